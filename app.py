@@ -7,26 +7,216 @@ Endpoints match official Mitel API patterns
 Includes Bearer Token authentication (optional)
 """
 
-from flask import Flask, jsonify, request, Response
+from flask import Flask, jsonify, request, Response, has_request_context, send_file
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
-from datetime import datetime, timedelta
-from functools import wraps
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache, partial, wraps
 import random
 import json
 import logging
+import logging.handlers
+import atexit
+import fcntl
+import gc
+import gzip
+import heapq
+import http.client
+import ipaddress
+import base64
+import copy
+import hashlib
+import hmac
+import math
+import mmap
 import os
+import queue
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+import cProfile
+import itertools
+import multiprocessing
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from typing import Optional
 
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Columnar export formats are optional
+    pa = None
+    pq = None
+
+# Start of module initialization, for the startup time reported by /health
+INIT_STARTED = time.perf_counter()
+
 app = Flask(__name__)
 CORS(app)
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Logging Configuration
+# Log records are handed to a bounded in-memory queue and written to stdout
+# by a background thread, so request threads never wait on log I/O.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# Output format: 'json' (structured, one object per line) or 'text'
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()
+# Max records waiting to be written; records are dropped when full
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+# Per-level sampling rates, e.g. "INFO=0.1,DEBUG=0" keeps 10% of INFO records
+# WARNING and above are never sampled
+LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES', '')
+
+
+class JsonFormatter(logging.Formatter):
+    """Format log records as single-line JSON objects"""
+    
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class LevelSamplingFilter(logging.Filter):
+    """
+    Keep only a fraction of records per level (WARNING and above always pass)
+    
+    Args:
+        rates: {levelno: fraction kept}, e.g. {logging.INFO: 0.1}
+    """
+    
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        # Separate RNG so sampling never perturbs the data generators
+        self._random = random.Random()
+    
+    def filter(self, record):
+        rate = self.rates.get(record.levelno)
+        if rate is None or record.levelno >= logging.WARNING:
+            return True
+        return rate > 0 and (rate >= 1 or self._random.random() < rate)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that never blocks and defers formatting to the writer thread
+    
+    Like the stock QueueHandler, the message (and traceback) is rendered in
+    the calling thread, so mutable %-style arguments are captured as they
+    were when logged; the JSON or text line itself is only formatted by the
+    background writer. Records are dropped (and counted) when the queue is
+    full.
+    """
+    
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+    
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        fields = getattr(record, 'fields', None)
+        if fields:
+            record.fields = dict(fields)
+        return record
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def parse_log_sample_rates(spec):
+    """Parse "INFO=0.1,DEBUG=0" into {logging.INFO: 0.1, logging.DEBUG: 0.0}"""
+    rates = {}
+    for item in spec.split(','):
+        if '=' not in item:
+            continue
+        level, rate = item.split('=', 1)
+        levelno = logging.getLevelName(level.strip().upper())
+        if isinstance(levelno, int):
+            rates[levelno] = max(0.0, min(1.0, float(rate)))
+    return rates
+
+
+_log_listener = None
+
+
+def start_log_listener(log_queue):
+    """Start the background thread that writes queued records to stdout"""
+    global _log_listener
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == 'json':
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter('%(levelname)s:%(name)s:%(message)s'))
+    _log_listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    _log_listener.start()
+
+
+def stop_log_listener():
+    """Flush queued records and stop the writer thread"""
+    if _log_listener is not None and _log_listener._thread is not None:
+        _log_listener.stop()
+
+
+def restart_log_listener_after_fork():
+    """
+    Give a forked worker a fresh queue and its own writer thread
+    Threads do not survive fork, and the parent's queue lock may be held
+    """
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    log_handler.queue = log_queue
+    start_log_listener(log_queue)
+
+
+def configure_logging():
+    """Route all logging through the non-blocking queue handler"""
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(LevelSamplingFilter(parse_log_sample_rates(LOG_SAMPLE_RATES)))
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    start_log_listener(log_queue)
+    atexit.register(stop_log_listener)
+    os.register_at_fork(after_in_child=restart_log_listener_after_fork)
+    return queue_handler
+
+
+log_handler = configure_logging()
 logger = logging.getLogger(__name__)
 
 # API Version
 API_VERSION = "v1"
 BASE_PATH = f"/api/{API_VERSION}"
+# Port of the development server (python app.py); gunicorn binds its own
+PORT = int(os.getenv('PORT', '5000'))
 
 # Authentication Configuration
 # Set REQUIRE_AUTH=true in environment to enable authentication
@@ -37,6 +227,248 @@ USER_MGMT_MODE = os.getenv('USER_MGMT_MODE', 'simple')
 USERS_FILE = os.getenv('USERS_FILE', 'users.json')
 # Token expiration time in seconds (default: 3600 = 1 hour)
 TOKEN_EXPIRATION_DEFAULT = int(os.getenv('TOKEN_EXPIRATION', '3600'))
+# Directory of issued bearer tokens, shared by all workers: a token works on
+# every worker, and a logout or injected expiry revokes it on all of them
+TOKEN_DIR = os.getenv('TOKEN_DIR', os.path.join(tempfile.gettempdir(), f'mitel-tokens-{PORT}'))
+
+# Dataset Configuration
+# /reporting/calls serves a deterministic call timeline: time is cut into
+# fixed slots and the call in each slot is generated from (seed, slot), so
+# every worker (and every restart) serves the same records.
+DATASET_SEED = int(os.getenv('DATASET_SEED', '1'))
+# Call volume of the timeline (one call per slot of 3600/N seconds)
+DATASET_CALLS_PER_HOUR = int(os.getenv('DATASET_CALLS_PER_HOUR', '360'))
+# Traffic shape of the timeline: 'flat' (every slot holds a call) or
+# 'contact-center' (hour-of-day and day-of-week arrival rates, bursts and
+# busy extensions from the traffic profile; DATASET_CALLS_PER_HOUR is then
+# the weekly average)
+TRAFFIC_MODEL = os.getenv('TRAFFIC_MODEL', 'flat')
+# Optional JSON file overriding DEFAULT_TRAFFIC_PROFILE (same shape)
+TRAFFIC_PROFILE_FILE = os.getenv('TRAFFIC_PROFILE_FILE')
+# Fastest simulated clock for /reporting/calls/stream?speed= (x real time)
+SIMULATION_MAX_SPEED = float(os.getenv('SIMULATION_MAX_SPEED', '3600'))
+# Longest paced /reporting/calls/stream replay (wall-clock seconds); keep it
+# below the proxy and gunicorn timeouts
+SIMULATION_MAX_SECONDS = float(os.getenv('SIMULATION_MAX_SECONDS', '55'))
+# Max messages of one paced replay
+SIMULATION_MAX_RECORDS = int(os.getenv('SIMULATION_MAX_RECORDS', '100000'))
+# Paced replays running at once per worker; each holds a worker thread, so
+# keep it below the gunicorn --threads. Replays beyond it get a 503
+SIMULATION_MAX_REPLAYS = int(os.getenv('SIMULATION_MAX_REPLAYS', '4'))
+# Optional JSON file of tenants by account (same shape as DEFAULT_TENANTS);
+# each tenant gets its own dataset, caches, rate limits and metrics
+TENANTS_FILE = os.getenv('TENANTS_FILE')
+# Memory-mapped file holding the per-tenant request metrics of all workers
+# (kept across restarts like the rate limit state; delete it to reset them)
+TENANT_METRICS_FILE = os.getenv(
+    'TENANT_METRICS_FILE', os.path.join(tempfile.gettempdir(), f'mitel-tenant-metrics-{PORT}.bin')
+)
+# Key used to sign pagination cursors
+SECRET_KEY = os.getenv('SECRET_KEY', 'your-secret-key-change-in-production')
+# Max slots scanned per /reporting/calls page, as a multiple of limit
+PAGE_SCAN_FACTOR = int(os.getenv('PAGE_SCAN_FACTOR', '50'))
+# Longest a /reporting/calls/changes long-poll may wait for new records (seconds);
+# keep it below the proxy and gunicorn timeouts
+CHANGES_MAX_WAIT = float(os.getenv('CHANGES_MAX_WAIT', '25'))
+# Long-polls waiting at once per worker; each holds a worker thread, so keep
+# it below the gunicorn --threads. Polls beyond it are answered right away
+# with Retry-After
+CHANGES_MAX_WAITERS = int(os.getenv('CHANGES_MAX_WAITERS', '8'))
+
+# Request Coalescing Configuration
+# Identical concurrent reporting queries are computed once and share the
+# encoded response: between threads of a worker, and (COALESCE_SHARED)
+# between workers through lock/result files in COALESCE_DIR
+COALESCE_ENABLED = os.getenv('COALESCE_ENABLED', 'true').lower() == 'true'
+COALESCE_SHARED = os.getenv('COALESCE_SHARED', 'true').lower() == 'true'
+COALESCE_DIR = os.getenv('COALESCE_DIR', os.path.join(tempfile.gettempdir(), 'mitel-coalesce'))
+# Lock/result file pairs; queries hashing to the same stripe take turns
+COALESCE_STRIPES = int(os.getenv('COALESCE_STRIPES', '256'))
+# Longest a duplicate waits for the first request before computing itself (seconds)
+COALESCE_TIMEOUT = float(os.getenv('COALESCE_TIMEOUT', '30'))
+
+# Cluster Configuration
+# Base URLs of all cluster nodes, comma-separated and in the same order on
+# every node (empty: standalone). Nodes must share DATASET_SEED, TENANTS_FILE
+# and SECRET_KEY; each owns one shard of every timeline and answers
+# /reporting/calls and /reporting/statistics by scatter-gather across peers.
+CLUSTER_PEERS = [url.strip().rstrip('/') for url in os.getenv('CLUSTER_PEERS', '').split(',') if url.strip()]
+# Index of this node in CLUSTER_PEERS
+CLUSTER_NODE = int(os.getenv('CLUSTER_NODE', '0'))
+# How timelines are split: 'hour' (hours dealt round-robin) or 'extension' (Extno hash)
+CLUSTER_SHARD_BY = os.getenv('CLUSTER_SHARD_BY', 'hour')
+# Timeout of a peer request (seconds); a failed peer's shard is computed locally
+CLUSTER_TIMEOUT = float(os.getenv('CLUSTER_TIMEOUT', '10'))
+# Idle keep-alive connections kept per peer, per worker
+CLUSTER_POOL_SIZE = int(os.getenv('CLUSTER_POOL_SIZE', '8'))
+
+# Warmup Configuration
+# Completed timeline hours built at startup, before gunicorn forks its workers
+# (run it with --preload so they are built once and shared); 0 disables warmup
+WARMUP_HOURS = int(os.getenv('WARMUP_HOURS', '24'))
+
+# Aggregation Configuration
+# Longest date range /reporting/calls/aggregate accepts, in days
+AGGREGATE_MAX_DAYS = int(os.getenv('AGGREGATE_MAX_DAYS', '92'))
+# Completed hours of the timeline kept as compact column blocks per worker
+# and tenant (tenants may override it, see DEFAULT_TENANTS). The default
+# covers an AGGREGATE_MAX_DAYS window, about 70 MB at 360 calls per hour.
+TIMELINE_CACHE_HOURS = int(os.getenv('TIMELINE_CACHE_HOURS', str((AGGREGATE_MAX_DAYS + 1) * 24)))
+# Longest date range /reporting/calls/search looks through, in days (its
+# default range); keep its hours below TIMELINE_CACHE_HOURS, or a search
+# cycling through the range evicts each hour's index before reusing it
+SEARCH_MAX_DAYS = int(os.getenv('SEARCH_MAX_DAYS', '30'))
+# Cached per-hour partial aggregates (one per hour and query shape) per tenant
+ROLLUP_CACHE_SIZE = int(os.getenv('ROLLUP_CACHE_SIZE', '16384'))
+# Longest wait of an inbound call answered within the service level target (seconds)
+SERVICE_LEVEL_SECONDS = int(os.getenv('SERVICE_LEVEL_SECONDS', '20'))
+# t-digest compression of the /reporting/statistics percentile sketches
+# (higher is more accurate and larger)
+TDIGEST_COMPRESSION = int(os.getenv('TDIGEST_COMPRESSION', '100'))
+# HyperLogLog precision of distinct-count sketches: 2^p one-byte registers
+# per sketch, standard error 1.04 / sqrt(2^p)
+HLL_PRECISION = int(os.getenv('HLL_PRECISION', '12'))
+# Counters per heavy-hitter (space-saving) sketch
+HEAVY_HITTER_CAPACITY = int(os.getenv('HEAVY_HITTER_CAPACITY', '512'))
+
+# Agent State Configuration
+# Agent states change with the call timeline and shift schedules; recent
+# changes are kept for /reporting/agents?sinceVersion= and the SSE feed
+AGENT_EVENT_LOG = int(os.getenv('AGENT_EVENT_LOG', '4096'))
+# Longest /reporting/agents/events connection (seconds); clients reconnect
+# with Last-Event-ID. Keep it below the proxy and gunicorn timeouts
+AGENT_STREAM_MAX_SECONDS = float(os.getenv('AGENT_STREAM_MAX_SECONDS', '55'))
+# Idle time after which the SSE feed sends a keep-alive comment (seconds)
+AGENT_HEARTBEAT_SECONDS = float(os.getenv('AGENT_HEARTBEAT_SECONDS', '15'))
+# Open /reporting/agents/events feeds per worker; each holds a worker
+# thread, so keep it below the gunicorn --threads. Feeds beyond it get a
+# 503 pointing to /reporting/agents?sinceVersion= polling
+AGENT_STREAM_MAX_CLIENTS = int(os.getenv('AGENT_STREAM_MAX_CLIENTS', '8'))
+
+# Rate Limiting Configuration
+# Set RATE_LIMIT_ENABLED=true to throttle clients with token buckets
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', 'false').lower() == 'true'
+# Default client identity for buckets: 'token', 'user' or 'account'
+RATE_LIMIT_KEY = os.getenv('RATE_LIMIT_KEY', 'user')
+# Optional JSON file overriding DEFAULT_RATE_LIMITS (same shape)
+RATE_LIMITS_FILE = os.getenv('RATE_LIMITS_FILE')
+# Memory-mapped file holding bucket state shared by all workers
+RATE_LIMIT_STATE_FILE = os.getenv(
+    'RATE_LIMIT_STATE_FILE', os.path.join(tempfile.gettempdir(), 'mitel-rate-limits.bin')
+)
+RATE_LIMIT_SLOTS = int(os.getenv('RATE_LIMIT_SLOTS', '16384'))
+# Reverse proxies in front of the app, each appending the address it saw to
+# X-Forwarded-For (1: the bundled nginx); anonymous clients are keyed by the
+# entry the outermost one appended. 0 when clients connect directly.
+RATE_LIMIT_PROXY_HOPS = int(os.getenv('RATE_LIMIT_PROXY_HOPS', '1'))
+
+# Fault Injection Configuration
+# Optional JSON file of fault profiles replacing DEFAULT_FAULT_PROFILES (same shape)
+FAULT_PROFILES_FILE = os.getenv('FAULT_PROFILES_FILE')
+# File holding the active profiles, shared by all workers; rewritten at
+# startup and by PUT /admin/faults
+FAULT_STATE_FILE = os.getenv(
+    'FAULT_STATE_FILE', os.path.join(tempfile.gettempdir(), f'mitel-faults-{PORT}.json')
+)
+# Longest injected delay (seconds); keep it below the proxy and gunicorn timeouts
+FAULT_MAX_DELAY_SECONDS = float(os.getenv('FAULT_MAX_DELAY_SECONDS', '55'))
+# Let nginx throttle bandwidth (X-Accel-Limit-Rate) from its response buffer,
+# instead of trickling the body from the worker
+FAULT_PROXY_THROTTLE = os.getenv('FAULT_PROXY_THROTTLE', 'false').lower() == 'true'
+
+# Admission Control Configuration
+# Set ADMISSION_CONTROL_ENABLED=true to shed load early with 503 when overloaded
+ADMISSION_CONTROL_ENABLED = os.getenv('ADMISSION_CONTROL_ENABLED', 'false').lower() == 'true'
+# End-to-end latency target (queueing + service) for admitted requests
+ADMISSION_LATENCY_TARGET_MS = float(os.getenv('ADMISSION_LATENCY_TARGET_MS', '2000'))
+# Max concurrent requests per worker process (threaded workers)
+ADMISSION_MAX_INFLIGHT = int(os.getenv('ADMISSION_MAX_INFLIGHT', '16'))
+# A route shed for its service time still admits one probe request per
+# interval (seconds), so its estimate recovers once the route is fast again
+ADMISSION_PROBE_SECONDS = float(os.getenv('ADMISSION_PROBE_SECONDS', '1'))
+
+# Columnar Export Configuration (format=arrow|parquet, requires pyarrow)
+# Max records per columnar export (CSV stays capped at 1000)
+COLUMNAR_EXPORT_MAX_LIMIT = int(os.getenv('COLUMNAR_EXPORT_MAX_LIMIT', '1000000'))
+# Records generated and written per Arrow record batch / Parquet row group
+EXPORT_ROW_GROUP_SIZE = int(os.getenv('EXPORT_ROW_GROUP_SIZE', '65536'))
+
+# Parallel Generation Configuration
+# Processes used to generate large exports/streams (1 disables the pool)
+PARALLEL_WORKERS = int(os.getenv('PARALLEL_WORKERS', str(os.cpu_count() or 1)))
+# Requests for at least this many records are generated in the process pool
+PARALLEL_MIN_RECORDS = int(os.getenv('PARALLEL_MIN_RECORDS', '50000'))
+# Records per range handed to one pool process (CSV and stream)
+PARALLEL_CHUNK_SIZE = int(os.getenv('PARALLEL_CHUNK_SIZE', '10000'))
+# Max records for CSV exports and Kafka streams
+CSV_EXPORT_MAX_LIMIT = int(os.getenv('CSV_EXPORT_MAX_LIMIT', '1000'))
+STREAM_MAX_LIMIT = int(os.getenv('STREAM_MAX_LIMIT', '500'))
+
+# Export Job Configuration (/reporting/exports)
+# Directory of job status files and finished exports; shared by all workers
+EXPORT_JOB_DIR = os.getenv('EXPORT_JOB_DIR', os.path.join(tempfile.gettempdir(), 'mitel-exports'))
+# Processes writing export files (per worker)
+EXPORT_JOB_WORKERS = int(os.getenv('EXPORT_JOB_WORKERS', '2'))
+# Max records per export file (the file is marked truncated beyond)
+EXPORT_JOB_MAX_RECORDS = int(os.getenv('EXPORT_JOB_MAX_RECORDS', '5000000'))
+# Longest date range of an export job, in days
+EXPORT_JOB_MAX_DAYS = int(os.getenv('EXPORT_JOB_MAX_DAYS', '92'))
+# gzip level of export files (1 = fastest, 9 = smallest)
+EXPORT_JOB_COMPRESSION = int(os.getenv('EXPORT_JOB_COMPRESSION', '6'))
+# Hours jobs and their files are kept after submission
+EXPORT_JOB_TTL_HOURS = float(os.getenv('EXPORT_JOB_TTL_HOURS', '24'))
+
+# Webhook Subscription Configuration (/reporting/subscriptions)
+# Directory of subscriptions and their delivery cursors; shared by all workers
+WEBHOOK_DIR = os.getenv('WEBHOOK_DIR', os.path.join(tempfile.gettempdir(), f'mitel-webhooks-{PORT}'))
+# Default and max records per pushed batch
+WEBHOOK_BATCH_RECORDS = int(os.getenv('WEBHOOK_BATCH_RECORDS', '500'))
+WEBHOOK_MAX_BATCH_RECORDS = int(os.getenv('WEBHOOK_MAX_BATCH_RECORDS', '5000'))
+# Default longest wait before a partial batch is pushed (milliseconds)
+WEBHOOK_BATCH_DELAY_MS = int(os.getenv('WEBHOOK_BATCH_DELAY_MS', '1000'))
+# Max unanswered batches per subscriber (1 keeps batches in order)
+WEBHOOK_MAX_IN_FLIGHT = int(os.getenv('WEBHOOK_MAX_IN_FLIGHT', '4'))
+# Threads posting batches, shared by all subscribers
+WEBHOOK_POOL_SIZE = int(os.getenv('WEBHOOK_POOL_SIZE', '16'))
+# Connect and response timeout of one delivery (seconds)
+WEBHOOK_TIMEOUT = float(os.getenv('WEBHOOK_TIMEOUT', '10'))
+# Retry backoff: first delay, doubled per attempt up to the max (seconds)
+WEBHOOK_RETRY_BASE_SECONDS = float(os.getenv('WEBHOOK_RETRY_BASE_SECONDS', '0.5'))
+WEBHOOK_RETRY_MAX_SECONDS = float(os.getenv('WEBHOOK_RETRY_MAX_SECONDS', '60'))
+# Attempts per batch before it is dropped
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', '10'))
+# Records read ahead per subscriber while deliveries are behind
+WEBHOOK_MAX_PENDING_RECORDS = int(os.getenv('WEBHOOK_MAX_PENDING_RECORDS', '20000'))
+# Hosts webhooks may be posted to besides public addresses: hostnames, IP
+# addresses or CIDR networks, comma-separated. URLs resolving to private,
+# loopback, link-local or reserved addresses are refused otherwise, so
+# subscribers cannot make the mock probe its own network
+WEBHOOK_ALLOWED_HOSTS = [host.strip().lower() for host in os.getenv('WEBHOOK_ALLOWED_HOSTS', '').split(',')
+                         if host.strip()]
+# Subscriptions per tenant, and how far back a subscription's startDate may
+# replay calls (hours)
+WEBHOOK_MAX_SUBSCRIPTIONS = int(os.getenv('WEBHOOK_MAX_SUBSCRIPTIONS', '20'))
+WEBHOOK_MAX_BACKFILL_HOURS = float(os.getenv('WEBHOOK_MAX_BACKFILL_HOURS', '24'))
+# Where webhooks are delivered from: 'worker' (one web worker at a time) or
+# 'external' (a separate `python app.py --webhook-dispatcher` process)
+WEBHOOK_DISPATCHER = os.getenv('WEBHOOK_DISPATCHER', 'worker')
+
+# Max sub-queries in one /reporting/batch request
+BATCH_MAX_QUERIES = int(os.getenv('BATCH_MAX_QUERIES', '50'))
+
+# Profiling Configuration
+# Set PROFILING_ENABLED=true to let admin users profile individual requests
+PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', 'false').lower() == 'true'
+# Set PROFILING_CONTINUOUS=true to keep a low-overhead sampler running per worker
+PROFILING_CONTINUOUS = os.getenv('PROFILING_CONTINUOUS', 'false').lower() == 'true'
+# Directory where on-demand profiles are stored (shared by all workers)
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+# Most recent on-demand profiles kept in PROFILE_DIR; older ones are deleted
+PROFILE_RETENTION = int(os.getenv('PROFILE_RETENTION', '200'))
+# Sampling interval for on-demand profiles, in milliseconds
+PROFILE_SAMPLE_INTERVAL_MS = int(os.getenv('PROFILE_SAMPLE_INTERVAL_MS', '5'))
+# Sampling interval for the continuous sampler, in milliseconds
+PROFILE_CONTINUOUS_INTERVAL_MS = int(os.getenv('PROFILE_CONTINUOUS_INTERVAL_MS', '50'))
 
 # Simple mode - hardcoded users (for quick testing)
 SIMPLE_USERS = {
@@ -54,9 +486,83 @@ SIMPLE_USERS = {
     }
 }
 
-# Store active tokens (in production, use Redis or database)
+# Tokens seen by this worker (in production, use Redis or database); the
+# issued tokens themselves are kept in TOKEN_DIR
 active_tokens = {}
 
+# Rate limit rules: route -> role -> limits ('*' matches any route or role)
+#   rate:             sustained requests per second
+#   burst:            request bucket size
+#   recordsPerMinute: record quota (the request's 'limit' is its cost; a
+#                     larger limit is allowed once the quota is full, and
+#                     the excess is paid back before the next request)
+#   key:              bucket identity, 'token', 'user' or 'account'
+# Rules for a specific route fall back to the '*' route, key by key.
+DEFAULT_RATE_LIMITS = {
+    "*": {
+        "*": {"rate": 10, "burst": 20, "recordsPerMinute": 30000},
+        "admin": {"rate": 50, "burst": 100, "recordsPerMinute": 300000}
+    },
+    f"{BASE_PATH}/reporting/calls/export": {
+        "*": {"rate": 1, "burst": 5, "recordsPerMinute": 10000},
+        "admin": {"rate": 5, "burst": 20, "recordsPerMinute": 100000}
+    },
+    f"{BASE_PATH}/reporting/exports": {
+        "*": {"rate": 0.1, "burst": 5},
+        "admin": {"rate": 1, "burst": 20}
+    },
+    "/auth/login": {
+        "*": {"rate": 1, "burst": 10, "key": "token"}
+    }
+}
+
+# Fault profiles: route -> faults ('*' matches any route; empty: no faults)
+#   latencyMs:               delay before the response, a fixed number or a
+#                            distribution: {"distribution": "uniform", "min", "max"},
+#                            {"distribution": "exponential", "mean"} or
+#                            {"distribution": "lognormal", "median", "p99"}
+#   errorRate:               share of requests answered with an error instead
+#   errorStatuses:           statuses picked from for errors (default: [500, 502, 503])
+#   tokenExpiryRate:         share of bearer token requests whose token expires
+#                            (401 INVALID_TOKEN; the client has to log in again)
+#   bandwidthBytesPerSecond: body transfer rate
+#   disconnectRate:          share of responses cut off mid-body
+# Faults for a specific route fall back to the '*' route, key by key.
+# /, /health and /admin routes never get faults.
+DEFAULT_FAULT_PROFILES = {}
+
+# Admission priority per route: 0 = never shed, 1 = normal, 2 = expensive
+# Expensive routes are shed first, at a fraction of the latency/in-flight budget
+ROUTE_PRIORITIES = {
+    "/": 0,
+    "/health": 0,
+    f"{BASE_PATH}/reporting/calls/stream": 2,
+    f"{BASE_PATH}/reporting/calls/aggregate": 2,
+    f"{BASE_PATH}/reporting/calls/distinct": 2,
+    f"{BASE_PATH}/reporting/calls/top": 2,
+    f"{BASE_PATH}/reporting/calls/export": 2,
+    f"{BASE_PATH}/reporting/agents/events": 2
+}
+ADMISSION_BUDGET_SHARE = {1: 1.0, 2: 0.5}
+
+# Routes never rate limited
+RATE_LIMIT_EXEMPT = {"/", "/health"}
+
+# Record-returning routes: (default limit, max limit), used to cost quotas
+ROUTE_RECORD_LIMITS = {
+    f"{BASE_PATH}/reporting/calls": (50, 500),
+    f"{BASE_PATH}/reporting/calls/changes": (100, 500),
+    f"{BASE_PATH}/reporting/calls/search": (50, 500),
+    f"{BASE_PATH}/reporting/calls/stream": (50, STREAM_MAX_LIMIT),
+    f"{BASE_PATH}/reporting/calls/export": (100, CSV_EXPORT_MAX_LIMIT)
+}
+
+# /reporting/batch sub-queries returning records, and the route whose limits they share
+BATCH_RECORD_ROUTES = {
+    "calls": f"{BASE_PATH}/reporting/calls",
+    "search": f"{BASE_PATH}/reporting/calls/search"
+}
+
 # Mock data pools - based on your CSV
 USERNAMES = [
     "PTP AG4311,METZ", "PTP AG4311,G1", "COMPTOIR,FIXE2469", 
@@ -80,74 +586,227 @@ CALL_OUTCOMES = ["103", "108", "207", "202", "105", "102"]
 # Journey outcomes (Contact Center specific)
 JOURNEY_OUTCOMES = ["701", "702", "703", "0"]
 
+# Call outcomes of answered calls, and of legs that end when the next leg
+# of their journey starts
+CALL_ANSWERED = "103"
+CALL_TRANSFERRED = "202"
+CALL_NO_ANSWER = "108"
+
+# Outcomes drawn for unanswered calls that end their journey
+UNANSWERED_CALL_OUTCOMES = [outcome for outcome in CALL_OUTCOMES
+                            if outcome not in (CALL_ANSWERED, CALL_TRANSFERRED)]
+
+# Groups whose ringpoints a call can ring in turn
+RINGPOINT_GROUPS = [group for group in GROUP_NUMBERS if group]
+
+# Call journeys: kind -> (relative share, fewest legs, most legs)
+#   direct:    one leg
+#   transfer:  each leg is answered, then transferred to another extension
+#   ringpoint: the call rings a group's extensions in turn until one answers
+#   callback:  an abandoned inbound call, returned by an agent (outbound)
+JOURNEY_KINDS = {
+    "direct": (60, 1, 1),
+    "transfer": (18, 2, 3),
+    "ringpoint": (14, 2, 5),
+    "callback": (8, 2, 2)
+}
+
+# Most legs of a journey (Call_legs)
+JOURNEY_MAX_LEGS = 5
+
+# Journey kinds, and the cumulative share each kind's draws stay below
+JOURNEY_KIND_NAMES = list(JOURNEY_KINDS)
+JOURNEY_KIND_THRESHOLDS = list(itertools.accumulate(
+    share / sum(share for share, _, _ in JOURNEY_KINDS.values()) for share, _, _ in JOURNEY_KINDS.values()
+))[:-1]
+
 DEVICE_IDS = ["19", "-1", "873", "924", "63", "146", "1345"]
 
+# Distinct external numbers calling in or called; a few call often, most rarely
+CALLER_POPULATION = 20000
+
+# Contact-center traffic shape (TRAFFIC_MODEL=contact-center):
+#   hourly:       relative arrival rate per hour of day (0-23)
+#   weekday:      relative arrival rate per day of week (Monday first)
+#   burstiness:   coefficient of variation of the load in each burst period
+#                 (0: plain Poisson arrivals at the hourly rate)
+#   burstMinutes: length of a burst period
+#   extensions:   relative share of calls per extension (default: 1)
+# Rates are normalized so the weekly average is DATASET_CALLS_PER_HOUR.
+DEFAULT_TRAFFIC_PROFILE = {
+    "hourly": [0.05, 0.03, 0.02, 0.02, 0.03, 0.08, 0.25, 0.7, 1.6, 2.3, 2.5, 2.2,
+               1.5, 1.7, 2.1, 2.0, 1.7, 1.2, 0.6, 0.35, 0.25, 0.15, 0.1, 0.07],
+    "weekday": [1.35, 1.15, 1.05, 1.0, 0.95, 0.35, 0.15],
+    "burstiness": 0.35,
+    "burstMinutes": 5,
+    "extensions": {
+        "694311": 4, "9431101": 3, "711540": 2, "616445": 1.5, "9921043": 2.5,
+        "792653": 1, "9246901": 1, "9359201": 0.6, "712322": 0.4
+    }
+}
+
+# Tenants by token account_id ("*": accounts without their own entry, and
+# anonymous requests). Every setting is optional:
+#   tenantId:       TenantId of the tenant's records (default: "1")
+#   seed:           dataset seed (default: DATASET_SEED)
+#   callsPerHour:   call volume (default: DATASET_CALLS_PER_HOUR)
+#   trafficModel:   'flat' or 'contact-center' (default: TRAFFIC_MODEL)
+#   trafficProfile: traffic profile (default: TRAFFIC_PROFILE_FILE, then
+#                   DEFAULT_TRAFFIC_PROFILE)
+#   extensions:     extension pool (default: EXTENSIONS)
+#   rateLimits:     rules overriding the global rate limits, same shape as
+#                   DEFAULT_RATE_LIMITS
+#   cacheHours:     completed timeline hours kept in the tenant's caches
+#                   (default: TIMELINE_CACHE_HOURS)
+# Accounts sharing a tenantId and settings still get separate caches.
+DEFAULT_TENANTS = {
+    "*": {"tenantId": "1"}
+}
+
 # Starting record ID
 record_id_counter = 78340000
+# Guards the counter between the request threads of a worker
+record_id_lock = threading.Lock()
+# Guards the lazily started per-worker pools and threads
+worker_init_lock = threading.RLock()
 
 
-def generate_phone_number(international=True):
-    """Generate mock phone number"""
+def generate_phone_number(international=True, rng=random, digits=None):
+    """
+    Generate mock phone number
+    
+    Args:
+        digits: Subscriber number to use (default: drawn from rng)
+    """
+    if digits is None:
+        digits = rng.randint(100000000, 999999999)
     if international:
-        return f"+33{random.randint(100000000, 999999999)}"
-    return f"0{random.randint(100000000, 999999999)}"
+        return f"+33{digits}"
+    return f"0{digits}"
 
 
-def generate_call_id():
+def generate_call_id(rng=random):
     """Generate Mitel-style call ID"""
-    prefix = random.choice(['A', 'B', 'C', 'D', 'I', 'K', 'M', 'Q', 'Y', 'X'])
-    number = random.randint(2010000, 2020000)
+    prefix = rng.choice(['A', 'B', 'C', 'D', 'I', 'K', 'M', 'Q', 'Y', 'X'])
+    number = rng.randint(2010000, 2020000)
     return f"{prefix}{number}"
 
 
-def generate_leg_id(extno, call_id, timestamp):
-    """Generate Mitel-style leg ID"""
-    phone = random.randint(10000000000, 99999999999)
+def generate_leg_id(extno, call_id, timestamp, rng=random, phone=None):
+    """
+    Generate Mitel-style leg ID
+    
+    Args:
+        phone: Leading phone number to use (default: drawn from rng)
+    """
+    if phone is None:
+        phone = rng.randint(10000000000, 99999999999)
     return f"{phone}_{extno}_{call_id}_{timestamp}"
 
 
-def generate_call_record(start_date: Optional[datetime] = None, end_date: Optional[datetime] = None):
+class CallCore:
     """
-    Generate a single Call Detail Record matching Mitel MiContact Center format
+    Core values of a Call Detail Record (see generate_call_core), and its
+    place in its journey once linked (see link_journey)
+    
+    Slotted, so a core costs a fixed-size object instead of a dict; string
+    values are references into the mock data pools.
+    """
+    
+    __slots__ = ('record_id', 'extno', 'username', 'direction', 'call_id', 'group_no',
+                 'call_timestamp', 'ring_time', 'duration', 'wait_time', 'hold_duration',
+                 'journey_outcome', 'call_date', 'bits', 'tenant_id',
+                 'journey', 'leg', 'previous', 'call_outcome')
+    
+    def __init__(self, record_id, extno, username, direction, call_id, group_no, call_timestamp,
+                 ring_time, duration, wait_time, hold_duration, journey_outcome, call_date, bits,
+                 tenant_id="1"):
+        self.record_id = record_id
+        self.extno = extno
+        self.username = username
+        self.direction = direction
+        self.call_id = call_id
+        self.group_no = group_no
+        self.call_timestamp = call_timestamp
+        self.ring_time = ring_time
+        self.duration = duration
+        self.wait_time = wait_time
+        self.hold_duration = hold_duration
+        self.journey_outcome = journey_outcome
+        self.call_date = call_date
+        self.bits = bits
+        self.tenant_id = tenant_id
+        self.journey = None
+        self.leg = 1
+        self.previous = None
+        self.call_outcome = None
+
+
+def generate_call_core(start_date: Optional[datetime] = None, end_date: Optional[datetime] = None,
+                       rng=random, record_id: Optional[int] = None,
+                       call_date: Optional[datetime] = None, tenant=None):
+    """
+    Draw the core values of a Call Detail Record
+    
+    These are the values other fields or filters depend on, plus one wide
+    random integer ("bits") that per-field builders slice their values from.
+    Everything is drawn up front in a fixed order, so a record's values only
+    depend on the RNG state, never on which fields are projected. The core
+    is one leg; link_journey links it into its journey.
     
     Args:
         start_date: Start of date range for call_date
         end_date: End of date range for call_date
+        rng: Random generator to draw from (default: the shared module RNG)
+        record_id: RecordId to use (default: next value of the global counter)
+        call_date: Call date to use (default: drawn within the date range)
+        tenant: Tenant whose extensions and traffic model to use (default:
+                the default tenant)
     """
     global record_id_counter
-    record_id_counter += 1
+    if record_id is None:
+        with record_id_lock:
+            record_id_counter += 1
+            record_id = record_id_counter
+    if tenant is None:
+        tenant = default_tenant
+    traffic_model = tenant.traffic
     
     # Call metadata
-    extno = random.choice(EXTENSIONS)
-    username = random.choice(USERNAMES)
-    direction = random.choice(CALL_DIRECTIONS)
-    call_id = generate_call_id()
-    group_no = random.choice(GROUP_NUMBERS)
-    call_timestamp = int(datetime.now().timestamp())
+    if traffic_model.extension_weights:
+        extno = rng.choices(tenant.extensions, cum_weights=traffic_model.extension_weights)[0]
+    else:
+        extno = rng.choice(tenant.extensions)
+    username = rng.choice(USERNAMES)
+    direction = rng.choice(CALL_DIRECTIONS)
+    call_id = generate_call_id(rng)
+    group_no = rng.choice(GROUP_NUMBERS)
     
     # Call timing
-    ring_time = random.randint(0, 30) if direction in ["I", "B"] else 0
-    duration = random.randint(0, 600)
-    unanswered = "1" if duration == 0 else "0"
-    wait_time = random.randint(0, 60)
-    hold_duration = random.randint(0, 120) if duration > 0 else 0
+    ring_time = rng.randint(0, 30) if direction in ["I", "B"] else 0
+    duration = rng.randint(0, 600)
+    wait_time = rng.randint(0, 60)
+    hold_duration = rng.randint(0, 120) if duration > 0 else 0
     
     # Journey metrics (Contact Center specific)
-    journey_outcome = random.choice(JOURNEY_OUTCOMES)
-    contact_points = "1" if duration > 0 else "0"
-    call_experience = str(random.randint(0, 5)) if duration > 0 else "0"
+    journey_outcome = rng.choice(JOURNEY_OUTCOMES)
     
     # Call date - within specified range if provided
-    if start_date and end_date:
+    if call_date is not None:
+        pass
+    elif traffic_model.shaped:
+        # Arrivals follow the traffic model (same default windows as below)
+        call_date = traffic_model.draw_time(*dataset_window(start_date, end_date), rng)
+    elif start_date and end_date:
         # Generate random datetime within range
         time_diff = (end_date - start_date).total_seconds()
-        random_seconds = random.uniform(0, time_diff)
+        random_seconds = rng.uniform(0, time_diff)
         call_date = start_date + timedelta(seconds=random_seconds)
     elif start_date:
         # Generate from start_date to now
         time_diff = (datetime.now() - start_date).total_seconds()
         if time_diff > 0:
-            random_seconds = random.uniform(0, time_diff)
+            random_seconds = rng.uniform(0, time_diff)
             call_date = start_date + timedelta(seconds=random_seconds)
         else:
             call_date = start_date
@@ -155,603 +814,6553 @@ def generate_call_record(start_date: Optional[datetime] = None, end_date: Option
         # Generate from 30 days before end_date to end_date
         start = end_date - timedelta(days=30)
         time_diff = (end_date - start).total_seconds()
-        random_seconds = random.uniform(0, time_diff)
+        random_seconds = rng.uniform(0, time_diff)
         call_date = start + timedelta(seconds=random_seconds)
     else:
         # Default: random time in last hour
-        call_date = datetime.now() - timedelta(seconds=random.randint(0, 3600))
-    
-    # Build the record
-    record = {
-        "RecordId": record_id_counter,
-        "Extno": extno,
-        "Username": username,
-        "Call_date": call_date.strftime("%Y-%m-%dT%H:%M:%S"),
-        "Number": generate_phone_number(),
-        "Port": generate_phone_number() if random.random() > 0.1 else "",
-        "Ring_time": ring_time,
-        "Account": "",
-        "Call_cost": round(random.uniform(0, 5), 2) if duration > 0 else 0,
-        "Duration": duration,
-        "Direction": direction,
-        "Unanswer": unanswered,
-        "Transfer": str(random.randint(0, 1)),
-        "Vpn": "0",
-        "Call_dist": "1",
-        "Acc_code": "",
-        "Std_code": "0",
-        "Destination": "",
-        "CallId": call_id,
-        "Group_no": group_no,
-        "Call_outcome": random.choice(CALL_OUTCOMES),
-        "Call_legId": str(random.randint(1, 5)),
-        "Call_returnstatus": "0",
-        "TenantId": "1",
-        "LegID": generate_leg_id(extno, call_id, call_timestamp),
-        "PreviousLegID": "",
-        "Call_legs": str(random.randint(1, 5)),
-        "Return_date": "",
-        "Return_record": "",
-        "Return_direction": "",
-        
-        # VoIP Quality Metrics (may be empty)
-        "SourceRoundTripDelay": "",
-        "SourceEndSystemDelay": "",
-        "TargetEndSystemDelay": "",
-        "SourceSymmOneWayDelay": "",
-        "TargetSymmOneWayDelay": "",
-        "SourceInterarrivalJitter": "",
-        "TargetInterarrivalJitter": "",
-        "SourceMOSLQ": "",
-        "TargetMOSLQ": "",
-        "SourceMOSCQ": "",
-        "TargetMOSCQ": "",
-        
-        # Contact Center / Group fields
-        "firstGroupRingpoint": "",
-        "GroupPosition": str(random.randint(0, 1)),
-        
-        # Journey Analytics
-        "totalDuration": str(duration + ring_time + random.randint(0, 20)),
-        "waitTime": str(wait_time),
-        "CallBackAgentAssigned": "",
-        "CallBackAssignedDateTime": "",
-        "ReturnedByAgent": "",
-        "HoldDuration": str(hold_duration),
-        "JourneyWaitTime": str(wait_time),
-        "JourneyOutcome": journey_outcome,
-        "ContactPoints": contact_points,
-        "CallExperienceRating": call_experience,
-        "DeviceId": random.choice(DEVICE_IDS)
-    }
+        call_date = datetime.now() - timedelta(seconds=rng.randint(0, 3600))
     
-    return record
+    return CallCore(
+        record_id=record_id,
+        extno=extno,
+        username=username,
+        direction=direction,
+        call_id=call_id,
+        group_no=group_no,
+        call_timestamp=int(call_date.timestamp()),
+        ring_time=ring_time,
+        duration=duration,
+        wait_time=wait_time,
+        hold_duration=hold_duration,
+        journey_outcome=journey_outcome,
+        call_date=call_date,
+        bits=rng.getrandbits(CDR_RANDOM_BITS),
+        tenant_id=tenant.tenant_id
+    )
 
 
-def wrap_in_kafka_format(record):
+class Journey:
     """
-    Wrap CDR record in Kafka message format (as seen in your CSV)
+    Values shared by the legs of one call journey (see link_journey)
+    
+    Args:
+        kind: Journey kind (see JOURNEY_KINDS)
+        legs: Number of legs
+        total_duration: Seconds from the first leg's start to the last leg's end
+        wait_time: Wait time summed over the legs
+        contact_points: Number of answered legs
+        first_ringpoint: First extension a ringpoint journey rang ("" otherwise)
+        callback: (RecordId, Call_date) of a callback journey's returned call, or None
     """
-    timestamp = int(datetime.now().timestamp() * 1000)
     
-    return {
-        "timestamp": timestamp,
-        "timestampType": "CREATE_TIME",
-        "partition": 0,
-        "offset": random.randint(25393000, 25395000),
-        "key": {"key": str(record["RecordId"])},
-        "value": record,
-        "headers": [],
-        "exceededFields": ""
-    }
+    __slots__ = ('kind', 'legs', 'total_duration', 'wait_time', 'contact_points',
+                 'first_ringpoint', 'callback')
+    
+    def __init__(self, kind, legs, total_duration, wait_time, contact_points, first_ringpoint="",
+                 callback=None):
+        self.kind = kind
+        self.legs = legs
+        self.total_duration = total_duration
+        self.wait_time = wait_time
+        self.contact_points = contact_points
+        self.first_ringpoint = first_ringpoint
+        self.callback = callback
 
 
-def parse_date_param(date_str: str, param_name: str, end_of_day: bool = False):
+def draw_journey_kind(rng, max_legs=JOURNEY_MAX_LEGS):
     """
-    Parse date parameter from request
+    Draw a journey kind and its number of legs
     
-    Supports:
-    - ISO 8601: 2025-11-20T10:30:00
-    - ISO 8601 with Z: 2025-11-20T10:30:00Z
-    - Date only: 2025-11-20
+    Args:
+        max_legs: Most legs the journey may have; kinds that need more are
+                  shortened, or drawn as direct calls
+    
+    Returns:
+        tuple: (kind, legs)
     """
-    if not date_str:
-        return None
-        
-    try:
-        # Handle ISO 8601 with timezone
-        if 'T' in date_str:
-            date_str = date_str.replace('Z', '+00:00')
-            return datetime.fromisoformat(date_str)
-        else:
-            # Date only - parse and optionally set to end of day
-            dt = datetime.strptime(date_str, '%Y-%m-%d')
-            if end_of_day:
-                dt = dt.replace(hour=23, minute=59, second=59)
-            return dt
-    except ValueError:
-        raise ValueError(f"Invalid {param_name} format. Use ISO 8601: YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS")
+    kind = JOURNEY_KIND_NAMES[bisect_right(JOURNEY_KIND_THRESHOLDS, rng.random())]
+    _, fewest, most = JOURNEY_KINDS[kind]
+    legs = fewest + int(rng.random() * (most - fewest + 1))
+    if fewest > max_legs:
+        return "direct", 1
+    return kind, min(legs, max_legs)
 
 
-def load_users_from_json():
-    """Load users from JSON file"""
-    try:
-        with open(USERS_FILE, 'r') as f:
-            data = json.load(f)
-            users = {}
-            for user in data.get('users', []):
-                users[user['username']] = user
-            return users
-    except FileNotFoundError:
-        logger.warning(f"Users file '{USERS_FILE}' not found. Using simple mode.")
-        return SIMPLE_USERS
-    except Exception as e:
-        logger.error(f"Error loading users file: {e}. Using simple mode.")
-        return SIMPLE_USERS
+def link_journey(cores, kind, tenant, call_id=None):
+    """
+    Link the leg cores of one journey into a coherent journey
+    
+    Legs share the first leg's CallId, caller Number and direction (a
+    callback is returned outbound), and every leg but the last ends when the
+    next one starts: a transfer leg is answered, then transferred, while
+    ringpoints and the abandoned call before a callback ring unanswered.
+    Each leg references the one before it (PreviousLegID); JourneyOutcome,
+    totalDuration, JourneyWaitTime and ContactPoints describe the whole
+    journey on every leg.
+    
+    Args:
+        cores: Leg cores of the journey in call order, with their call dates
+        kind: Journey kind (see JOURNEY_KINDS)
+        tenant: Tenant whose extensions the legs move between
+        call_id: CallId of the journey (default: the first leg's)
+    
+    Returns:
+        Journey: Values shared by the legs (also set on each core)
+    """
+    first = cores[0]
+    last = cores[-1]
+    offset, width = CDR_RANDOM_SLICES["Number"]
+    caller_mask = ((1 << width) - 1) << offset
+    extensions = tenant.extensions
+    if kind in ("ringpoint", "callback"):
+        first.direction = "I"
+    if kind == "ringpoint" and not first.group_no:
+        first.group_no = RINGPOINT_GROUPS[first.record_id % len(RINGPOINT_GROUPS)]
+    
+    previous = None
+    for index, core in enumerate(cores):
+        core.leg = index + 1
+        core.previous = previous
+        core.call_id = call_id or first.call_id
+        if previous is not None:
+            core.bits = (core.bits & ~caller_mask) | (first.bits & caller_mask)
+            core.direction = "O" if kind == "callback" else first.direction
+            if kind == "ringpoint":
+                core.group_no = first.group_no
+            if kind != "callback" and core.extno == previous.extno:
+                core.extno = extensions[(extensions.index(core.extno) + 1) % len(extensions)]
+        if core is not last:
+            # The leg ends when the next one starts
+            gap = max(0, int((cores[index + 1].call_date - core.call_date).total_seconds()))
+            if kind == "transfer":
+                core.ring_time = min(core.ring_time, gap // 3)
+                core.duration = gap - core.ring_time
+                core.call_outcome = CALL_TRANSFERRED
+            else:
+                core.ring_time = gap if kind == "ringpoint" else min(core.ring_time, gap)
+                core.duration = 0
+                core.call_outcome = CALL_NO_ANSWER
+            core.hold_duration = min(core.hold_duration, core.duration)
+        previous = core
+    
+    if kind == "callback":
+        outcome = "703"
+    elif kind == "direct" and first.direction == "O":
+        outcome = "0"
+    else:
+        outcome = "701" if last.duration > 0 else "702"
+    journey = Journey(
+        kind, len(cores),
+        total_duration=(int((last.call_date - first.call_date).total_seconds())
+                        + last.ring_time + last.duration),
+        wait_time=sum(core.wait_time for core in cores),
+        contact_points=sum(1 for core in cores if core.duration > 0),
+        first_ringpoint=first.extno if kind == "ringpoint" else "",
+        callback=(last.record_id, last.call_date) if kind == "callback" else None
+    )
+    for core in cores:
+        core.journey = journey
+        core.journey_outcome = outcome
+    return journey
 
 
-def load_users_from_env():
-    """Load users from environment variables"""
-    # Format: MITEL_USER_1=username:password:account_id:role:name
-    users = {}
-    i = 1
-    while True:
-        user_env = os.getenv(f'MITEL_USER_{i}')
-        if not user_env:
-            break
-        
-        parts = user_env.split(':')
-        if len(parts) >= 2:
-            username = parts[0]
-            users[username] = {
-                'password': parts[1],
-                'account_id': parts[2] if len(parts) > 2 else '1',
-                'role': parts[3] if len(parts) > 3 else 'user',
-                'name': parts[4] if len(parts) > 4 else username
-            }
-        i += 1
+def generate_call_cores(count, start_date: Optional[datetime] = None, end_date: Optional[datetime] = None,
+                        rng=random, first_record_id: Optional[int] = None, tenant=None):
+    """
+    Generate `count` call cores outside the timeline, as whole journeys
     
-    return users if users else SIMPLE_USERS
+    Each journey starts at a call drawn like generate_call_core's; its next
+    legs start when the previous one ends (a callback a few minutes to an
+    hour later), with consecutive RecordIds. Journeys stop at the end of
+    the date range (or now).
+    
+    Args:
+        count: Number of cores (journeys that would not fit are shortened)
+        start_date, end_date: Date range of the journeys' first calls
+        rng: Random generator to draw from (default: the shared module RNG)
+        first_record_id: RecordId of the first core (default: next values of
+                         the global counter)
+        tenant: Tenant to generate for (default: the default tenant)
+    
+    Returns:
+        list: CallCore per leg, journey by journey
+    """
+    if tenant is None:
+        tenant = default_tenant
+    cores = []
+    while len(cores) < count:
+        kind, legs = draw_journey_kind(rng, count - len(cores))
+        journey = []
+        call_date = None
+        for _ in range(legs):
+            if journey:
+                previous = journey[-1]
+                if kind == "callback":
+                    call_date += timedelta(seconds=previous.ring_time + rng.randint(120, 3600))
+                elif kind == "ringpoint":
+                    call_date += timedelta(seconds=previous.ring_time)
+                else:
+                    call_date += timedelta(seconds=previous.ring_time + previous.duration)
+                if call_date > (end_date or datetime.now(call_date.tzinfo)):
+                    break
+            record_id = None if first_record_id is None else first_record_id + len(cores) + len(journey)
+            core = generate_call_core(start_date, end_date, rng, record_id, call_date, tenant)
+            call_date = core.call_date
+            journey.append(core)
+        link_journey(journey, kind if len(journey) > 1 else "direct", tenant)
+        cores.extend(journey)
+    return cores
 
 
-def get_users():
-    """Get users based on configured mode"""
-    if USER_MGMT_MODE == 'json':
-        return load_users_from_json()
-    elif USER_MGMT_MODE == 'env':
-        return load_users_from_env()
-    else:  # simple mode
-        return SIMPLE_USERS
+# Per-field random values are sliced from the core "bits" integer:
+# field -> (bit offset, bit width)
+CDR_RANDOM_SLICES = {
+    "Number": (0, 30),
+    "PortPresent": (30, 7),
+    "Port": (37, 30),
+    "Call_cost": (67, 10),
+    "Call_outcome": (78, 8),
+    "LegID": (94, 37),
+    "GroupPosition": (139, 1),
+    "CallExperienceRating": (148, 8),
+    "DeviceId": (156, 8)
+}
+CDR_RANDOM_BITS = 164
+
+
+def random_slice(core, name, modulo):
+    """Uniform-ish value in [0, modulo) from the core's bits reserved for `name`"""
+    offset, width = CDR_RANDOM_SLICES[name]
+    return ((core.bits >> offset) & ((1 << width) - 1)) % modulo
 
 
-def generate_token(username, account_id, expires_in=None):
+def leg_id(core):
+    """LegID of a call leg"""
+    return generate_leg_id(core.extno, core.call_id, core.call_timestamp,
+                           phone=10000000000 + random_slice(core, "LegID", 90000000000))
+
+
+def caller_digits(core):
     """
-    Generate a bearer token for a user
+    Subscriber number of the call's external party
     
-    Args:
-        username: Username
-        account_id: Account ID
-        expires_in: Token expiration in seconds (None = use default)
+    Drawn from CALLER_POPULATION numbers with a quadratic skew, so the most
+    frequent caller makes about 1 call in 140 and most callers call rarely.
+    """
+    offset, width = CDR_RANDOM_SLICES["Number"]
+    draw = random_slice(core, "Number", 1 << width) / (1 << width)
+    rank = int(CALLER_POPULATION * draw * draw)
+    return 100000000 + (rank * 2654435761) % 900000000
+
+
+# CDR fields in output order. Each entry is either a constant value or a
+# builder taking the record's core values; builders only run when their
+# field is requested.
+CDR_FIELDS = {
+    "RecordId": lambda c: c.record_id,
+    "Extno": lambda c: c.extno,
+    "Username": lambda c: c.username,
+    "Call_date": lambda c: c.call_date.strftime("%Y-%m-%dT%H:%M:%S"),
+    "Number": lambda c: generate_phone_number(digits=caller_digits(c)),
+    "Port": lambda c: (
+        generate_phone_number(digits=100000000 + random_slice(c, "Port", 900000000))
+        if random_slice(c, "PortPresent", 10) else ""
+    ),
+    "Ring_time": lambda c: c.ring_time,
+    "Account": "",
+    "Call_cost": lambda c: random_slice(c, "Call_cost", 501) / 100 if c.duration > 0 else 0,
+    "Duration": lambda c: c.duration,
+    "Direction": lambda c: c.direction,
+    "Unanswer": lambda c: "1" if c.duration == 0 else "0",
+    "Transfer": lambda c: "1" if c.call_outcome == CALL_TRANSFERRED else "0",
+    "Vpn": "0",
+    "Call_dist": "1",
+    "Acc_code": "",
+    "Std_code": "0",
+    "Destination": "",
+    "CallId": lambda c: c.call_id,
+    "Group_no": lambda c: c.group_no,
+    "Call_outcome": lambda c: c.call_outcome or (
+        CALL_ANSWERED if c.duration > 0
+        else UNANSWERED_CALL_OUTCOMES[random_slice(c, "Call_outcome", len(UNANSWERED_CALL_OUTCOMES))]
+    ),
+    "Call_legId": lambda c: str(c.leg),
+    "Call_returnstatus": "0",
+    "TenantId": lambda c: c.tenant_id,
+    "LegID": lambda c: leg_id(c),
+    "PreviousLegID": lambda c: leg_id(c.previous) if c.previous else "",
+    "Call_legs": lambda c: str(c.journey.legs),
+    "Return_date": lambda c: (
+        c.journey.callback[1].strftime("%Y-%m-%dT%H:%M:%S") if c.journey.callback and c.leg == 1 else ""
+    ),
+    "Return_record": lambda c: str(c.journey.callback[0]) if c.journey.callback and c.leg == 1 else "",
+    "Return_direction": lambda c: "O" if c.journey.callback and c.leg == 1 else "",
     
-    Returns:
-        tuple: (token, expires_in_seconds)
+    # VoIP Quality Metrics (may be empty)
+    "SourceRoundTripDelay": "",
+    "SourceEndSystemDelay": "",
+    "TargetEndSystemDelay": "",
+    "SourceSymmOneWayDelay": "",
+    "TargetSymmOneWayDelay": "",
+    "SourceInterarrivalJitter": "",
+    "TargetInterarrivalJitter": "",
+    "SourceMOSLQ": "",
+    "TargetMOSLQ": "",
+    "SourceMOSCQ": "",
+    "TargetMOSCQ": "",
+    
+    # Contact Center / Group fields
+    "firstGroupRingpoint": lambda c: c.journey.first_ringpoint,
+    "GroupPosition": lambda c: str(random_slice(c, "GroupPosition", 2)),
+    
+    # Journey Analytics
+    "totalDuration": lambda c: str(c.journey.total_duration),
+    "waitTime": lambda c: str(c.wait_time),
+    "CallBackAgentAssigned": lambda c: c.extno if c.journey.callback and c.leg == 2 else "",
+    "CallBackAssignedDateTime": lambda c: (
+        c.previous.call_date.strftime("%Y-%m-%dT%H:%M:%S") if c.journey.callback and c.leg == 2 else ""
+    ),
+    "ReturnedByAgent": lambda c: "1" if c.journey.callback and c.leg == 2 else "",
+    "HoldDuration": lambda c: str(c.hold_duration),
+    "JourneyWaitTime": lambda c: str(c.journey.wait_time),
+    "JourneyOutcome": lambda c: c.journey_outcome,
+    "ContactPoints": lambda c: str(c.journey.contact_points),
+    "CallExperienceRating": lambda c: (
+        str(random_slice(c, "CallExperienceRating", 6)) if c.duration > 0 else "0"
+    ),
+    "DeviceId": lambda c: DEVICE_IDS[random_slice(c, "DeviceId", len(DEVICE_IDS))]
+}
+
+
+# JSON encoders of record values, by exact type (as the json module encodes them)
+JSON_VALUE_ENCODERS = {
+    str: json.encoder.encode_basestring_ascii,
+    int: int.__repr__,
+    float: float.__repr__
+}
+
+
+def encode_json_value(value):
+    """JSON text of a record value"""
+    encoder = JSON_VALUE_ENCODERS.get(type(value))
+    return encoder(value) if encoder else json.dumps(value)
+
+
+class CompactRecord(Mapping):
     """
-    import hashlib
-    import time
+    A projected Call Detail Record
     
-    # Use provided expiration or default
-    if expires_in is None:
-        expires_in = TOKEN_EXPIRATION_DEFAULT
+    Holds only the values of the projection's builder fields, in a tuple;
+    constant fields and field names live on the projection. Reads like a
+    read-only dict, serializes to JSON from the projection's templates
+    (see dumps_records) and only becomes a real dict through dict(record).
+    """
     
-    # Create a simple token (in production, use JWT)
-    token_data = f"{username}:{account_id}:{time.time()}"
-    token = hashlib.sha256(token_data.encode()).hexdigest()
+    __slots__ = ('projection', 'values')
     
-    # Store token with user info and expiration
-    active_tokens[token] = {
-        'username': username,
-        'account_id': account_id,
-        'created_at': datetime.now(),
-        'expires_at': datetime.now() + timedelta(seconds=expires_in),
-        'expires_in': expires_in
-    }
+    def __init__(self, projection, values):
+        self.projection = projection
+        self.values = values
     
-    return token, expires_in
+    def __getitem__(self, name):
+        is_builder, value = self.projection.lookup[name]
+        return self.values[value] if is_builder else value
+    
+    def __iter__(self):
+        return iter(self.projection.fields)
+    
+    def __len__(self):
+        return len(self.projection.fields)
+    
+    def __contains__(self, name):
+        return name in self.projection.lookup
+    
+    def to_json(self, compact=True):
+        """
+        JSON text of the record, as jsonify (compact: sorted keys, no spaces)
+        or as json.dumps with default arguments (field order, spaces) writes it
+        """
+        template, order = self.projection.template(compact)
+        values = self.values
+        return template % tuple([encode_json_value(values[i]) for i in order])
 
 
-def validate_token(token):
-    """Validate a bearer token"""
-    if token not in active_tokens:
-        return None
+class RecordProjection:
+    """
+    A compiled set of CDR fields
     
-    token_info = active_tokens[token]
+    Splits the requested fields into constants and builders once, so
+    building a record only evaluates the requested builders, in CDR_FIELDS
+    order, into a CompactRecord.
     
-    # Check if token expired
-    if datetime.now() > token_info['expires_at']:
-        del active_tokens[token]
-        return None
+    Args:
+        fields: Field names to include, or None for all fields
+    """
     
-    return token_info
+    def __init__(self, fields=None):
+        if fields is None:
+            names = list(CDR_FIELDS)
+        else:
+            unknown = [name for name in fields if name not in CDR_FIELDS]
+            if unknown:
+                raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+            requested = set(fields)
+            names = [name for name in CDR_FIELDS if name in requested]
+        self.fields = tuple(names)
+        self.steps = tuple((name, CDR_FIELDS[name], callable(CDR_FIELDS[name])) for name in names)
+        self.builders = tuple(value for _, value, is_builder in self.steps if is_builder)
+        # name -> (True, position in the record's values) or (False, constant value)
+        self.lookup = {}
+        position = 0
+        for name, value, is_builder in self.steps:
+            if is_builder:
+                self.lookup[name] = (True, position)
+                position += 1
+            else:
+                self.lookup[name] = (False, value)
+        self._templates = {}
+    
+    def build(self, core):
+        """Build the projected record from core values"""
+        return CompactRecord(self, tuple([builder(core) for builder in self.builders]))
+    
+    def template(self, compact=True):
+        """
+        %-template of a record's JSON text with keys and constants
+        pre-encoded, and the order of the builder values filling it
+        """
+        cached = self._templates.get(compact)
+        if cached is None:
+            names = sorted(self.fields) if compact else self.fields
+            item_separator, key_separator = (',', ':') if compact else (', ', ': ')
+            items = []
+            order = []
+            for name in names:
+                is_builder, value = self.lookup[name]
+                if is_builder:
+                    encoded = '%s'
+                    order.append(value)
+                else:
+                    encoded = encode_json_value(value).replace('%', '%%')
+                key = json.encoder.encode_basestring_ascii(name).replace('%', '%%')
+                items.append(key + key_separator + encoded)
+            cached = self._templates[compact] = ('{' + item_separator.join(items) + '}', tuple(order))
+        return cached
 
 
-def require_auth(f):
+def dumps_records(obj, compact=True, default=None, **kwargs):
+    """
+    json.dumps that writes CompactRecords from their templates
+    
+    Each record is first written as a placeholder string, then the
+    placeholders are swapped, in document order, for the records' JSON text,
+    so records are never turned into dicts. The placeholder is random per
+    call, so strings taken from the request (echoed filters, batch
+    parameters) can never match it.
+    
+    Args:
+        obj: Value to serialize
+        compact: Record style, see CompactRecord.to_json
+        default: Fallback for other types json cannot serialize
+        **kwargs: Other json.dumps arguments
+    """
+    fragments = []
+    placeholder = f"\x00record:{uuid.uuid4().hex}\x00"
+    
+    def encode_record(value):
+        if isinstance(value, CompactRecord):
+            fragments.append(value.to_json(compact))
+            return placeholder
+        if default is not None:
+            return default(value)
+        raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+    
+    text = json.dumps(obj, default=encode_record, **kwargs)
+    if not fragments:
+        return text
+    parts = text.split(json.dumps(placeholder))
+    return parts[0] + ''.join(fragment + part for fragment, part in zip(fragments, parts[1:]))
+
+
+class RecordJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider writing CompactRecords with dumps_records"""
+    
+    def dumps(self, obj, **kwargs):
+        kwargs.setdefault("default", self.default)
+        kwargs.setdefault("ensure_ascii", self.ensure_ascii)
+        kwargs.setdefault("sort_keys", self.sort_keys)
+        return dumps_records(obj, **kwargs)
+
+
+app.json = RecordJSONProvider(app)
+
+
+FULL_PROJECTION = RecordProjection()
+
+
+@lru_cache(maxsize=256)
+def get_projection(fields_param: Optional[str] = None):
+    """
+    Validate and compile a `fields=` parameter (comma-separated field names)
+    Compiled once per distinct parameter value
+    
+    Raises:
+        ValueError: If a field name is unknown or no field is given
+    """
+    if not fields_param:
+        return FULL_PROJECTION
+    fields = [name.strip() for name in fields_param.split(',') if name.strip()]
+    if not fields:
+        raise ValueError("fields must list at least one field name")
+    return RecordProjection(fields)
+
+
+def generate_call_record(start_date: Optional[datetime] = None, end_date: Optional[datetime] = None,
+                         projection: Optional[RecordProjection] = None):
+    """
+    Generate a single Call Detail Record matching Mitel MiContact Center format
+    
+    Args:
+        start_date: Start of date range for call_date
+        end_date: End of date range for call_date
+        projection: Fields to generate (default: all fields)
+    """
+    core = generate_call_cores(1, start_date, end_date)[0]
+    return (projection or FULL_PROJECTION).build(core)
+
+
+def wrap_in_kafka_format(record, record_id=None, rng=random, offset=None, timestamp=None):
+    """
+    Wrap CDR record in Kafka message format (as seen in your CSV)
+    
+    Args:
+        record: CDR record (possibly projected)
+        record_id: Message key, for records projected without RecordId
+        rng: Random generator for the offset
+        offset: Message offset (default: random)
+        timestamp: Message timestamp in milliseconds (default: now)
+    """
+    if timestamp is None:
+        timestamp = int(datetime.now().timestamp() * 1000)
+    if record_id is None:
+        record_id = record["RecordId"]
+    if offset is None:
+        offset = rng.randint(25393000, 25395000)
+    
+    return {
+        "timestamp": timestamp,
+        "timestampType": "CREATE_TIME",
+        "partition": 0,
+        "offset": offset,
+        "key": {"key": str(record_id)},
+        "value": record,
+        "headers": [],
+        "exceededFields": ""
+    }
+
+
+# Header line of Kafka-style CSV exports
+KAFKA_CSV_HEADER = "timestamp,timestampType,partition,offset,key,value,headers,exceededFields"
+
+
+def kafka_csv_line(message):
+    """Format a Kafka message as a CSV line (matching your source file)"""
+    return (
+        f"{message['timestamp']},"
+        f"{message['timestampType']},"
+        f"{message['partition']},"
+        f"{message['offset']},"
+        f'"{json.dumps(message["key"])}",'
+        f'"{dumps_records(message["value"], compact=False)}",'
+        f"[],"
+    )
+
+
+# ==================== TRAFFIC MODEL ====================
+
+class TrafficModel:
+    """
+    Arrival process of the call timeline
+    
+    Calls arrive as a Poisson process. Its rate follows the profile's hour of
+    day and day of week, scaled in each burst period by a gamma-distributed
+    load factor (mean 1), so busy periods cluster the way real queues do.
+    The timeline realizes it by thinning: time is cut into `capacity` times
+    more slots than the average call volume, and each slot holds a call with
+    probability rate / capacity (capped at 1, like a full trunk). The flat
+    model (no profile) has a capacity of 1 and fills every slot.
+    
+    Args:
+        profile: Traffic profile (see DEFAULT_TRAFFIC_PROFILE), None for flat
+        seed: Dataset seed the burst factors are drawn from
+        extensions: Extension pool the profile's extension shares apply to
+        calls_per_hour: Average call volume
+    """
+    
+    def __init__(self, profile=None, seed=DATASET_SEED, extensions=EXTENSIONS,
+                 calls_per_hour=DATASET_CALLS_PER_HOUR):
+        self.profile = profile
+        self.seed = seed
+        self.shaped = profile is not None
+        self.extension_weights = None
+        if not self.shaped:
+            self.capacity = 1
+            self.signature = 'flat'
+            self._slots(calls_per_hour)
+            return
+        
+        hourly = [float(rate) for rate in profile["hourly"]]
+        weekday = [float(rate) for rate in profile["weekday"]]
+        if len(hourly) != 24 or len(weekday) != 7 or min(hourly + weekday) < 0:
+            raise ValueError("Traffic profile needs 24 hourly and 7 weekday rates >= 0")
+        scale = (sum(hourly) / 24) * (sum(weekday) / 7)
+        # Relative rate (weekly average 1) by [day of week][hour of day]
+        self.rates = [[day * hour / scale for hour in hourly] for day in weekday]
+        
+        burstiness = float(profile.get("burstiness", 0))
+        self.burst_shape = 1 / burstiness ** 2 if burstiness > 0 else None
+        self.burst_seconds = max(1, int(float(profile.get("burstMinutes", 5)) * 60))
+        # Room for bursts up to 3 standard deviations above the peak hour
+        self.capacity = math.ceil(max(map(max, self.rates)) * (1 + 3 * burstiness))
+        
+        weights = profile.get("extensions", {})
+        self.extension_weights = list(itertools.accumulate(
+            float(weights.get(extension, 1)) for extension in extensions
+        ))
+        self.signature = hashlib.sha256(
+            json.dumps(profile, sort_keys=True).encode()
+        ).hexdigest()[:12]
+        self._bursts = {}
+        self._slots(calls_per_hour)
+    
+    def _slots(self, calls_per_hour):
+        # Slots per hour: one per call on average, times the capacity
+        self.slots_per_hour = calls_per_hour * self.capacity
+        self.slot_seconds = 3600.0 / self.slots_per_hour
+    
+    @classmethod
+    def load(cls, name, profile=None, profile_file=None, **settings):
+        """
+        Traffic model by name ('flat' or 'contact-center'), shaped by
+        `profile`, else by the JSON profile file, else by DEFAULT_TRAFFIC_PROFILE
+        
+        Args:
+            settings: seed, extensions and calls_per_hour (see TrafficModel)
+        """
+        if name == 'flat':
+            return cls(**settings)
+        if name != 'contact-center':
+            raise ValueError(f"Unknown traffic model '{name}' (use flat or contact-center)")
+        if profile is None and profile_file:
+            with open(profile_file, 'r') as f:
+                profile = json.load(f)
+        return cls(profile or DEFAULT_TRAFFIC_PROFILE, **settings)
+    
+    def burst(self, seconds):
+        """Load factor of the burst period containing a timeline second"""
+        if self.burst_shape is None:
+            return 1.0
+        period = int(seconds // self.burst_seconds)
+        factor = self._bursts.get(period)
+        if factor is None:
+            if len(self._bursts) >= 65536:
+                self._bursts.clear()
+            rng = random.Random((self.seed << 48) ^ period ^ 0x5EED)
+            factor = self._bursts[period] = rng.gammavariate(self.burst_shape, 1 / self.burst_shape)
+        return factor
+    
+    def rate(self, seconds):
+        """Expected calls per hour, relative to the average, at a timeline second"""
+        if not self.shaped:
+            return 1.0
+        hour = int(seconds // 3600)
+        day = (hour // 24 + DATASET_EPOCH.weekday()) % 7
+        return self.rates[day][hour % 24] * self.burst(seconds)
+    
+    def has_call(self, slot):
+        """Whether a timeline slot holds a call (always, for the flat model)"""
+        if not self.shaped:
+            return True
+        occupancy = self.rate(slot * self.slot_seconds) / self.capacity
+        return mix64((self.seed << 48) ^ slot) < occupancy * 2.0 ** 64
+    
+    def draw_time(self, start, end, rng=random):
+        """Random arrival time within [start, end], weighted by the rate"""
+        span = max((end - start).total_seconds(), 0.0)
+        first = (start - DATASET_EPOCH).total_seconds()
+        offset = 0.0
+        # Rejection sampling against the slot capacity
+        for _ in range(64):
+            offset = rng.uniform(0, span)
+            if rng.random() * self.capacity < self.rate(first + offset):
+                break
+        return start + timedelta(seconds=offset)
+
+
+class SimulatedClock:
+    """
+    A clock running `speed` times faster than real time from `start`
+    
+    Used to replay the timeline in accelerated time: an hour of traffic
+    takes 3600 / speed seconds.
+    """
+    
+    def __init__(self, start, speed=1.0):
+        self.start = start
+        self.speed = speed
+        self.origin = time.monotonic()
+    
+    def at(self, monotonic):
+        """Simulated time at a time.monotonic() value"""
+        return self.start + timedelta(seconds=(monotonic - self.origin) * self.speed)
+    
+    def now(self):
+        return self.at(time.monotonic())
+    
+    def sleep_until(self, moment):
+        """Sleep until the simulated clock reaches `moment`"""
+        delay = (moment - self.now()).total_seconds() / self.speed
+        if delay > 0:
+            time.sleep(delay)
+
+
+# ==================== TENANTS ====================
+
+class Tenant:
+    """
+    One account's partition of the mock
+    
+    Each tenant serves its own call timeline (seed, extension pool, volume
+    and traffic shape) and keeps its own timeline caches, agent state engine,
+    rate limit buckets and request metrics, so a large tenant's working set
+    never evicts or slows down the others.
+    
+    Args:
+        key: Account id the tenant is configured for ("*" for the default tenant)
+        settings: Tenant settings (see DEFAULT_TENANTS)
+    """
+    
+    def __init__(self, key, settings):
+        self.key = key
+        self.settings = settings
+        self.tenant_id = str(settings.get("tenantId", "1"))
+        self.seed = int(settings.get("seed", DATASET_SEED))
+        self.extensions = [str(extension) for extension in settings.get("extensions", EXTENSIONS)]
+        self.extension_index = {extension: index for index, extension in enumerate(self.extensions)}
+        self.calls_per_hour = int(settings.get("callsPerHour", DATASET_CALLS_PER_HOUR))
+        if not self.extensions or self.calls_per_hour <= 0:
+            raise ValueError(f"Tenant '{key}' needs extensions and a positive callsPerHour")
+        self.traffic = TrafficModel.load(
+            settings.get("trafficModel", TRAFFIC_MODEL), settings.get("trafficProfile"),
+            TRAFFIC_PROFILE_FILE, seed=self.seed, extensions=self.extensions,
+            calls_per_hour=self.calls_per_hour
+        )
+        self.slots_per_hour = self.traffic.slots_per_hour
+        self.slot_seconds = self.traffic.slot_seconds
+        self.cache_hours = int(settings.get("cacheHours", TIMELINE_CACHE_HOURS))
+        self.rate_limits = settings.get("rateLimits")
+        # Per-tenant lru caches by function name (see tenant_cache)
+        self.caches = {}
+        # Blocks built in the process pool, until completed_timeline_block caches them
+        self.prebuilt_blocks = {}
+        self._agents = None
+        self._buckets = None
+        self._lock = threading.Lock()
+    
+    @property
+    def agents(self):
+        """The tenant's agent state engine, created on first use"""
+        if self._agents is None:
+            with self._lock:
+                if self._agents is None:
+                    self._agents = AgentStateEngine(self)
+        return self._agents
+    
+    @property
+    def rate_limit_buckets(self):
+        """
+        The tenant's token bucket table, created on first use
+        
+        The default tenant uses RATE_LIMIT_STATE_FILE; other tenants use a
+        file of their own next to it, so their clients never evict each
+        other's buckets.
+        """
+        if self._buckets is None:
+            with self._lock:
+                if self._buckets is None:
+                    path = RATE_LIMIT_STATE_FILE
+                    if self.key != "*":
+                        path += '.' + hashlib.blake2b(self.key.encode(), digest_size=6).hexdigest()
+                    self._buckets = SharedTokenBuckets(path, RATE_LIMIT_SLOTS)
+        return self._buckets
+    
+    def record_request(self, status, latency_ms, records=None):
+        """Count a served request in the tenant's metrics (shared by all workers)"""
+        tenant_metrics.add(self.key, requests=1, latencyMs=latency_ms,
+                           errors=1 if status >= 400 else 0, records=records or 0)
+    
+    def summary(self):
+        """
+        Settings, metrics and cache statistics, as listed by /admin/tenants
+        Metrics cover all workers; cache statistics are this worker's
+        """
+        since, totals = tenant_metrics.read(self.key)
+        latency = totals.pop("latencyMs")
+        metrics = {name: int(value) for name, value in totals.items()}
+        metrics["avgLatencyMs"] = round(latency / metrics["requests"], 2) if metrics["requests"] else None
+        metrics["since"] = datetime.fromtimestamp(since).isoformat() if since else None
+        caches = {}
+        for name, cache in sorted(self.caches.items()):
+            info = cache.cache_info()
+            caches[name] = {"hits": info.hits, "misses": info.misses,
+                            "size": info.currsize, "maxSize": info.maxsize}
+        return {
+            "account": self.key,
+            "tenantId": self.tenant_id,
+            "seed": self.seed,
+            "callsPerHour": self.calls_per_hour,
+            "trafficModel": 'contact-center' if self.traffic.shaped else 'flat',
+            "extensions": self.extensions,
+            "metrics": metrics,
+            "caches": caches
+        }
+
+
+def tenant_cache(maxsize):
+    """
+    lru_cache with one cache per tenant (the function's first argument), so
+    one tenant's working set never evicts another's
+    
+    Args:
+        maxsize: Cache size, or a function of the tenant returning it
+    """
+    def decorator(function):
+        name = function.__name__
+        
+        @wraps(function)
+        def cached(tenant, *args):
+            cache = tenant.caches.get(name)
+            if cache is None:
+                size = maxsize(tenant) if callable(maxsize) else maxsize
+                cache = tenant.caches.setdefault(name, lru_cache(maxsize=size)(partial(function, tenant)))
+            return cache(*args)
+        return cached
+    return decorator
+
+
+def load_tenants():
+    """
+    Load tenants from TENANTS_FILE, or use the defaults
+    
+    Returns:
+        dict: {account id: Tenant}, always including the "*" default tenant
+    """
+    settings = DEFAULT_TENANTS
+    if TENANTS_FILE:
+        with open(TENANTS_FILE, 'r') as f:
+            settings = json.load(f)
+    settings = {"*": {}, **settings}
+    return {str(key): Tenant(str(key), value) for key, value in settings.items()}
+
+
+tenants = load_tenants()
+default_tenant = tenants["*"]
+
+# Extensions and TenantIds of all tenants, default tenant first (timeline
+# blocks store them as one-byte codes)
+TENANT_EXTENSIONS = list(dict.fromkeys(
+    extension for tenant in tenants.values() for extension in tenant.extensions
+))
+TENANT_IDS = list(dict.fromkeys(tenant.tenant_id for tenant in tenants.values()))
+if len(TENANT_EXTENSIONS) > 256 or len(TENANT_IDS) > 256:
+    raise ValueError("Tenants may use at most 256 distinct extensions and TenantIds")
+
+
+def tenant_for_account(account_id):
+    """Tenant of an account id, falling back to the default tenant"""
+    return tenants.get(str(account_id), default_tenant)
+
+
+def current_tenant():
+    """
+    Tenant of the current request, from its bearer token's account_id
+    
+    Anonymous requests (and code running outside a request) get the
+    default tenant. Resolved once per request.
+    """
+    if not has_request_context():
+        return default_tenant
+    tenant = getattr(request, 'tenant', None)
+    if tenant is None:
+        token_info = getattr(request, 'user_info', None) or get_bearer_token_info()
+        tenant = tenant_for_account(token_info['account_id']) if token_info else default_tenant
+        request.tenant = tenant
+    return tenant
+
+
+# ==================== DATASET ====================
+
+# Start of the call timeline; slot 0 begins here
+DATASET_EPOCH = datetime(2020, 1, 1)
+DATASET_RECORD_ID_BASE = 78340000
+
+# Journey layouts (one per timeline hour, see journey_layout) and linked
+# journeys each worker keeps generated per tenant
+JOURNEY_FRAME_CACHE_SIZE = 32
+JOURNEY_CACHE_SIZE = 4096
+# CallId number of the journey starting in slot 0
+JOURNEY_CALL_ID_BASE = 2010000
+# Set in journey RNG seeds, so they never equal a layout's (slots stay below it)
+JOURNEY_SEED_BIT = 1 << 47
+
+
+def dataset_time(dt):
+    """Normalize a datetime for timeline arithmetic (naive, UTC if aware)"""
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def dataset_slot(tenant, dt):
+    """Slot of a tenant's timeline containing a datetime"""
+    return math.floor((dataset_time(dt) - DATASET_EPOCH).total_seconds() / tenant.slot_seconds)
+
+
+def dataset_slot_time(tenant, slot):
+    """Start time of a slot of a tenant's timeline"""
+    return DATASET_EPOCH + timedelta(seconds=slot * tenant.slot_seconds)
+
+
+def dataset_core(tenant, slot):
+    """
+    Core values of the call in a slot of a tenant's timeline, or None if the
+    traffic model leaves the slot empty
+    
+    Generated with the rest of its journey (see dataset_journey_cores), so
+    any slot can be generated directly, without generating more than its
+    hour's journey layout and its own journey. The call's RecordId is
+    derived from the slot, so RecordIds increase with Call_date.
+    """
+    if not tenant.traffic.has_call(slot):
+        return None
+    heads, _ = journey_layout(tenant, slot // tenant.slots_per_hour)
+    record_id = DATASET_RECORD_ID_BASE + slot
+    for core in dataset_journey_cores(tenant, heads[slot % tenant.slots_per_hour]):
+        if core.record_id == record_id:
+            return core
+
+
+@tenant_cache(maxsize=JOURNEY_FRAME_CACHE_SIZE)
+def journey_layout(tenant, frame):
+    """
+    Journeys of the calls in a journey frame of a tenant's timeline (one
+    timeline hour): which calls are legs of which journey, and when
+    
+    Drawn from the frame's own RNG seeded with (tenant seed, first slot),
+    without generating the calls themselves. Every call not yet taken
+    starts a journey: transfer and ringpoint legs are the next calls, while
+    a callback is returned by the first call 2 to 60 minutes later (within
+    the hour; if none is left, the abandoned call stays a direct one).
+    Journeys never span frames, so a frame holds whole journeys; a
+    journey's CallId is its first slot (see journey_call_slot).
+    
+    Returns:
+        tuple: (first slot of the journey per slot of the frame, None for
+                empty slots; {first slot: (kind, ((slot, call date) per
+                leg))})
+    """
+    slots_per_hour = tenant.slots_per_hour
+    first_slot = frame * slots_per_hour
+    frame_end = dataset_slot_time(tenant, first_slot + slots_per_hour)
+    rng = random.Random((tenant.seed << 48) ^ first_slot)
+    slots = []
+    dates = []
+    for slot in range(first_slot, first_slot + slots_per_hour):
+        if tenant.traffic.has_call(slot):
+            call_date = DATASET_EPOCH + timedelta(seconds=(slot + rng.random()) * tenant.slot_seconds)
+            slots.append(slot)
+            dates.append(call_date.replace(microsecond=0))
+    
+    heads = [None] * slots_per_hour
+    journeys = {}
+    taken = [False] * len(slots)
+    free = len(slots)
+    for index, slot in enumerate(slots):
+        if taken[index]:
+            continue
+        kind, legs = draw_journey_kind(rng, free)
+        if kind == "callback":
+            # Returned by the first call not in a journey yet, minutes later
+            remaining = int((frame_end - dates[index]).total_seconds())
+            returned = None
+            if remaining >= 120:
+                later = bisect_left(dates, dates[index] + timedelta(seconds=rng.randint(120, min(3600, remaining))))
+                returned = next((i for i in range(later, len(slots)) if not taken[i]), None)
+            members = [index] if returned is None else [index, returned]
+            if returned is None:
+                kind = "direct"
+        else:
+            members = list(itertools.islice((i for i in range(index, len(slots)) if not taken[i]), legs))
+        for member in members:
+            taken[member] = True
+            heads[slots[member] - first_slot] = slot
+        free -= len(members)
+        journeys[slot] = (kind, tuple((slots[member], dates[member]) for member in members))
+    return tuple(heads), journeys
+
+
+@tenant_cache(maxsize=JOURNEY_CACHE_SIZE)
+def dataset_journey_cores(tenant, slot):
+    """
+    Leg cores of the timeline journey starting in a slot, in call order
+    
+    Generated from the journey's own RNG seeded with (tenant seed, first
+    slot), at the legs' slots and call dates of its journey layout, and
+    linked. Cached, so scanning a journey's legs generates it once.
+    
+    Returns:
+        tuple: Leg cores
+    """
+    kind, legs = journey_layout(tenant, slot // tenant.slots_per_hour)[1][slot]
+    rng = random.Random((tenant.seed << 48) ^ slot ^ JOURNEY_SEED_BIT)
+    cores = [generate_call_core(rng=rng, record_id=DATASET_RECORD_ID_BASE + leg_slot,
+                                call_date=call_date, tenant=tenant)
+             for leg_slot, call_date in legs]
+    link_journey(cores, kind, tenant, f"{cores[0].call_id[0]}{JOURNEY_CALL_ID_BASE + slot}")
+    return tuple(cores)
+
+
+def journey_call_slot(tenant, call_id):
+    """
+    Timeline slot of the first leg of a journey with a CallId, or None if
+    no journey that has started can have it
+    """
+    digits = call_id[1:]
+    if not digits.isdigit() or not 0 <= int(digits) - JOURNEY_CALL_ID_BASE <= dataset_slot(tenant, datetime.now()):
+        return None
+    return int(digits) - JOURNEY_CALL_ID_BASE
+
+
+def dataset_journey(tenant, call_id):
+    """
+    Leg cores of the timeline journey with a CallId, in call order
+    
+    The CallId gives the journey's first slot, so this is one journey
+    lookup.
+    
+    Returns:
+        list: Leg cores, or None if no journey has this CallId
+    """
+    slot = journey_call_slot(tenant, call_id)
+    if slot is None:
+        return None
+    head = dataset_core(tenant, slot)
+    if head is None or head.leg != 1 or head.call_id != call_id:
+        return None
+    return list(dataset_journey_cores(tenant, slot))
+
+
+def dataset_window(start_date, end_date):
+    """
+    Resolve a query's date range on the timeline, with the same defaults as
+    the random generator: last hour, start to now, or 30 days before end
+    
+    Returns:
+        tuple: (start, end) as naive datetimes
+    """
+    now = datetime.now()
+    if start_date and end_date:
+        return dataset_time(start_date), dataset_time(end_date)
+    if start_date:
+        return dataset_time(start_date), now
+    if end_date:
+        end = dataset_time(end_date)
+        return end - timedelta(days=30), end
+    return now - timedelta(hours=1), now
+
+
+def encode_cursor(state):
+    """Serialize and sign a pagination cursor (opaque to clients)"""
+    payload = base64.urlsafe_b64encode(
+        json.dumps(state, separators=(',', ':'), sort_keys=True).encode()
+    ).rstrip(b'=')
+    signature = base64.urlsafe_b64encode(
+        hmac.new(SECRET_KEY.encode(), payload, hashlib.sha256).digest()[:16]
+    ).rstrip(b'=')
+    return (payload + b'.' + signature).decode()
+
+
+def decode_cursor(cursor):
+    """
+    Verify and deserialize a pagination cursor
+    
+    Raises:
+        ValueError: If the cursor is malformed or its signature is invalid
+    """
+    try:
+        payload, signature = cursor.encode().split(b'.')
+        expected = base64.urlsafe_b64encode(
+            hmac.new(SECRET_KEY.encode(), payload, hashlib.sha256).digest()[:16]
+        ).rstrip(b'=')
+        if not hmac.compare_digest(signature, expected):
+            raise ValueError("signature mismatch")
+        return json.loads(base64.urlsafe_b64decode(payload + b'=' * (-len(payload) % 4)))
+    except (ValueError, TypeError, UnicodeError):
+        raise ValueError("Invalid or tampered cursor")
+
+
+# ==================== ROLLUPS ====================
+
+# Fields /reporting/calls/aggregate can group by, with all their values
+# (columns are stored as small codes into these lists)
+AGGREGATE_DIMENSIONS = {
+    "Extno": TENANT_EXTENSIONS,
+    "Username": USERNAMES,
+    "Direction": CALL_DIRECTIONS,
+    "Group_no": GROUP_NUMBERS,
+    "Call_outcome": CALL_OUTCOMES,
+    "JourneyOutcome": JOURNEY_OUTCOMES,
+    "DeviceId": DEVICE_IDS,
+    "CallExperienceRating": ["0", "1", "2", "3", "4", "5"],
+    "Transfer": ["0", "1"],
+    "Unanswer": ["0", "1"],
+    "Call_legs": ["1", "2", "3", "4", "5"],
+    "Call_legId": ["1", "2", "3", "4", "5"],
+    "GroupPosition": ["0", "1"],
+    "ContactPoints": ["0", "1", "2", "3", "4", "5"],
+    "TenantId": TENANT_IDS
+}
+
+# Numeric fields metrics can be computed over: field -> array typecode
+AGGREGATE_METRIC_FIELDS = {
+    "Duration": 'i',
+    "Ring_time": 'i',
+    "waitTime": 'i',
+    "HoldDuration": 'i',
+    "JourneyWaitTime": 'i',
+    "totalDuration": 'i',
+    "Call_cost": 'd'
+}
+
+AGGREGATE_FUNCTIONS = ("count", "sum", "avg", "min", "max")
+
+# Time buckets for groupBy. All are whole hours or coarser, so a bucket is
+# constant within an hourly block and rollups never need to be re-split.
+TIME_BUCKETS = {
+    "hour": lambda hour: hour.strftime("%Y-%m-%dT%H:00:00"),
+    "day": lambda hour: hour.strftime("%Y-%m-%d"),
+    "week": lambda hour: (hour - timedelta(days=hour.weekday())).strftime("%Y-%m-%d"),
+    "month": lambda hour: hour.strftime("%Y-%m"),
+    "hourOfDay": lambda hour: hour.hour,
+    "dayOfWeek": lambda hour: hour.isoweekday()
+}
+
+DIMENSION_CODES = {
+    name: {value: code for code, value in enumerate(values)}
+    for name, values in AGGREGATE_DIMENSIONS.items()
+}
+
+
+def field_values(name, cores):
+    """Values of a CDR field for each of a list of cores"""
+    value = CDR_FIELDS[name]
+    return map(value, cores) if callable(value) else [value] * len(cores)
+
+
+class TimelineBlock:
+    """
+    One hour of the call timeline as compact columns
+    
+    Holds the slot, the call time (seconds since DATASET_EPOCH), the Number
+    subscriber digits and the CallId and LegID search keys of each call, a
+    code per call for every groupable field and the value of every numeric
+    field, in arrays, so an hour costs about 30 KB at 360 calls per hour
+    instead of hundreds of record dicts. Columns are built straight from the
+    CDR_FIELDS builders, without projecting records first.
+    
+    Args:
+        tenant: Tenant whose timeline the block is cut from
+        hour: Hour index since DATASET_EPOCH
+    """
+    
+    __slots__ = ('hour', 'start', 'size', 'slots', 'times', 'numbers', 'call_ids', 'leg_ids', 'columns')
+    
+    def __init__(self, tenant, hour):
+        self.hour = hour
+        self.start = DATASET_EPOCH + timedelta(hours=hour)
+        first_slot = hour * tenant.slots_per_hour
+        slots = [slot for slot in range(first_slot, first_slot + tenant.slots_per_hour)
+                 if tenant.traffic.has_call(slot)]
+        cores = [dataset_core(tenant, slot) for slot in slots]
+        self.size = len(cores)
+        self.slots = array('I', slots)
+        self.times = array('I', (int((core.call_date - DATASET_EPOCH).total_seconds()) for core in cores))
+        self.numbers = array('I', map(caller_digits, cores))
+        self.call_ids = array('Q', (search_key(core.call_id) for core in cores))
+        self.leg_ids = array('Q', (search_key(leg_id(core)) for core in cores))
+        self.columns = {}
+        for name, codes in DIMENSION_CODES.items():
+            self.columns[name] = array('B', map(codes.__getitem__, field_values(name, cores)))
+        for name, typecode in AGGREGATE_METRIC_FIELDS.items():
+            convert = float if typecode == 'd' else int
+            self.columns[name] = array(typecode, map(convert, field_values(name, cores)))
+
+
+class BlockNotCached(Exception):
+    """Raised by completed_timeline_block for an uncached hour while probing"""
+
+
+# Set on a thread while it probes the block cache (see uncached_block_hours)
+_block_probe = threading.local()
+
+
+@tenant_cache(maxsize=lambda tenant: tenant.cache_hours)
+def completed_timeline_block(tenant, hour):
+    """
+    Block of an hour that is over (immutable, so cached per tenant)
+    Takes over the block prefetch_timeline_blocks built for the hour, if any
+    """
+    block = tenant.prebuilt_blocks.pop(hour, None)
+    if block is not None:
+        return block
+    if getattr(_block_probe, 'active', False):
+        raise BlockNotCached(hour)
+    return TimelineBlock(tenant, hour)
+
+
+def uncached_block_hours(tenant, hours):
+    """Hours whose completed block is not cached, without building any"""
+    missing = []
+    _block_probe.active = True
+    try:
+        for hour in hours:
+            try:
+                completed_timeline_block(tenant, hour)
+            except BlockNotCached:
+                missing.append(hour)
+    finally:
+        _block_probe.active = False
+    return missing
+
+
+def build_timeline_blocks(task):
+    """Build the blocks of some completed hours (process pool entry point)"""
+    tenant = tenants[task['tenant']]
+    return [TimelineBlock(tenant, hour) for hour in task['hours']]
+
+
+def prefetch_timeline_blocks(tenant, first_hour, last_hour):
+    """
+    Build the uncached completed blocks of a long window in the process pool
+    
+    Blocks are built in ranges of about PARALLEL_CHUNK_SIZE calls and put in
+    the block cache before the window is folded, so a cold 92-day window
+    is built by all pool processes instead of one request thread. Windows
+    with fewer than PARALLEL_MIN_RECORDS uncached calls, or more hours than
+    the cache keeps, are left to be built inline.
+    """
+    current_hour = int((datetime.now() - DATASET_EPOCH).total_seconds()) // 3600
+    hours = range(max(0, first_hour), min(last_hour + 1, current_hour))
+    if (PARALLEL_WORKERS <= 1 or len(hours) > tenant.cache_hours
+            or len(hours) * tenant.slots_per_hour < PARALLEL_MIN_RECORDS):
+        return
+    missing = uncached_block_hours(tenant, hours)
+    if len(missing) * tenant.slots_per_hour < PARALLEL_MIN_RECORDS:
+        return
+    step = max(1, PARALLEL_CHUNK_SIZE // tenant.slots_per_hour)
+    pool = get_generation_pool()
+    futures = [pool.submit(build_timeline_blocks, {"tenant": tenant.key, "hours": missing[i:i + step]})
+               for i in range(0, len(missing), step)]
+    for future in futures:
+        for block in future.result():
+            tenant.prebuilt_blocks[block.hour] = block
+            completed_timeline_block(tenant, block.hour)
+            # Already cached by a concurrent request: drop the spare
+            tenant.prebuilt_blocks.pop(block.hour, None)
+
+
+def timeline_block(tenant, hour):
+    """Column block of a timeline hour; the current hour is rebuilt each time"""
+    if DATASET_EPOCH + timedelta(hours=hour + 1) <= datetime.now():
+        return completed_timeline_block(tenant, hour)
+    return TimelineBlock(tenant, hour)
+
+
+def fold_block(block, dims, metric_fields, filters, bounds=None, groups=None):
+    """
+    Fold a block's calls into per-group accumulators in one pass
+    
+    Args:
+        block: TimelineBlock
+        dims: Grouping fields (tuple)
+        metric_fields: Numeric fields to accumulate (tuple)
+        filters: ((field, code), ...) calls must match
+        bounds: Optional (first, last) call time in seconds, inclusive
+        groups: Dict to fold into (default: a new one)
+    
+    Returns:
+        dict: {tuple of dimension codes: [count, sums..., mins..., maxs...]}
+    """
+    if groups is None:
+        groups = {}
+    rows = range(block.size)
+    if bounds is not None:
+        low, high = bounds
+        rows = [i for i, time_ in enumerate(block.times) if low <= time_ <= high]
+    for name, code in filters:
+        column = block.columns[name]
+        rows = [i for i in rows if column[i] == code]
+    
+    # Group the matching positions by key, then reduce each metric column
+    # of a group with the builtins instead of call by call
+    if dims:
+        keys = zip(*[list(map(block.columns[name].__getitem__, rows)) for name in dims])
+        positions = {}
+        for key, i in zip(keys, rows):
+            group = positions.get(key)
+            if group is None:
+                positions[key] = [i]
+            else:
+                group.append(i)
+    else:
+        positions = {(): rows} if len(rows) else {}
+    
+    metric_columns = [block.columns[name] for name in metric_fields]
+    width = len(metric_fields)
+    for key, group in positions.items():
+        values = [list(map(column.__getitem__, group)) for column in metric_columns]
+        acc = groups.get(key)
+        if acc is None:
+            groups[key] = ([len(group)] + [sum(column) for column in values]
+                           + [min(column) for column in values] + [max(column) for column in values])
+            continue
+        acc[0] += len(group)
+        for j, column in enumerate(values):
+            acc[1 + j] += sum(column)
+            acc[1 + width + j] = min(acc[1 + width + j], min(column))
+            acc[1 + 2 * width + j] = max(acc[1 + 2 * width + j], max(column))
+    return groups
+
+
+@tenant_cache(maxsize=ROLLUP_CACHE_SIZE)
+def hour_rollup(tenant, hour, dims, metric_fields, filters):
+    """
+    Partial aggregates of a whole completed hour (cached per tenant and query shape)
+    Treat the result as read-only: it is shared between requests
+    """
+    return fold_block(completed_timeline_block(tenant, hour), dims, metric_fields, filters)
+
+
+def merge_rollup(groups, partial, width, prefix=()):
+    """Merge partial aggregates into groups, prefixing their keys"""
+    for key, acc in partial.items():
+        key = prefix + key
+        total = groups.get(key)
+        if total is None:
+            groups[key] = list(acc)
+            continue
+        total[0] += acc[0]
+        for j in range(width):
+            total[1 + j] += acc[1 + j]
+            total[1 + width + j] = min(total[1 + width + j], acc[1 + width + j])
+            total[1 + 2 * width + j] = max(total[1 + 2 * width + j], acc[1 + 2 * width + j])
+
+
+# ==================== QUANTILE SKETCHES ====================
+
+# Numeric fields /reporting/statistics reports percentiles of
+SKETCH_FIELDS = ("Duration", "waitTime", "Ring_time", "HoldDuration")
+
+
+class TDigest:
+    """
+    Mergeable quantile sketch (merging t-digest)
+    
+    Values are summarized as weighted centroids, small near the tails and
+    large around the median, so the digest stays within a few times
+    `compression` centroids however many values it summarizes, and tail
+    quantiles stay accurate. Digests of disjoint sets of values merge into
+    a digest of their union.
+    
+    Args:
+        compression: Accuracy/size trade-off (default: TDIGEST_COMPRESSION)
+    """
+    
+    __slots__ = ('compression', 'means', 'weights', 'total', 'min', 'max')
+    
+    def __init__(self, compression=None):
+        self.compression = compression or TDIGEST_COMPRESSION
+        self.means = array('d')
+        self.weights = array('d')
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+    
+    @classmethod
+    def of(cls, values, compression=None):
+        """Digest of a sequence of numbers"""
+        digest = cls(compression)
+        digest._compress(sorted((float(value), 1.0) for value in values))
+        return digest
+    
+    @classmethod
+    def merged(cls, digests, compression=None):
+        """Digest of the union of the values summarized by `digests`"""
+        digest = cls(compression)
+        centroids = []
+        for other in digests:
+            centroids.extend(zip(other.means, other.weights))
+            digest.min = min(digest.min, other.min)
+            digest.max = max(digest.max, other.max)
+        centroids.sort()
+        digest._compress(centroids)
+        return digest
+    
+    def _compress(self, centroids):
+        """Merge sorted (mean, weight) pairs into centroids within the k1 size bound"""
+        if not centroids:
+            return
+        self.total = total = sum(weight for _, weight in centroids)
+        self.min = min(self.min, centroids[0][0])
+        self.max = max(self.max, centroids[-1][0])
+        scale = self.compression / (2 * math.pi)
+        
+        def k(cumulative):
+            return scale * math.asin(min(1.0, 2 * cumulative / total - 1))
+        
+        cumulative = 0.0
+        k_limit = k(0.0) + 1
+        mean, weight = centroids[0]
+        for next_mean, next_weight in centroids[1:]:
+            if k(cumulative + weight + next_weight) <= k_limit:
+                weight += next_weight
+                mean += (next_mean - mean) * next_weight / weight
+                continue
+            self.means.append(mean)
+            self.weights.append(weight)
+            cumulative += weight
+            k_limit = k(cumulative) + 1
+            mean, weight = next_mean, next_weight
+        self.means.append(mean)
+        self.weights.append(weight)
+    
+    @property
+    def mean(self):
+        """Mean of the summarized values (None when empty)"""
+        if not self.total:
+            return None
+        return sum(mean * weight for mean, weight in zip(self.means, self.weights)) / self.total
+    
+    def quantile(self, q):
+        """
+        Estimate the q-quantile (0 <= q <= 1), interpolating between
+        centroid centers (None when empty)
+        """
+        if not self.total:
+            return None
+        target = q * self.total
+        cumulative = 0.0
+        previous_mean, previous_center = self.min, 0.0
+        for mean, weight in zip(self.means, self.weights):
+            center = cumulative + weight / 2
+            if target < center:
+                if center == previous_center:
+                    return mean
+                return previous_mean + (mean - previous_mean) * (target - previous_center) / (center - previous_center)
+            previous_mean, previous_center = mean, center
+            cumulative += weight
+        if cumulative == previous_center:
+            return self.max
+        return previous_mean + (self.max - previous_mean) * (target - previous_center) / (cumulative - previous_center)
+    
+    def serialize(self):
+        """Centroids and range as a JSON-safe dict, for merging elsewhere"""
+        return {
+            "compression": self.compression,
+            "means": list(self.means),
+            "weights": list(self.weights),
+            "min": self.min if self.total else None,
+            "max": self.max if self.total else None
+        }
+    
+    @classmethod
+    def deserialize(cls, data):
+        """Digest from its serialize() form"""
+        digest = cls(data["compression"])
+        digest.means = array('d', data["means"])
+        digest.weights = array('d', data["weights"])
+        digest.total = sum(digest.weights)
+        if digest.total:
+            digest.min, digest.max = data["min"], data["max"]
+        return digest
+
+
+def block_sketches(block, bounds=None):
+    """
+    Digests of SKETCH_FIELDS per extension over a timeline block
+    
+    Args:
+        block: TimelineBlock
+        bounds: Optional (first, last) call time in seconds, inclusive
+    
+    Returns:
+        dict: {Extno code: {field: TDigest}}
+    """
+    rows = {}
+    extensions = block.columns["Extno"]
+    for i in range(block.size):
+        if bounds is None or bounds[0] <= block.times[i] <= bounds[1]:
+            rows.setdefault(extensions[i], []).append(i)
+    return {
+        code: {name: TDigest.of(block.columns[name][i] for i in indexes) for name in SKETCH_FIELDS}
+        for code, indexes in rows.items()
+    }
+
+
+@tenant_cache(maxsize=lambda tenant: tenant.cache_hours)
+def hour_sketches(tenant, hour):
+    """Per-extension digests of a whole completed hour (cached, read-only)"""
+    return block_sketches(completed_timeline_block(tenant, hour))
+
+
+def window_sketches(tenant, window_start, window_end, extension_code=None, shard=None):
+    """
+    Merge the per-hour, per-extension digests covering a window (only the
+    hours or extensions a cluster shard owns, if given)
+    
+    Whole hours come from the cache; only the partial hours at the edges are
+    summarized from their blocks.
+    
+    Returns:
+        dict: {field: TDigest}
+    """
+    parts = {name: [] for name in SKETCH_FIELDS}
+    first = int((window_start - DATASET_EPOCH).total_seconds())
+    last = int((window_end - DATASET_EPOCH).total_seconds())
+    prefetch_timeline_blocks(tenant, first // 3600, last // 3600)
+    for hour in range(max(0, first // 3600), last // 3600 + 1):
+        if shard is not None and not shard_owns_hour(shard, hour):
+            continue
+        if first <= hour * 3600 and (hour + 1) * 3600 - 1 <= last:
+            sketches = hour_sketches(tenant, hour)
+        else:
+            sketches = block_sketches(timeline_block(tenant, hour), (first, last))
+        for code, digests in sketches.items():
+            if shard is not None and not shard_owns_extension(shard, AGGREGATE_DIMENSIONS["Extno"][code]):
+                continue
+            if extension_code is None or code == extension_code:
+                for name in SKETCH_FIELDS:
+                    parts[name].append(digests[name])
+    return {name: TDigest.merged(digests) for name, digests in parts.items()}
+
+
+# Call counters /reporting/statistics derives its volume, service level,
+# journey and handle time metrics from
+CALL_COUNTERS = ("calls", "inbound", "outbound", "answered", "missed", "inboundInTarget",
+                 "journeys", "completedJourneys", "contactPoints", "rated", "rating", "talkTime")
+
+# Journey outcomes of journeys that reached someone (answered or called back)
+COMPLETED_JOURNEY_OUTCOMES = ("701", "703")
+
+
+def block_call_counts(block, bounds=None):
+    """
+    CALL_COUNTERS per extension over a timeline block
+    
+    A journey is counted with its first leg, so it counts in the window its
+    first call falls in.
+    
+    Args:
+        block: TimelineBlock
+        bounds: Optional (first, last) call time in seconds, inclusive
+    
+    Returns:
+        dict: {Extno code: {counter: value}}
+    """
+    columns = block.columns
+    inbound, outbound = DIMENSION_CODES["Direction"]["I"], DIMENSION_CODES["Direction"]["O"]
+    completed = {DIMENSION_CODES["JourneyOutcome"][outcome] for outcome in COMPLETED_JOURNEY_OUTCOMES}
+    first_leg = DIMENSION_CODES["Call_legId"]["1"]
+    counts = {}
+    for i in range(block.size):
+        if bounds is not None and not bounds[0] <= block.times[i] <= bounds[1]:
+            continue
+        row = counts.get(columns["Extno"][i])
+        if row is None:
+            row = counts[columns["Extno"][i]] = dict.fromkeys(CALL_COUNTERS, 0)
+        answered = not columns["Unanswer"][i]
+        row["calls"] += 1
+        row["inbound"] += columns["Direction"][i] == inbound
+        row["outbound"] += columns["Direction"][i] == outbound
+        row["answered"] += answered
+        row["missed"] += not answered
+        if answered:
+            row["inboundInTarget"] += (columns["Direction"][i] == inbound
+                                       and columns["waitTime"][i] <= SERVICE_LEVEL_SECONDS)
+            row["talkTime"] += columns["Duration"][i]
+            # Rating codes are the ratings; only answered calls are rated
+            row["rated"] += 1
+            row["rating"] += columns["CallExperienceRating"][i]
+        if columns["Call_legId"][i] == first_leg:
+            row["journeys"] += 1
+            row["completedJourneys"] += columns["JourneyOutcome"][i] in completed
+            row["contactPoints"] += columns["ContactPoints"][i]
+    return counts
+
+
+@tenant_cache(maxsize=lambda tenant: tenant.cache_hours)
+def hour_call_counts(tenant, hour):
+    """Per-extension call counters of a whole completed hour (cached, read-only)"""
+    return block_call_counts(completed_timeline_block(tenant, hour))
+
+
+def window_call_counts(tenant, window_start, window_end, extension_code=None, shard=None):
+    """
+    Sum the per-hour, per-extension call counters covering a window (only
+    the hours or extensions a cluster shard owns, if given), like
+    window_sketches
+    
+    Returns:
+        dict: {counter: value}
+    """
+    totals = dict.fromkeys(CALL_COUNTERS, 0)
+    first = int((window_start - DATASET_EPOCH).total_seconds())
+    last = int((window_end - DATASET_EPOCH).total_seconds())
+    for hour in range(max(0, first // 3600), last // 3600 + 1):
+        if shard is not None and not shard_owns_hour(shard, hour):
+            continue
+        if first <= hour * 3600 and (hour + 1) * 3600 - 1 <= last:
+            counts = hour_call_counts(tenant, hour)
+        else:
+            counts = block_call_counts(timeline_block(tenant, hour), (first, last))
+        for code, row in counts.items():
+            if shard is not None and not shard_owns_extension(shard, AGGREGATE_DIMENSIONS["Extno"][code]):
+                continue
+            if extension_code is None or code == extension_code:
+                for name, value in row.items():
+                    totals[name] += value
+    return totals
+
+
+# ==================== CARDINALITY AND HEAVY-HITTER SKETCHES ====================
+
+# Fields /reporting/calls/distinct and /reporting/calls/top can sketch
+SKETCH_KEY_FIELDS = ("Number",) + tuple(AGGREGATE_DIMENSIONS)
+
+MASK64 = (1 << 64) - 1
+
+
+def mix64(value):
+    """64-bit hash of an integer key (splitmix64 finalizer), stable across processes"""
+    value = (value + 0x9E3779B97F4A7C15) & MASK64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK64
+    return value ^ (value >> 31)
+
+
+class HyperLogLog:
+    """
+    Distinct-count sketch (HyperLogLog)
+    
+    2^precision one-byte registers, whatever the number of keys added.
+    Sketches merge by taking the register-wise maximum, so the sketch of a
+    union of buckets (or of another worker's sketch) is exact to build.
+    
+    Args:
+        precision: Register index bits (default: HLL_PRECISION)
+        registers: Existing registers (from `serialize`)
+    """
+    
+    __slots__ = ('precision', 'registers')
+    
+    def __init__(self, precision=None, registers=None):
+        self.precision = precision or HLL_PRECISION
+        self.registers = bytearray(registers) if registers else bytearray(1 << self.precision)
+    
+    def add(self, key):
+        """Add an integer key"""
+        value = mix64(key)
+        suffix_bits = 64 - self.precision
+        index = value >> suffix_bits
+        rank = suffix_bits - (value & ((1 << suffix_bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+    
+    @classmethod
+    def merged(cls, sketches, precision=None):
+        """Sketch of the union of the keys added to `sketches`"""
+        merged = cls(precision)
+        for sketch in sketches:
+            merged.registers = bytearray(map(max, merged.registers, sketch.registers))
+        return merged
+    
+    @property
+    def standard_error(self):
+        """Relative standard error of `estimate`"""
+        return 1.04 / math.sqrt(len(self.registers))
+    
+    def estimate(self):
+        """Estimated number of distinct keys"""
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Small range correction (linear counting)
+            estimate = m * math.log(m / zeros)
+        return estimate
+    
+    def serialize(self):
+        """Registers as base64, for merging elsewhere"""
+        return base64.b64encode(bytes(self.registers)).decode()
+
+
+class SpaceSaving:
+    """
+    Heavy-hitter sketch (space-saving summary, mergeable form)
+    
+    Keeps at most `capacity` counters. `counts` are upper bounds on each
+    kept key's count and `errors` the most they may overestimate it by;
+    `floor` bounds the count of any key that was not kept. Merging adds
+    counts (a key missing from a summary counts as that summary's floor)
+    and keeps the largest `capacity` counters.
+    
+    Args:
+        capacity: Counters kept (default: HEAVY_HITTER_CAPACITY)
+    """
+    
+    __slots__ = ('capacity', 'counts', 'errors', 'floor', 'total')
+    
+    def __init__(self, capacity=None):
+        self.capacity = capacity or HEAVY_HITTER_CAPACITY
+        self.counts = {}
+        self.errors = {}
+        self.floor = 0
+        self.total = 0
+    
+    @classmethod
+    def of(cls, keys, capacity=None):
+        """Summary of a sequence of keys (exact counts, then truncated)"""
+        summary = cls(capacity)
+        counts = Counter(keys)
+        summary.total = sum(counts.values())
+        summary._keep(counts, {}, 0)
+        return summary
+    
+    @classmethod
+    def merged(cls, summaries, capacity=None):
+        """Summary of the concatenation of the keys summarized by `summaries`"""
+        merged = cls(capacity)
+        summaries = list(summaries)
+        # Start every key at the sum of floors, then swap each summary's
+        # floor for its actual counter where it has one
+        floor = sum(summary.floor for summary in summaries)
+        counts = {}
+        errors = {}
+        for summary in summaries:
+            merged.total += summary.total
+            for key, count in summary.counts.items():
+                counts[key] = counts.get(key, floor) + count - summary.floor
+                errors[key] = errors.get(key, floor) + summary.errors[key] - summary.floor
+        merged._keep(counts, errors, floor)
+        return merged
+    
+    def _keep(self, counts, errors, floor):
+        """Keep the largest `capacity` counters; dropped counts raise the floor"""
+        ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+        if len(ranked) > self.capacity:
+            floor = max(floor, ranked[self.capacity][1])
+            ranked = ranked[:self.capacity]
+        self.counts = dict(ranked)
+        self.errors = {key: errors.get(key, 0) for key, _ in ranked}
+        self.floor = floor
+    
+    def top(self, k):
+        """
+        The k keys with the highest counts
+        
+        Returns:
+            list: (key, count upper bound, count lower bound, guaranteed) tuples;
+                  guaranteed when the key is certainly among the top k
+        """
+        ranked = list(self.counts.items())
+        threshold = max(self.floor, ranked[k][1] if len(ranked) > k else 0)
+        result = []
+        for key, count in ranked[:k]:
+            lower = count - self.errors[key]
+            result.append((key, count, lower, lower >= threshold))
+        return result
+
+
+def block_key_column(block, field):
+    """Integer keys of a sketchable field over a block"""
+    return block.numbers if field == "Number" else block.columns[field]
+
+
+def sketch_key_label(field, key):
+    """Field value of a sketch key"""
+    if field == "Number":
+        return generate_phone_number(digits=key)
+    return AGGREGATE_DIMENSIONS[field][key]
+
+
+def block_key_sketches(block, field, bounds=None):
+    """
+    Distinct-count and heavy-hitter sketches of a field over a block
+    
+    Returns:
+        tuple: (HyperLogLog, SpaceSaving)
+    """
+    column = block_key_column(block, field)
+    if bounds is None:
+        keys = list(column)
+    else:
+        keys = [key for time_, key in zip(block.times, column) if bounds[0] <= time_ <= bounds[1]]
+    distinct = HyperLogLog()
+    for key in keys:
+        distinct.add(key)
+    return distinct, SpaceSaving.of(keys)
+
+
+# Time buckets that are constant within a day, so whole days can be merged
+DAY_BUCKETS = ("day", "week", "month", "dayOfWeek")
+
+
+@tenant_cache(maxsize=168)
+def hour_key_sketches(tenant, hour, field):
+    """Sketches of a field over a whole completed hour (cached, read-only)"""
+    return block_key_sketches(completed_timeline_block(tenant, hour), field)
+
+
+@tenant_cache(maxsize=2 * AGGREGATE_MAX_DAYS)
+def day_key_sketches(tenant, day, field):
+    """Sketches of a field over a whole completed day, merged from its hours (cached, read-only)"""
+    hours = [hour_key_sketches(tenant, hour, field) for hour in range(day * 24, day * 24 + 24)]
+    return (HyperLogLog.merged(distinct for distinct, _ in hours),
+            SpaceSaving.merged(heavy for _, heavy in hours))
+
+
+def window_key_sketches(tenant, window_start, window_end, field, bucket_name=None):
+    """
+    Sketches of a field per time bucket over a window
+    
+    Whole days (when the bucket allows) and whole hours come from the
+    caches; only the partial hours at the edges are sketched from their
+    blocks.
+    
+    Returns:
+        dict: {bucket value (None without bucket): ([HyperLogLog], [SpaceSaving])}
+    """
+    bucket = TIME_BUCKETS.get(bucket_name)
+    whole_days = bucket_name is None or bucket_name in DAY_BUCKETS
+    parts = {}
+    first = int((window_start - DATASET_EPOCH).total_seconds())
+    last = int((window_end - DATASET_EPOCH).total_seconds())
+    prefetch_timeline_blocks(tenant, first // 3600, last // 3600)
+    hour = max(0, first // 3600)
+    while hour <= last // 3600:
+        step = 1
+        if whole_days and hour % 24 == 0 and first <= hour * 3600 and (hour + 24) * 3600 - 1 <= last:
+            distinct, heavy = day_key_sketches(tenant, hour // 24, field)
+            step = 24
+        elif first <= hour * 3600 and (hour + 1) * 3600 - 1 <= last:
+            distinct, heavy = hour_key_sketches(tenant, hour, field)
+        else:
+            distinct, heavy = block_key_sketches(timeline_block(tenant, hour), field, (first, last))
+        key = bucket(DATASET_EPOCH + timedelta(hours=hour)) if bucket else None
+        hlls, summaries = parts.setdefault(key, ([], []))
+        hlls.append(distinct)
+        summaries.append(heavy)
+        hour += step
+    return parts
+
+# Export formats: content type and file extension
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+    "parquet": ("application/vnd.apache.parquet", "parquet")
+}
+
+# Typed columns for columnar exports; other fields are plain strings
+#   'dictionary': dictionary-encoded strings (low-cardinality pools)
+COLUMNAR_FIELD_TYPES = {
+    "RecordId": "int64",
+    "Call_date": "timestamp",
+    "Ring_time": "int32",
+    "Duration": "int32",
+    "Call_cost": "float64",
+    "totalDuration": "int32",
+    "waitTime": "int32",
+    "HoldDuration": "int32",
+    "JourneyWaitTime": "int32",
+    "Extno": "dictionary",
+    "Username": "dictionary",
+    "Call_outcome": "dictionary",
+    "Direction": "dictionary",
+    "Group_no": "dictionary",
+    "JourneyOutcome": "dictionary",
+    "DeviceId": "dictionary"
+}
+
+
+def export_limits(export_format):
+    """(default, max) record limit for an export format"""
+    if export_format in ("arrow", "parquet"):
+        return 100, COLUMNAR_EXPORT_MAX_LIMIT
+    return 100, CSV_EXPORT_MAX_LIMIT
+
+
+def columnar_schema(projection):
+    """Arrow schema for a projection, using COLUMNAR_FIELD_TYPES"""
+    arrow_types = {
+        "int64": pa.int64(),
+        "int32": pa.int32(),
+        "float64": pa.float64(),
+        "timestamp": pa.timestamp('s'),
+        "dictionary": pa.dictionary(pa.int32(), pa.string())
+    }
+    return pa.schema([
+        (name, arrow_types[COLUMNAR_FIELD_TYPES.get(name)] if name in COLUMNAR_FIELD_TYPES else pa.string())
+        for name in projection.fields
+    ])
+
+
+def columnar_batch(projection, schema, cores):
+    """
+    Build an Arrow record batch from core values, column by column
+    Numeric strings and dates are converted with vectorized casts
+    """
+    arrays = []
+    for (name, value, is_builder), field in zip(projection.steps, schema):
+        if is_builder:
+            column = [value(core) for core in cores]
+        else:
+            column = [value] * len(cores)
+        kind = COLUMNAR_FIELD_TYPES.get(name)
+        if kind == "dictionary":
+            array = pa.array(column, pa.string()).dictionary_encode()
+        elif kind in ("int32", "int64", "timestamp") and column and isinstance(column[0], str):
+            array = pa.array(column, pa.string()).cast(field.type)
+        else:
+            array = pa.array(column, field.type)
+        arrays.append(array)
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+class ChunkSink:
+    """Write-only file object that collects bytes until drained"""
+    
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+    
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+    
+    def tell(self):
+        return self.position
+    
+    def flush(self):
+        pass
+    
+    def close(self):
+        self.closed = True
+    
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def generate_columnar_export(tenant, export_format, fields_param, limit, start_date, end_date):
+    """
+    Generate records in row groups and yield the Arrow IPC stream or Parquet
+    bytes as each group is written, so memory stays bounded by the group size
+    """
+    schema = columnar_schema(get_projection(fields_param))
+    sink = ChunkSink()
+    if export_format == "parquet":
+        writer = pq.ParquetWriter(sink, schema, compression='snappy')
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+    
+    for chunk in generate_record_chunks(tenant, export_format, fields_param, limit, start_date,
+                                        end_date, EXPORT_ROW_GROUP_SIZE):
+        batch = pa.ipc.open_stream(chunk).read_next_batch()
+        if export_format == "parquet":
+            writer.write_batch(batch, row_group_size=batch.num_rows)
+        else:
+            writer.write_batch(batch)
+        yield sink.drain()
+    
+    writer.close()
+    yield sink.drain()
+
+
+# ==================== SEARCH INDEXES ====================
+
+# /reporting/calls/search parameters: field looked up and how it matches
+SEARCH_PARAMETERS = {
+    "callId": ("CallId", "exact"),
+    "legId": ("LegID", "exact"),
+    "number": ("Number", "prefix"),
+    "username": ("Username", "prefix")
+}
+
+# Subscriber digits of a Number (see caller_digits)
+NUMBER_DIGITS = 9
+
+
+def search_key(value):
+    """64-bit hash of an exact-match search value (CallId, LegID), stable across processes"""
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+
+class SortedKeys:
+    """
+    One key per call of a block, sorted, with the block position of each
+    
+    Key ranges are found by binary search, and two arrays cost a few bytes
+    per call instead of a dict entry and a string per call.
+    
+    Args:
+        keys: Keys in block order (array or sequence of ints)
+        typecode: Array typecode of the keys
+    """
+    
+    __slots__ = ('keys', 'positions')
+    
+    def __init__(self, keys, typecode):
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        self.keys = array(typecode, (keys[i] for i in order))
+        self.positions = array('I', order)
+    
+    def find(self, low, high):
+        """Block positions of the keys in [low, high)"""
+        return self.positions[bisect_left(self.keys, low):bisect_left(self.keys, high)]
+
+
+class SearchIndex:
+    """
+    Lookup indexes over one hour of the call timeline
+    
+    Hashed CallId and LegID keys for exact lookups, Number subscriber
+    digits for prefix lookups (a prefix is a range of digits) and Username
+    codes (a prefix is a set of codes), each as SortedKeys.
+    
+    Args:
+        block: TimelineBlock of the hour
+    """
+    
+    __slots__ = ('block', 'fields')
+    
+    def __init__(self, block):
+        self.block = block
+        self.fields = {
+            "CallId": SortedKeys(block.call_ids, 'Q'),
+            "LegID": SortedKeys(block.leg_ids, 'Q'),
+            "Number": SortedKeys(block.numbers, 'I'),
+            "Username": SortedKeys(block.columns["Username"], 'B')
+        }
+    
+    def lookup(self, field, key_ranges):
+        """Block positions of the calls whose `field` key falls in any of key_ranges, in time order"""
+        keys = self.fields[field]
+        positions = []
+        for low, high in key_ranges:
+            positions.extend(keys.find(low, high))
+        positions.sort()
+        return positions
+
+
+@tenant_cache(maxsize=lambda tenant: tenant.cache_hours)
+def hour_search_index(tenant, hour):
+    """
+    Search index of a timeline hour (cached per tenant)
+    
+    Slots are generated rather than recorded, so the block of the current
+    hour already holds its calls still to come; lookups leave them out by
+    call time, and the index can be cached like any other hour's.
+    """
+    return SearchIndex(completed_timeline_block(tenant, hour))
+
+
+def search_key_ranges(field, value):
+    """
+    Index key ranges matching a search value
+    
+    Args:
+        field: Searched field (see SEARCH_PARAMETERS)
+        value: CallId or LegID, or a prefix of a Number (as returned,
+               +33..., or national, 0...) or of a Username (case-insensitive)
+    
+    Returns:
+        list: [(low, high)] key ranges; empty when nothing can match
+    """
+    if field in ("CallId", "LegID"):
+        key = search_key(value)
+        return [(key, key + 1)]
+    if field == "Username":
+        prefix = value.upper()
+        return [(code, code + 1) for code, name in enumerate(USERNAMES) if name.upper().startswith(prefix)]
+    
+    # Number: the digits after the +33 or 0 prefix select a range of subscriber numbers
+    for country in ("+33", "0"):
+        if country.startswith(value):
+            return [(0, 10 ** NUMBER_DIGITS)]
+        if value.startswith(country):
+            digits = value[len(country):]
+            break
+    else:
+        return []
+    if not digits.isdigit() or len(digits) > NUMBER_DIGITS:
+        return []
+    scale = 10 ** (NUMBER_DIGITS - len(digits))
+    return [(int(digits) * scale, (int(digits) + 1) * scale)]
+
+
+def leg_id_hour(leg_id):
+    """Timeline hour a LegID was issued in (it ends with the call's Unix timestamp), or None"""
+    try:
+        call_date = datetime.fromtimestamp(int(leg_id.rsplit('_', 1)[-1]))
+    except (ValueError, OverflowError, OSError):
+        return None
+    return int((call_date - DATASET_EPOCH).total_seconds()) // 3600
+
+
+# ==================== AGENT STATES ====================
+
+AGENT_STATES = ["Offline", "Available", "Away", "Busy"]
+OFFLINE, AVAILABLE, AWAY, BUSY = range(len(AGENT_STATES))
+
+# Event kinds, in the order they apply within a second
+CALL_END, SCHEDULE_CHANGE, CALL_START = range(3)
+
+# Longest a timeline call keeps an agent busy (max Ring_time + Duration);
+# shorter than any break, so agents are never on a call when they return
+AGENT_MAX_CALL_SECONDS = 630
+
+
+def agent_directory(extensions):
+    """Fixed directory details of each extension's agent"""
+    return [
+        {
+            "extension": extension,
+            "username": USERNAMES[index % len(USERNAMES)],
+            "groupNumber": GROUP_NUMBERS[index % len(GROUP_NUMBERS)],
+            "deviceId": DEVICE_IDS[index % len(DEVICE_IDS)]
+        }
+        for index, extension in enumerate(extensions)
+    ]
+
+
+def timeline_seconds(dt):
+    """Whole seconds since DATASET_EPOCH"""
+    return int((dataset_time(dt) - DATASET_EPOCH).total_seconds())
+
+
+@lru_cache(maxsize=1024)
+def agent_schedule(seed, index, day):
+    """
+    Shift of an extension's agent on a timeline day
+    
+    Drawn from (tenant seed, extension, day): most agents work weekdays and some
+    work weekends, starting between 07:00 and 10:00 for 7 to 9 hours, with
+    two short breaks and a lunch break (Away). Offline outside the shift.
+    
+    Returns:
+        tuple: ([change times in timeline seconds], [states])
+    """
+    rng = random.Random((seed << 48) ^ (index << 32) ^ day ^ 0xA6E7)
+    midnight = day * 86400
+    times, states = [midnight], [OFFLINE]
+    weekday = (day + DATASET_EPOCH.weekday()) % 7
+    if rng.random() < (0.95 if weekday < 5 else 0.3):
+        start = midnight + rng.randrange(7 * 3600, 10 * 3600, 300)
+        length = rng.randrange(7 * 3600, 9 * 3600 + 1, 900)
+        breaks = [
+            (start + rng.randrange(90, 150) * 60, 15 * 60),
+            (start + length // 2 + rng.randrange(-30, 31) * 60, rng.randrange(30, 61, 15) * 60),
+            (start + length - rng.randrange(60, 90) * 60, 15 * 60)
+        ]
+        times.append(start)
+        states.append(AVAILABLE)
+        for at, span in breaks:
+            times += [at, at + span]
+            states += [AWAY, AVAILABLE]
+        times.append(start + length)
+        states.append(OFFLINE)
+    return times, states
+
+
+def scheduled_state(seed, index, seconds):
+    """Scheduled state of an agent at a timeline second (ignoring calls)"""
+    times, states = agent_schedule(seed, index, seconds // 86400)
+    return states[bisect_right(times, seconds) - 1]
+
+
+def agent_replay_start(seed, index, seconds):
+    """
+    Timeline second from which replaying calls gives an agent's exact state
+    
+    Agents are never on a call when they become Available (breaks and time
+    off outlast any call), so the agent's history starts to matter at the
+    start of its last Available period (today's or yesterday's).
+    
+    Returns:
+        int: Timeline second, or None if the agent has been off since before
+        yesterday
+    """
+    day = seconds // 86400
+    for schedule_day in (day, day - 1):
+        times, states = agent_schedule(seed, index, schedule_day)
+        position = bisect_right(times, seconds) - 1
+        while position >= 0 and states[position] != AVAILABLE:
+            position -= 1
+        if position >= 0:
+            return times[position]
+    return None
+
+
+def agent_off_since(seed, index, seconds):
+    """End of the last shift of an agent off since before yesterday (within a week)"""
+    day = seconds // 86400
+    for schedule_day in range(day - 2, day - 8, -1):
+        times, _ = agent_schedule(seed, index, schedule_day)
+        if len(times) > 1:
+            return times[-1]
+    return (day - 7) * 86400
+
+
+def next_schedule_change(seed, index, seconds):
+    """First schedule change of an agent after a timeline second"""
+    day = seconds // 86400
+    times, _ = agent_schedule(seed, index, day)
+    position = bisect_right(times, seconds)
+    return times[position] if position < len(times) else (day + 1) * 86400
+
+
+class AgentStateEngine:
+    """
+    Agent state machine driven by the call timeline
+    
+    Each of a tenant's extensions has an agent, who follows its shift schedule (Available, Away on
+    breaks, Offline outside the shift) and takes the extension's timeline
+    calls while Available and not already on a call, staying Busy while the
+    call rings and lasts. States are a function of the
+    deterministic timeline, so every worker computes the same states and
+    versions. The engine applies call starts, call ends and schedule changes
+    in time order, only as far as the current time and only when the next
+    one is due, so reading states costs O(1) between changes.
+    
+    A state's version is the timeline second (since DATASET_EPOCH) of the
+    last change. The last `log_size` changes are kept for delta queries;
+    older versions get a full snapshot instead.
+    
+    Args:
+        tenant: Tenant whose extensions and timeline drive the agents
+        log_size: Number of recent changes kept for deltas
+    """
+    
+    def __init__(self, tenant, log_size=AGENT_EVENT_LOG):
+        self.tenant = tenant
+        self.directory = agent_directory(tenant.extensions)
+        count = len(self.directory)
+        self.states = array('B', [OFFLINE] * count)
+        self.since = array('l', [0] * count)
+        self.active = array('B', [0] * count)
+        self.calls = [None] * count
+        self.log = deque(maxlen=log_size)
+        self.version = 0
+        self.floor = 0
+        self.clock = None
+        self.next_slot = 0
+        self.next_due = 0
+        self._queue = []
+        self._sequence = itertools.count()
+        self._snapshot = None
+        self._lock = threading.Lock()
+    
+    def _start(self, now):
+        """Replay the calls agents are or may still be on, then keep changes from now"""
+        seed = self.tenant.seed
+        starts = [agent_replay_start(seed, index, now) for index in range(len(self.directory))]
+        begin = min((start for start in starts if start is not None), default=now) - 1
+        for index, start in enumerate(starts):
+            times, states = agent_schedule(seed, index, begin // 86400)
+            position = bisect_right(times, begin) - 1
+            self.states[index] = states[position]
+            self.since[index] = times[position] if start is not None else agent_off_since(seed, index, now)
+        self.clock = begin
+        self.next_slot = dataset_slot(self.tenant, DATASET_EPOCH + timedelta(seconds=begin + 1))
+        self._apply(now)
+        self.log.clear()
+        self.floor = self.version = now
+    
+    def advance(self, now=None):
+        """Apply all changes up to `now` (timeline seconds, default: the current time)"""
+        if now is None:
+            now = timeline_seconds(datetime.now())
+        if self.clock is not None and now < self.next_due:
+            return
+        with self._lock:
+            if self.clock is None:
+                self._start(now)
+            elif now > self.clock:
+                self._apply(now)
+    
+    def _push(self, seconds, kind, index, call=None):
+        heapq.heappush(self._queue, (seconds, kind, index, next(self._sequence), call))
+    
+    def _apply(self, now):
+        tenant = self.tenant
+        seed = tenant.seed
+        # Queue the timeline calls that have started by now
+        while True:
+            core = dataset_core(tenant, self.next_slot)
+            if core is None:
+                next_call = math.ceil((dataset_slot_time(tenant, self.next_slot + 1) - DATASET_EPOCH).total_seconds())
+                if next_call > now:
+                    break
+            else:
+                started = next_call = timeline_seconds(core.call_date)
+                if started > now:
+                    break
+                busy = core.ring_time + core.duration
+                if started > self.clock and busy > 0:
+                    self._push(started, CALL_START, tenant.extension_index[core.extno],
+                               (started + busy, core.call_id))
+            self.next_slot += 1
+        
+        # Queue schedule changes
+        next_change = now + 86400
+        for index in range(len(self.directory)):
+            change = next_schedule_change(seed, index, self.clock)
+            while change <= now:
+                self._push(change, SCHEDULE_CHANGE, index)
+                change = next_schedule_change(seed, index, change)
+            next_change = min(next_change, change)
+        
+        # Apply events second by second; a state only changes once per second
+        queue = self._queue
+        while queue and queue[0][0] <= now:
+            seconds = queue[0][0]
+            touched = set()
+            while queue and queue[0][0] == seconds:
+                _, kind, index, _, call = heapq.heappop(queue)
+                if kind == CALL_START:
+                    # One call at a time, and only while available; other
+                    # calls go to the group or voicemail
+                    if self.active[index] or scheduled_state(seed, index, seconds) != AVAILABLE:
+                        continue
+                    self.active[index] = 1
+                    self.calls[index] = call[1]
+                    self._push(call[0], CALL_END, index)
+                elif kind == CALL_END:
+                    self.active[index] = 0
+                    self.calls[index] = None
+                touched.add(index)
+            for index in sorted(touched):
+                state = BUSY if self.active[index] else scheduled_state(seed, index, seconds)
+                if state != self.states[index]:
+                    self.states[index] = state
+                    self.since[index] = seconds
+                    self.version = seconds
+                    self.log.append((seconds, index, state))
+        
+        self.clock = now
+        self.next_due = min(next_change, queue[0][0] if queue else next_change, next_call)
+    
+    def agent(self, index):
+        """Current state of one agent, as returned by /reporting/agents"""
+        return {
+            **self.directory[index],
+            "status": AGENT_STATES[self.states[index]],
+            "since": (DATASET_EPOCH + timedelta(seconds=self.since[index])).isoformat(),
+            "callId": self.calls[index] if self.states[index] == BUSY else None
+        }
+    
+    def snapshot(self):
+        """
+        All agents' current states
+        
+        Returns:
+            tuple: (version, list of agents); built once per version
+        """
+        self.advance()
+        snapshot = self._snapshot
+        if snapshot is None or snapshot[0] != self.version:
+            with self._lock:
+                snapshot = self._snapshot = (self.version, [self.agent(i) for i in range(len(self.directory))])
+        return snapshot
+    
+    def changes(self, since):
+        """
+        Changes after version `since`, oldest first
+        
+        Returns:
+            tuple: (version, [(version, agent index, state)]), or None if
+            changes that old are no longer kept
+        """
+        self.advance()
+        with self._lock:
+            if since < self.floor:
+                return None
+            changes = []
+            for change in reversed(self.log):
+                if change[0] <= since:
+                    break
+                changes.append(change)
+            changes.reverse()
+            return self.version, changes
+    
+    def change(self, change):
+        """JSON form of a state change"""
+        seconds, index, state = change
+        return {
+            "version": seconds,
+            "extension": self.directory[index]["extension"],
+            "status": AGENT_STATES[state],
+            "at": (DATASET_EPOCH + timedelta(seconds=seconds)).isoformat()
+        }
+
+
+# ==================== PARALLEL GENERATION ====================
+
+def reserve_record_ids(count):
+    """Reserve a contiguous block of RecordIds; returns the first one"""
+    global record_id_counter
+    with record_id_lock:
+        first_record_id = record_id_counter + 1
+        record_id_counter += count
+    return first_record_id
+
+
+def generate_record_chunk(task):
+    """
+    Generate and encode one range of records (process pool entry point)
+    
+    Each range draws from its own RNG seeded with (seed, chunk), so the output
+    only depends on the task, not on which process runs it or in what order.
+    
+    Args:
+        task: dict with tenant (account key), kind ('csv', 'json', 'arrow' or
+              'parquet'), fields, start_date, end_date, seed, chunk,
+              first_record_id and count
+    
+    Returns:
+        bytes: CSV lines (each prefixed with a newline), comma-separated JSON
+               messages, or an Arrow IPC stream holding one record batch
+    """
+    rng = random.Random(f"{task['seed']}:{task['chunk']}")
+    projection = get_projection(task['fields'])
+    tenant = tenants[task['tenant']]
+    cores = generate_call_cores(task['count'], task['start_date'], task['end_date'], rng,
+                                task['first_record_id'], tenant)
+    
+    if task['kind'] in ('arrow', 'parquet'):
+        schema = columnar_schema(projection)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, schema) as writer:
+            writer.write_batch(columnar_batch(projection, schema, cores))
+        return sink.getvalue().to_pybytes()
+    
+    messages = [
+        wrap_in_kafka_format(projection.build(core), core.record_id, rng)
+        for core in cores
+    ]
+    if task['kind'] == 'csv':
+        return ''.join('\n' + kafka_csv_line(message) for message in messages).encode()
+    # Same key order and separators as jsonify
+    return ','.join(
+        dumps_records(message, sort_keys=True, separators=(',', ':')) for message in messages
+    ).encode()
+
+
+_generation_pool = None
+_generation_pool_pid = None
+
+
+def get_generation_pool():
+    """
+    Return this worker's generation process pool, creating it on first use
+    Uses 'spawn' so pool processes never inherit locks held by our threads
+    """
+    global _generation_pool, _generation_pool_pid
+    with worker_init_lock:
+        if _generation_pool is None or _generation_pool_pid != os.getpid():
+            _generation_pool = ProcessPoolExecutor(
+                max_workers=PARALLEL_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            _generation_pool_pid = os.getpid()
+        return _generation_pool
+
+
+def generate_record_chunks(tenant, kind, fields_param, limit, start_date, end_date, chunk_size):
+    """
+    Split a request into record ranges and yield each encoded range in order
+    
+    Large requests (PARALLEL_MIN_RECORDS or more) are generated in the process
+    pool, keeping at most two ranges per pool process in flight so memory stays
+    bounded when the client reads slowly. Smaller ones are generated inline.
+    """
+    seed = random.getrandbits(64)
+    first_record_id = reserve_record_ids(limit)
+    tasks = (
+        {
+            "tenant": tenant.key,
+            "kind": kind,
+            "fields": fields_param,
+            "start_date": start_date,
+            "end_date": end_date,
+            "seed": seed,
+            "chunk": chunk,
+            "first_record_id": first_record_id + start,
+            "count": min(chunk_size, limit - start)
+        }
+        for chunk, start in enumerate(range(0, limit, chunk_size))
+    )
+    
+    if PARALLEL_WORKERS <= 1 or limit < PARALLEL_MIN_RECORDS:
+        for task in tasks:
+            yield generate_record_chunk(task)
+        return
+    
+    pool = get_generation_pool()
+    pending = deque()
+    try:
+        for task in tasks:
+            pending.append(pool.submit(generate_record_chunk, task))
+            if len(pending) >= PARALLEL_WORKERS * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # Client went away: drop ranges that have not started yet
+        for future in pending:
+            future.cancel()
+
+
+def generate_stream_body(tenant, fields_param, limit, start_date, end_date, filters):
+    """Yield a /calls/stream JSON body incrementally, range by range"""
+    yield (
+        f'{{"count":{limit},'
+        f'"filters":{json.dumps(filters, sort_keys=True, separators=(",", ":"))},'
+        f'"messages":['
+    ).encode()
+    for index, chunk in enumerate(generate_record_chunks(
+            tenant, 'json', fields_param, limit, start_date, end_date, PARALLEL_CHUNK_SIZE)):
+        yield (b',' + chunk) if index else chunk
+    yield f'],"success":true,"timestamp":{json.dumps(datetime.now().isoformat())}}}\n'.encode()
+
+
+# Paced replays of this worker in progress (SIMULATION_MAX_REPLAYS)
+replay_slots = threading.BoundedSemaphore(max(1, SIMULATION_MAX_REPLAYS))
+
+
+def replay_record_limit(args, tenant):
+    """
+    Most messages a /calls/stream?speed= replay can send: its limit, or the
+    slots of the timeline span it can reach before SIMULATION_MAX_SECONDS
+    or endDate if fewer (0 for a replay that will be rejected)
+    """
+    cost = record_cost(args.get('limit'), SIMULATION_MAX_RECORDS, SIMULATION_MAX_RECORDS)
+    try:
+        speed = float(args.get('speed'))
+        start_date = parse_date_param(args.get('startDate'), 'startDate', end_of_day=False)
+        end_date = parse_date_param(args.get('endDate'), 'endDate', end_of_day=True)
+    except ValueError:
+        return 0
+    if not 0 < speed <= SIMULATION_MAX_SPEED:
+        return 0
+    span = speed * SIMULATION_MAX_SECONDS
+    if end_date:
+        start = dataset_time(start_date) if start_date else datetime.now()
+        span = min(span, (dataset_time(end_date) - start).total_seconds())
+    return min(cost, max(0, math.ceil(span / tenant.slot_seconds) + 1))
+
+
+def replay_timeline(tenant, clock, end, limit, projection, deadline):
+    """
+    Yield a tenant's timeline calls as newline-delimited Kafka messages, each
+    one when the simulated clock reaches its Call_date
+    
+    Args:
+        tenant: Tenant whose timeline is replayed
+        clock: SimulatedClock the replay is paced by (starts at clock.start)
+        end: Last Call_date to replay, or None
+        limit: Max messages
+        projection: RecordProjection of the message values
+        deadline: time.monotonic() value after which the replay stops
+    """
+    horizon = clock.at(deadline)
+    if end is not None:
+        horizon = min(horizon, end)
+    slot = dataset_slot(tenant, clock.start)
+    sent = 0
+    while sent < limit and dataset_slot_time(tenant, slot) <= horizon:
+        core = dataset_core(tenant, slot)
+        slot += 1
+        if core is None or core.call_date < clock.start:
+            continue
+        if core.call_date > horizon:
+            break
+        clock.sleep_until(core.call_date)
+        message = wrap_in_kafka_format(projection.build(core), core.record_id, offset=slot - 1,
+                                       timestamp=int(core.call_date.timestamp() * 1000))
+        yield dumps_records(message, sort_keys=True, separators=(',', ':')) + '\n'
+        sent += 1
+
+
+# ==================== EXPORT JOBS ====================
+
+# Export job formats: suffix of the finished (gzip) file
+EXPORT_JOB_FORMATS = {
+    "csv": "csv.gz",
+    "ndjson": "ndjson.gz"
+}
+
+# Running jobs whose status has not been updated for this long lost their
+# process (e.g. the worker was restarted) and are reported as failed
+EXPORT_JOB_STALE_SECONDS = 60
+
+# Timeline slots scanned between progress updates
+EXPORT_JOB_PROGRESS_SLOTS = 4096
+
+
+def write_json_atomic(path, data):
+    """Replace a JSON file atomically, so readers in other workers never see partial writes"""
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.tmp-', suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+
+def export_job_path(job_id, suffix):
+    """Path of one of a job's files in EXPORT_JOB_DIR"""
+    return os.path.join(EXPORT_JOB_DIR, f"{job_id}.{suffix}")
+
+
+def read_export_job(job_id):
+    """Job status by id, or None if unknown or expired"""
+    if not job_id or not all(c in '0123456789abcdef' for c in job_id):
+        return None
+    try:
+        with open(export_job_path(job_id, 'json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_export_job(job):
+    """Replace a job's status file (see write_json_atomic)"""
+    job["updatedAt"] = datetime.now().isoformat()
+    write_json_atomic(export_job_path(job["id"], 'json'), job)
+
+
+def purge_export_jobs():
+    """Delete jobs and files older than EXPORT_JOB_TTL_HOURS"""
+    cutoff = time.time() - EXPORT_JOB_TTL_HOURS * 3600
+    for entry in os.scandir(EXPORT_JOB_DIR):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.unlink(entry.path)
+        except OSError:
+            pass
+
+
+def run_export_job(job_id):
+    """
+    Write an export job's file (export pool entry point)
+    
+    Scans the tenant's call timeline over the job's window, as
+    /reporting/calls pages do, and writes every matching call as a Kafka
+    message to a gzip file. The file gets its final name once complete, so
+    downloads never see a partial file. Progress is published to the status
+    file every EXPORT_JOB_PROGRESS_SLOTS slots.
+    
+    Args:
+        job_id: Id of a queued job
+    """
+    job = read_export_job(job_id)
+    if job is None or job["status"] != "queued":
+        return
+    job.update(status="running", startedAt=datetime.now().isoformat())
+    write_export_job(job)
+    
+    part_path = export_job_path(job_id, 'part')
+    try:
+        tenant = tenants[job["tenant"]]
+        query = job["query"]
+        projection = get_projection(query["fields"])
+        extension = query["extension"]
+        direction = query["direction"]
+        window_start = datetime.fromisoformat(query["start"])
+        window_end = datetime.fromisoformat(query["end"])
+        first_slot = dataset_slot(tenant, window_start)
+        last_slot = dataset_slot(tenant, window_end)
+        csv = job["format"] == "csv"
+        
+        records = 0
+        truncated = False
+        with gzip.open(part_path, 'wb', compresslevel=EXPORT_JOB_COMPRESSION) as f:
+            if csv:
+                f.write(KAFKA_CSV_HEADER.encode())
+            for block_start in range(first_slot, last_slot + 1, EXPORT_JOB_PROGRESS_SLOTS):
+                lines = []
+                for slot in range(block_start, min(block_start + EXPORT_JOB_PROGRESS_SLOTS, last_slot + 1)):
+                    core = dataset_core(tenant, slot)
+                    if core is None or not window_start <= core.call_date <= window_end:
+                        continue
+                    if extension and core.extno != extension:
+                        continue
+                    if direction and core.direction != direction:
+                        continue
+                    if records == EXPORT_JOB_MAX_RECORDS:
+                        truncated = True
+                        break
+                    message = wrap_in_kafka_format(projection.build(core), core.record_id, offset=slot,
+                                                   timestamp=int(core.call_date.timestamp() * 1000))
+                    if csv:
+                        lines.append('\n' + kafka_csv_line(message))
+                    else:
+                        lines.append(dumps_records(message, sort_keys=True, separators=(',', ':')) + '\n')
+                    records += 1
+                f.write(''.join(lines).encode())
+                if truncated:
+                    break
+                done = min(block_start + EXPORT_JOB_PROGRESS_SLOTS, last_slot + 1) - first_slot
+                job["progress"] = {
+                    "records": records,
+                    "percent": round(100 * done / (last_slot + 1 - first_slot), 1)
+                }
+                write_export_job(job)
+        
+        file_path = export_job_path(job_id, EXPORT_JOB_FORMATS[job["format"]])
+        os.replace(part_path, file_path)
+        job.update(
+            status="completed",
+            completedAt=datetime.now().isoformat(),
+            progress={"records": records, "percent": 100.0},
+            file={"records": records, "size": os.path.getsize(file_path), "truncated": truncated}
+        )
+    except Exception as e:
+        logger.exception("Export job %s failed: %s", job_id, e)
+        if os.path.exists(part_path):
+            os.unlink(part_path)
+        job.update(status="failed", completedAt=datetime.now().isoformat(), error=str(e))
+    write_export_job(job)
+
+
+_export_pool = None
+_export_pool_pid = None
+
+
+def get_export_pool():
+    """
+    Return this worker's export process pool, creating it on first use
+    Uses 'spawn' like the generation pool
+    """
+    global _export_pool, _export_pool_pid
+    with worker_init_lock:
+        if _export_pool is None or _export_pool_pid != os.getpid():
+            _export_pool = ProcessPoolExecutor(
+                max_workers=EXPORT_JOB_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+            _export_pool_pid = os.getpid()
+        return _export_pool
+
+
+def export_job_done(job_id, future):
+    """Fail a job whose pool process died before it could record the outcome"""
+    global _export_pool
+    error = None if future.cancelled() else future.exception()
+    if error is None:
+        return
+    if isinstance(error, BrokenProcessPool):
+        # The pool is unusable: the next job starts a new one
+        _export_pool = None
+    job = read_export_job(job_id)
+    if job and job["status"] in ("queued", "running"):
+        job.update(status="failed", completedAt=datetime.now().isoformat(), error=str(error) or repr(error))
+        write_export_job(job)
+
+
+def submit_export_job(tenant, state, export_format):
+    """
+    Queue an export of a resolved /reporting/calls query
+    
+    Args:
+        tenant: Tenant whose timeline is exported
+        state: Query state from resolve_calls_query
+        export_format: Key of EXPORT_JOB_FORMATS
+    
+    Returns:
+        dict: Job status
+    """
+    os.makedirs(EXPORT_JOB_DIR, exist_ok=True)
+    purge_export_jobs()
+    job = {
+        "id": uuid.uuid4().hex,
+        "tenant": tenant.key,
+        "status": "queued",
+        "format": export_format,
+        "filters": {
+            "startDate": state["startDate"],
+            "endDate": state["endDate"],
+            "extension": state["extension"],
+            "direction": state["direction"],
+            "fields": state["fields"]
+        },
+        "query": state,
+        "progress": {"records": 0, "percent": 0.0},
+        "file": None,
+        "error": None,
+        "createdAt": datetime.now().isoformat(),
+        "startedAt": None,
+        "completedAt": None
+    }
+    write_export_job(job)
+    future = get_export_pool().submit(run_export_job, job["id"])
+    future.add_done_callback(partial(export_job_done, job["id"]))
+    return job
+
+
+def export_job_view(job):
+    """Public form of a job status, with its status and download links"""
+    view = {key: value for key, value in job.items() if key not in ("tenant", "query")}
+    if job["status"] == "running":
+        updated = datetime.fromisoformat(job["updatedAt"])
+        if (datetime.now() - updated).total_seconds() > EXPORT_JOB_STALE_SECONDS:
+            view.update(status="failed", error="Export process stopped")
+    view["links"] = {"self": f"{BASE_PATH}/reporting/exports/{job['id']}"}
+    if job["status"] == "completed":
+        view["links"]["download"] = f"{BASE_PATH}/reporting/exports/{job['id']}/download"
+    return view
+
+
+def parse_date_param(date_str: str, param_name: str, end_of_day: bool = False):
+    """
+    Parse date parameter from request
+    
+    Supports:
+    - ISO 8601: 2025-11-20T10:30:00
+    - ISO 8601 with Z: 2025-11-20T10:30:00Z
+    - Date only: 2025-11-20
+    """
+    if not date_str:
+        return None
+        
+    try:
+        # Handle ISO 8601 with timezone
+        if 'T' in date_str:
+            date_str = date_str.replace('Z', '+00:00')
+            return datetime.fromisoformat(date_str)
+        else:
+            # Date only - parse and optionally set to end of day
+            dt = datetime.strptime(date_str, '%Y-%m-%d')
+            if end_of_day:
+                dt = dt.replace(hour=23, minute=59, second=59)
+            return dt
+    except ValueError:
+        raise ValueError(f"Invalid {param_name} format. Use ISO 8601: YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS")
+
+
+def load_users_from_json():
+    """Load users from JSON file"""
+    try:
+        with open(USERS_FILE, 'r') as f:
+            data = json.load(f)
+            users = {}
+            for user in data.get('users', []):
+                users[user['username']] = user
+            return users
+    except FileNotFoundError:
+        logger.warning("Users file '%s' not found. Using simple mode.", USERS_FILE)
+        return SIMPLE_USERS
+    except Exception as e:
+        logger.error("Error loading users file: %s. Using simple mode.", e)
+        return SIMPLE_USERS
+
+
+def load_users_from_env():
+    """Load users from environment variables"""
+    # Format: MITEL_USER_1=username:password:account_id:role:name
+    users = {}
+    i = 1
+    while True:
+        user_env = os.getenv(f'MITEL_USER_{i}')
+        if not user_env:
+            break
+        
+        parts = user_env.split(':')
+        if len(parts) >= 2:
+            username = parts[0]
+            users[username] = {
+                'password': parts[1],
+                'account_id': parts[2] if len(parts) > 2 else '1',
+                'role': parts[3] if len(parts) > 3 else 'user',
+                'name': parts[4] if len(parts) > 4 else username
+            }
+        i += 1
+    
+    return users if users else SIMPLE_USERS
+
+
+def get_users():
+    """Get users based on configured mode"""
+    if USER_MGMT_MODE == 'json':
+        return load_users_from_json()
+    elif USER_MGMT_MODE == 'env':
+        return load_users_from_env()
+    else:  # simple mode
+        return SIMPLE_USERS
+
+
+def generate_token(username, account_id, expires_in=None, role='user'):
+    """
+    Generate a bearer token for a user
+    
+    Args:
+        username: Username
+        account_id: Account ID
+        expires_in: Token expiration in seconds (None = use default)
+        role: User role (e.g. 'admin', 'user')
+    
+    Returns:
+        tuple: (token, expires_in_seconds)
+    """
+    import hashlib
+    import time
+    
+    # Use provided expiration or default
+    if expires_in is None:
+        expires_in = TOKEN_EXPIRATION_DEFAULT
+    
+    # Create a simple token (in production, use JWT)
+    token_data = f"{username}:{account_id}:{time.time()}"
+    token = hashlib.sha256(token_data.encode()).hexdigest()
+    
+    # Store token with user info and expiration
+    token_info = {
+        'username': username,
+        'account_id': account_id,
+        'role': role,
+        'created_at': datetime.now(),
+        'expires_at': datetime.now() + timedelta(seconds=expires_in),
+        'expires_in': expires_in
+    }
+    os.makedirs(TOKEN_DIR, exist_ok=True)
+    purge_expired_tokens()
+    path = token_path(token)
+    write_json_atomic(path, dict(token_info, created_at=token_info['created_at'].isoformat(),
+                                 expires_at=token_info['expires_at'].isoformat()))
+    # The file's mtime is the token's expiry, for purge_expired_tokens
+    expires_at = token_info['expires_at'].timestamp()
+    os.utime(path, (expires_at, expires_at))
+    active_tokens[token] = token_info
+    
+    return token, expires_in
+
+
+def token_path(token):
+    """Path of a token's file in TOKEN_DIR (named by its hash, so the directory lists no tokens)"""
+    return os.path.join(TOKEN_DIR, f"{hashlib.sha256(token.encode()).hexdigest()}.json")
+
+
+def purge_expired_tokens():
+    """Delete the files of expired tokens from TOKEN_DIR"""
+    now = time.time()
+    for entry in os.scandir(TOKEN_DIR):
+        try:
+            if entry.stat().st_mtime < now:
+                os.unlink(entry.path)
+        except OSError:
+            pass
+
+
+def validate_token(token):
+    """
+    Validate a bearer token
+    
+    A token issued by another worker is loaded from TOKEN_DIR and cached;
+    a cached token is refused once another worker has revoked it.
+    """
+    path = token_path(token)
+    token_info = active_tokens.get(token)
+    if token_info is None:
+        try:
+            with open(path) as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return None
+        token_info = dict(stored, created_at=datetime.fromisoformat(stored['created_at']),
+                          expires_at=datetime.fromisoformat(stored['expires_at']))
+        active_tokens[token] = token_info
+    elif not os.path.exists(path):
+        active_tokens.pop(token, None)
+        return None
+    
+    # Check if token expired
+    if datetime.now() > token_info['expires_at']:
+        revoke_token(token)
+        return None
+    
+    return token_info
+
+
+def revoke_token(token):
+    """Revoke a bearer token on every worker"""
+    active_tokens.pop(token, None)
+    try:
+        os.unlink(token_path(token))
+    except FileNotFoundError:
+        pass
+
+
+def require_auth(f):
     """
     Decorator to require Bearer token authentication
     Only enforced if REQUIRE_AUTH=true
     """
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if not REQUIRE_AUTH:
-            # Auth disabled - allow all requests
-            return f(*args, **kwargs)
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not REQUIRE_AUTH or cluster_shard() is not None:
+            # Auth disabled, or a signed shard request from a cluster node
+            return f(*args, **kwargs)
+        
+        # Check for Authorization header
+        auth_header = request.headers.get('Authorization')
+        
+        if not auth_header:
+            return jsonify({
+                "success": False,
+                "error": {
+                    "code": "UNAUTHORIZED",
+                    "message": "Missing Authorization header. Include 'Authorization: Bearer <token>'"
+                }
+            }), 401
+        
+        # Check Bearer token format
+        if not auth_header.startswith('Bearer '):
+            return jsonify({
+                "success": False,
+                "error": {
+                    "code": "INVALID_AUTH_FORMAT",
+                    "message": "Authorization header must use Bearer token format: 'Bearer <token>'"
+                }
+            }), 401
+        
+        # Extract token
+        token = auth_header[7:]  # Remove 'Bearer ' prefix
+        
+        # Validate token
+        token_info = validate_token(token)
+        if not token_info:
+            return jsonify({
+                "success": False,
+                "error": {
+                    "code": "INVALID_TOKEN",
+                    "message": "Invalid or expired bearer token"
+                }
+            }), 401
+        
+        # Token valid - add user info to request context
+        request.user_info = token_info
+        return f(*args, **kwargs)
+    
+    return decorated_function
+
+
+def hold_slot(slots, body):
+    """
+    Wrap a streamed body holding one of a semaphore's slots (already acquired)
+    
+    The slot is given back when the body ends, or by the returned release
+    callback when the response is closed before the body is read; the dev
+    server can skip the close when the client has gone away.
+    
+    Returns:
+        tuple: (wrapped body, release callback)
+    """
+    lock = threading.Lock()
+    held = [True]
+    
+    def release():
+        with lock:
+            if held[0]:
+                held[0] = False
+                slots.release()
+    
+    def chunks():
+        try:
+            yield from body
+        finally:
+            release()
+    
+    return chunks(), release
+
+
+def error_response(code, message, status, headers=None):
+    """Build an error response using the standard error envelope"""
+    response = jsonify({
+        "success": False,
+        "error": {
+            "code": code,
+            "message": message
+        }
+    })
+    response.status_code = status
+    if headers:
+        response.headers.update(headers)
+    return response
+
+
+def get_bearer_token_info():
+    """
+    Return token info for the request's bearer token, if any
+    Works whether or not REQUIRE_AUTH is enabled
+    """
+    auth_header = request.headers.get('Authorization', '')
+    if not auth_header.startswith('Bearer '):
+        return None
+    return validate_token(auth_header[7:])
+
+
+def require_admin(f):
+    """
+    Decorator to require a valid bearer token with the admin role
+    Always enforced, regardless of REQUIRE_AUTH
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        token_info = get_bearer_token_info()
+        if not token_info:
+            return error_response(
+                "UNAUTHORIZED", "A valid admin bearer token is required", 401
+            )
+        if token_info.get('role') != 'admin':
+            return error_response(
+                "FORBIDDEN", "This endpoint requires the admin role", 403
+            )
+        request.user_info = token_info
+        return f(*args, **kwargs)
+    
+    return decorated_function
+
+
+# ==================== REQUEST LOGGING ====================
+
+access_logger = logging.getLogger('mitel.access')
+
+
+@app.before_request
+def start_request_timer():
+    """Record when the request started, for the access log"""
+    request.start_time = time.perf_counter()
+
+
+@app.after_request
+def log_request(response):
+    """Count the request in its tenant's metrics and emit one structured access log record"""
+    latency_ms = (time.perf_counter() - request.start_time) * 1000
+    tenant = None
+    if request.path.startswith(BASE_PATH):
+        # Reporting requests count in the metrics of the tenant they read
+        tenant = current_tenant()
+        tenant.record_request(response.status_code, latency_ms, getattr(request, 'record_count', None))
+    if not access_logger.isEnabledFor(logging.INFO):
+        return response
+    user_info = getattr(request, 'user_info', None)
+    access_logger.info("%s %s %s", request.method, request.path, response.status_code, extra={
+        "fields": {
+            "event": "request",
+            "method": request.method,
+            "route": request.url_rule.rule if request.url_rule else None,
+            "path": request.path,
+            "status": response.status_code,
+            "latencyMs": round(latency_ms, 2),
+            "records": getattr(request, 'record_count', None),
+            "user": user_info['username'] if user_info else None,
+            "tenant": tenant.key if tenant is not None else None
+        }
+    })
+    return response
+
+
+# ==================== PROFILING ====================
+
+class StackSampler:
+    """
+    Sampling profiler that periodically captures Python stacks of selected
+    threads and aggregates them as folded stacks ("a;b;c count"), the input
+    format of flamegraph.pl, speedscope and inferno.
+    
+    Args:
+        interval: Sampling interval in seconds
+        targets: Callable returning {thread_id: root_label} to sample
+    """
+    
+    def __init__(self, interval, targets):
+        self.interval = interval
+        self.targets = targets
+        self.counts = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+    
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+        return self
+    
+    def stop(self):
+        self._stop.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+    
+    def snapshot(self):
+        """Return a copy of the aggregated folded stack counts"""
+        with self._lock:
+            return Counter(self.counts)
+    
+    def reset(self):
+        with self._lock:
+            self.counts.clear()
+            self.samples = 0
+    
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            targets = self.targets()
+            if not targets:
+                continue
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, label in targets.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        self.counts[fold_stack(frame, label)] += 1
+                        self.samples += 1
+    
+    def folded(self):
+        """Render aggregated stacks in folded format, hottest first"""
+        return '\n'.join(
+            f"{stack} {count}" for stack, count in self.snapshot().most_common()
+        )
+
+
+def fold_stack(frame, root=None):
+    """Render a frame's call stack root-first as a folded stack line"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    if root:
+        names.append(root)
+    return ';'.join(reversed(names))
+
+
+# Thread id -> route of the request it is currently serving
+_request_routes = {}
+_continuous_sampler = None
+_continuous_sampler_pid = None
+
+
+def get_continuous_sampler():
+    """
+    Return this worker's continuous sampler, starting it on first use
+    Started lazily so each gunicorn worker gets its own sampler thread after fork
+    """
+    global _continuous_sampler, _continuous_sampler_pid
+    if not PROFILING_CONTINUOUS:
+        return None
+    if _continuous_sampler is None or _continuous_sampler_pid != os.getpid():
+        with worker_init_lock:
+            if _continuous_sampler is None or _continuous_sampler_pid != os.getpid():
+                _continuous_sampler = StackSampler(
+                    PROFILE_CONTINUOUS_INTERVAL_MS / 1000.0,
+                    lambda: dict(_request_routes)
+                ).start()
+                _continuous_sampler_pid = os.getpid()
+    return _continuous_sampler
+
+
+def requested_profile_mode():
+    """
+    Return the profiling mode requested by the current request, if allowed
+    
+    Profiling is opt-in per request via ?profile=<mode> or X-Profile: <mode>
+    (mode: 'sample' or 'cprofile'), and is only honoured when PROFILING_ENABLED
+    is set and the bearer token belongs to an admin user.
+    """
+    mode = request.args.get('profile') or request.headers.get('X-Profile')
+    if not mode or not PROFILING_ENABLED:
+        return None
+    mode = mode.lower()
+    if mode in ('1', 'true'):
+        mode = 'sample'
+    if mode not in ('sample', 'cprofile'):
+        return None
+    token_info = get_bearer_token_info()
+    if not token_info or token_info.get('role') != 'admin':
+        return None
+    return mode
+
+
+@app.before_request
+def start_request_profiling():
+    """Register the request route for sampling and start on-demand profilers"""
+    route = request.url_rule.rule if request.url_rule else request.path
+    if get_continuous_sampler():
+        _request_routes[threading.get_ident()] = route
+    
+    mode = requested_profile_mode()
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        request.profiler = ('cprofile', profiler)
+    elif mode == 'sample':
+        thread_id = threading.get_ident()
+        sampler = StackSampler(
+            PROFILE_SAMPLE_INTERVAL_MS / 1000.0,
+            lambda: {thread_id: route}
+        ).start()
+        request.profiler = ('sample', sampler)
+
+
+def purge_profiles():
+    """Delete all but the PROFILE_RETENTION most recent profiles"""
+    try:
+        entries = sorted(os.scandir(PROFILE_DIR), key=lambda entry: entry.stat().st_mtime, reverse=True)
+    except OSError:
+        return
+    for entry in entries[PROFILE_RETENTION:]:
+        try:
+            os.unlink(entry.path)
+        except OSError:
+            pass
+
+
+def stop_request_profiler(profiler, profile_id, path):
+    """Stop a request's profiler and store its output under profile_id"""
+    mode, profiler = profiler
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    if mode == 'cprofile':
+        profiler.disable()
+        profiler.dump_stats(os.path.join(PROFILE_DIR, f"{profile_id}.prof"))
+    else:
+        profiler.stop()
+        with open(os.path.join(PROFILE_DIR, f"{profile_id}.folded"), 'w') as f:
+            f.write(profiler.folded())
+    purge_profiles()
+    
+    logger.info("Stored %s profile %s for %s", mode, profile_id, path)
+
+
+@app.after_request
+def finish_request_profiling(response):
+    """
+    Attach the profile id of an on-demand profiled request
+    
+    Streamed bodies (/reporting/calls/stream, /reporting/calls/export) are
+    generated after the request ends, so their profiler and route
+    registration are kept until the response is closed.
+    """
+    thread_id = threading.get_ident()
+    if response.is_streamed and thread_id in _request_routes:
+        request.sampled_until_close = True
+        response.call_on_close(partial(_request_routes.pop, thread_id, None))
+    if hasattr(request, 'profiler'):
+        profiler = request.profiler
+        del request.profiler
+        profile_id = uuid.uuid4().hex
+        if response.is_streamed:
+            response.call_on_close(partial(stop_request_profiler, profiler, profile_id, request.path))
+        else:
+            stop_request_profiler(profiler, profile_id, request.path)
+        response.headers['X-Profile-Id'] = profile_id
+        response.headers['X-Profile-Url'] = f"/admin/profiles/{profile_id}"
+    return response
+
+
+@app.teardown_request
+def cleanup_request_profiling(exc=None):
+    """Make sure profilers and route registrations never outlive the request"""
+    if not getattr(request, 'sampled_until_close', False):
+        _request_routes.pop(threading.get_ident(), None)
+    if hasattr(request, 'profiler'):
+        stop_request_profiler(request.profiler, uuid.uuid4().hex, request.path)
+
+
+# ==================== ADMISSION CONTROL ====================
+
+class AdmissionController:
+    """
+    Per-worker admission control
+    
+    Tracks in-flight requests, queueing delay (from the proxy's X-Request-Start
+    header) and an EWMA of service time per route. A request is rejected up
+    front when its expected latency (queueing delay + typical service time)
+    or the number of in-flight requests exceeds its class budget, so that
+    admitted requests finish within the latency target instead of piling up
+    until the gunicorn/nginx timeouts fire.
+    
+    Service times are only measured on admitted requests, so a route shed
+    for its service time lets one probe request through every probe_seconds
+    to refresh the estimate.
+    """
+    
+    EWMA_ALPHA = 0.2
+    
+    def __init__(self, latency_target_ms, max_inflight, probe_seconds=ADMISSION_PROBE_SECONDS):
+        self.latency_target_ms = latency_target_ms
+        self.max_inflight = max_inflight
+        self.probe_seconds = probe_seconds
+        self.in_flight = 0
+        self.shed = 0
+        self.service_ms = {}
+        # Route -> when its last admitted request started or finished
+        self.active_at = {}
+        self.queue_delay_ms = 0.0
+        self._lock = threading.Lock()
+    
+    def admit(self, route, priority, queue_delay_ms):
+        """
+        Decide whether to serve a request
+        
+        Returns:
+            float or None: None to admit, else suggested Retry-After seconds
+        """
+        now = time.monotonic()
+        with self._lock:
+            self.queue_delay_ms += self.EWMA_ALPHA * (queue_delay_ms - self.queue_delay_ms)
+            if priority > 0:
+                share = ADMISSION_BUDGET_SHARE.get(priority, 1.0)
+                expected_ms = queue_delay_ms + self.service_ms.get(route, 0.0)
+                probe = (queue_delay_ms <= self.latency_target_ms * share
+                         and now - self.active_at.get(route, 0.0) >= self.probe_seconds)
+                if ((expected_ms > self.latency_target_ms * share and not probe)
+                        or self.in_flight >= max(1, int(self.max_inflight * share))):
+                    self.shed += 1
+                    return max(1.0, (self.queue_delay_ms + expected_ms) / 1000.0)
+            self.in_flight += 1
+            self.active_at[route] = now
+            return None
+    
+    def release(self, route, service_ms=None):
+        """
+        Mark an admitted request finished and update its route's service time
+        (None: the request was not served, e.g. rate limited)
+        """
+        with self._lock:
+            self.in_flight -= 1
+            self.active_at[route] = time.monotonic()
+            if service_ms is None:
+                return
+            previous = self.service_ms.get(route)
+            if previous is None:
+                self.service_ms[route] = service_ms
+            else:
+                self.service_ms[route] = previous + self.EWMA_ALPHA * (service_ms - previous)
+
+
+admission = AdmissionController(ADMISSION_LATENCY_TARGET_MS, ADMISSION_MAX_INFLIGHT)
+
+
+def request_queue_delay_ms():
+    """
+    Time the request waited before reaching the worker, in milliseconds
+    Read from X-Request-Start ("t=<epoch seconds|ms|us>", as set by nginx)
+    """
+    header = request.headers.get('X-Request-Start')
+    if not header:
+        return 0.0
+    try:
+        started = float(header.replace('t=', '').strip())
+    except ValueError:
+        return 0.0
+    # Normalize microseconds / milliseconds to seconds
+    while started > 1e11:
+        started /= 1000.0
+    return max(0.0, (time.time() - started) * 1000)
+
+
+@app.before_request
+def admit_request():
+    """Shed requests that cannot be served within the latency target"""
+    if not ADMISSION_CONTROL_ENABLED or request.url_rule is None:
+        return None
+    route = request.url_rule.rule
+    retry_after = admission.admit(route, ROUTE_PRIORITIES.get(route, 1), request_queue_delay_ms())
+    if retry_after is not None:
+        return error_response(
+            "SERVICE_OVERLOADED",
+            "Server is overloaded. Retry later",
+            503,
+            headers={'Retry-After': str(math.ceil(retry_after))}
+        )
+    request.admitted_route = route
+    return None
+
+
+@app.teardown_request
+def release_admission(exc=None):
+    """Release the in-flight slot of an admitted request"""
+    route = getattr(request, 'admitted_route', None)
+    if route is not None:
+        del request.admitted_route
+        if getattr(request, 'rate_limited', False):
+            # Rejected before any work: not a service time sample
+            admission.release(route)
+            return
+        # Long-poll waits are idle time, not service time
+        idle_ms = getattr(request, 'idle_ms', 0.0)
+        admission.release(route, (time.perf_counter() - request.start_time) * 1000 - idle_ms)
+
+
+# ==================== RATE LIMITING ====================
+
+class MappedTable:
+    """
+    Fixed-size hash table of `SLOT` structs inside a memory-mapped file
+    
+    Every worker process maps the same file, so its state is shared by all
+    gunicorn workers; subclasses update slots under a file lock (processes)
+    plus a thread lock.
+    
+    Args:
+        path: Backing file, created and sized on first use
+        slots: Number of slots in the table
+    """
+    
+    SLOT = None
+    
+    def __init__(self, path, slots):
+        self.path = path
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._fd = None
+        self._map = None
+        self._pid = None
+    
+    def _open(self):
+        # Reopen after fork so each process holds its own lock descriptor
+        if self._pid == os.getpid():
+            return
+        size = self.SLOT.size * self.slots
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(fd).st_size != size:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(fd).st_size != size:
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, size)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        self._fd = fd
+        self._map = mmap.mmap(fd, size)
+        self._pid = os.getpid()
+    
+    @staticmethod
+    def key_hash(key):
+        digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'little') or 1
+
+
+class SharedTokenBuckets(MappedTable):
+    """
+    Token buckets in a fixed-size hash table inside a memory-mapped file
+    
+    Limits hold across gunicorn workers. Each slot is (key hash, tokens,
+    last update); a key probes a few consecutive slots and, when none
+    match, reuses the least recently updated one. Updates are O(1).
+    """
+    
+    SLOT = struct.Struct('<Qdd')
+    PROBES = 8
+    
+    def consume(self, key, capacity, refill_rate, cost=1):
+        """
+        Take `cost` tokens from the bucket for `key`
+        
+        A cost larger than the bucket is allowed from a full bucket and
+        charged in full: the balance goes negative, and the debt is paid
+        back by refilling before the next request is allowed.
+        
+        Returns:
+            tuple: (allowed, retry_after_seconds, tokens_left)
+        """
+        cost = max(0, cost)
+        required = min(cost, capacity)
+        key_hash = self.key_hash(key)
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                offset, tokens, updated = self._find(key_hash, capacity, now)
+                tokens = min(capacity, tokens + (now - updated) * refill_rate)
+                allowed = tokens >= required
+                if allowed:
+                    tokens -= cost
+                self.SLOT.pack_into(self._map, offset, key_hash, tokens, now)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        retry_after = 0 if allowed else (required - tokens) / refill_rate
+        return allowed, retry_after, tokens
+    
+    def _find(self, key_hash, capacity, now):
+        start = key_hash % self.slots
+        victim = None
+        for i in range(self.PROBES):
+            offset = ((start + i) % self.slots) * self.SLOT.size
+            slot_hash, tokens, updated = self.SLOT.unpack_from(self._map, offset)
+            if slot_hash == key_hash:
+                return offset, tokens, updated
+            if victim is None or updated < victim[1]:
+                victim = (offset, updated)
+        # New key: start with a full bucket in the stalest probed slot
+        return victim[0], capacity, now
+
+
+class SharedCounters(MappedTable):
+    """
+    Counters per key in a memory-mapped hash table, summed over all workers
+    
+    Each slot is (key hash, first update, one double per field). Keys are
+    few (one per tenant), so a key probes the whole table and is never
+    evicted; updates to a full table are dropped.
+    
+    Args:
+        path: Backing file, created and sized on first use
+        fields: Counter names
+        slots: Number of slots in the table
+    """
+    
+    def __init__(self, path, fields, slots=256):
+        super().__init__(path, slots)
+        self.fields = tuple(fields)
+        self.SLOT = struct.Struct(f'<Qd{len(self.fields)}d')
+    
+    def add(self, key, **amounts):
+        """Add amounts to the counters of `key`"""
+        key_hash = self.key_hash(key)
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                offset, values = self._find(key_hash)
+                if offset is None:
+                    return
+                if not values[0]:
+                    values[0] = time.time()
+                for i, name in enumerate(self.fields):
+                    values[1 + i] += amounts.get(name, 0)
+                self.SLOT.pack_into(self._map, offset, key_hash, *values)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+    
+    def read(self, key):
+        """
+        Counters of `key` over all workers
+        
+        Returns:
+            tuple: (first update as time.time(), or None, {field: value})
+        """
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_SH)
+            try:
+                _, values = self._find(self.key_hash(key))
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        return values[0] or None, dict(zip(self.fields, values[1:]))
+    
+    def _find(self, key_hash):
+        """Offset and values of the key's slot, or of a free one (offset None if full)"""
+        start = key_hash % self.slots
+        for i in range(self.slots):
+            offset = ((start + i) % self.slots) * self.SLOT.size
+            slot_hash, *values = self.SLOT.unpack_from(self._map, offset)
+            if slot_hash == key_hash:
+                return offset, values
+            if not slot_hash:
+                return offset, [0.0] * (1 + len(self.fields))
+        return None, [0.0] * (1 + len(self.fields))
+
+
+# Request metrics of each tenant (Tenant.record_request), shared by all workers
+tenant_metrics = SharedCounters(TENANT_METRICS_FILE, ("requests", "errors", "records", "latencyMs"))
+
+
+def load_rate_limits():
+    """Load rate limit rules from RATE_LIMITS_FILE, or use the defaults"""
+    if RATE_LIMITS_FILE:
+        with open(RATE_LIMITS_FILE, 'r') as f:
+            return json.load(f)
+    return DEFAULT_RATE_LIMITS
+
+
+rate_limits = load_rate_limits()
+_resolved_rate_limits = {}
+
+
+def resolve_rate_limit(route, role, tenant=None):
+    """
+    Merge the rules that apply to a route and role (most specific wins),
+    then the tenant's own rules for them (see DEFAULT_TENANTS rateLimits)
+    Resolved once per (route, role, tenant)
+    """
+    tenant = tenant or default_tenant
+    cache_key = (route, role, tenant.key)
+    rule = _resolved_rate_limits.get(cache_key)
+    if rule is None:
+        rule = {"key": RATE_LIMIT_KEY}
+        for rules in (rate_limits, tenant.rate_limits or {}):
+            for route_key in ("*", route):
+                route_rules = rules.get(route_key, {})
+                for role_key in ("*", role):
+                    rule.update(route_rules.get(role_key, {}))
+        _resolved_rate_limits[cache_key] = rule
+    return rule
+
+
+def rate_limit_identity(kind, token_info):
+    """Bucket identity for the client: token, username or account id"""
+    if token_info:
+        if kind == 'account':
+            return f"account:{token_info['account_id']}"
+        if kind == 'user':
+            return f"user:{token_info['username']}"
+        auth_header = request.headers.get('Authorization', '')
+        return f"token:{auth_header[7:]}"
+    # Anonymous clients (auth disabled or missing token) are keyed by address.
+    # Clients can send their own X-Forwarded-For entries, so only the ones
+    # appended by our proxies are trusted.
+    forwarded = [entry.strip() for entry in request.headers.get('X-Forwarded-For', '').split(',')]
+    if RATE_LIMIT_PROXY_HOPS and len(forwarded) >= RATE_LIMIT_PROXY_HOPS:
+        address = forwarded[-RATE_LIMIT_PROXY_HOPS]
+    else:
+        address = request.remote_addr
+    return f"ip:{address or request.remote_addr}"
+
+
+def record_cost(limit, default, maximum):
+    """
+    Quota cost of a requested limit: clamped to 1..maximum, so a zero or
+    negative limit never refills the bucket (0 if it is not a number)
+    """
+    try:
+        return max(1, min(int(limit if limit is not None else default), maximum))
+    except (ValueError, TypeError):
+        return 0
+
+
+def requested_record_count(route):
+    """Records a request will generate, used as its quota cost"""
+    if route == f"{BASE_PATH}/reporting/batch":
+        data = request.get_json(silent=True) or {}
+        queries = data.get('queries') if isinstance(data, dict) else None
+        total = 0
+        for query in queries if isinstance(queries, list) else []:
+            sub_route = BATCH_RECORD_ROUTES.get(query.get('route')) if isinstance(query, dict) else None
+            if sub_route:
+                params = query.get('params') if isinstance(query.get('params'), dict) else {}
+                total += record_cost(params.get('limit'), *ROUTE_RECORD_LIMITS[sub_route])
+        return total
+    if route == f"{BASE_PATH}/reporting/calls/stream" and 'speed' in request.args:
+        return replay_record_limit(request.args, current_tenant())
+    limits = ROUTE_RECORD_LIMITS.get(route)
+    if not limits:
+        return 0
+    default, maximum = limits
+    if route == f"{BASE_PATH}/reporting/calls/export":
+        default, maximum = export_limits(request.args.get('format', 'csv').lower())
+    return record_cost(request.args.get('limit'), default, maximum)
+
+
+@app.before_request
+def enforce_rate_limits():
+    """Reject requests over their request rate or record quota with 429"""
+    if not RATE_LIMIT_ENABLED or request.method == 'OPTIONS' or cluster_shard() is not None:
+        return None
+    route = request.url_rule.rule if request.url_rule else None
+    if route is None or route in RATE_LIMIT_EXEMPT:
+        return None
+    
+    token_info = get_bearer_token_info()
+    role = token_info.get('role', 'user') if token_info else 'anonymous'
+    tenant = current_tenant()
+    rule = resolve_rate_limit(route, role, tenant)
+    identity = rate_limit_identity(rule["key"], token_info)
+    
+    if rule.get("rate"):
+        allowed, retry_after, _ = tenant.rate_limit_buckets.consume(
+            f"req:{route}:{identity}", rule.get("burst", rule["rate"]), rule["rate"]
+        )
+        if not allowed:
+            request.rate_limited = True
+            return error_response(
+                "RATE_LIMITED",
+                f"Too many requests. Retry after {math.ceil(retry_after)} seconds",
+                429,
+                headers={'Retry-After': str(math.ceil(retry_after))}
+            )
+    
+    records = requested_record_count(route)
+    if records and rule.get("recordsPerMinute"):
+        quota = rule["recordsPerMinute"]
+        allowed, retry_after, _ = tenant.rate_limit_buckets.consume(
+            f"rec:{identity}", quota, quota / 60.0, records
+        )
+        if not allowed:
+            request.rate_limited = True
+            return error_response(
+                "QUOTA_EXCEEDED",
+                f"Record quota of {quota} per minute exceeded. "
+                f"Retry after {math.ceil(retry_after)} seconds",
+                429,
+                headers={'Retry-After': str(math.ceil(retry_after))}
+            )
+    return None
+
+
+# ==================== REQUEST COALESCING ====================
+
+class CapturedResponse:
+    """An encoded response that can be replayed for duplicate requests"""
+    
+    __slots__ = ('status', 'headers', 'body', 'records')
+    
+    def __init__(self, status, headers, body, records):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.records = records
+    
+    @classmethod
+    def capture(cls, response):
+        """Capture a view's return value (Response or (Response, status))"""
+        response = app.make_response(response)
+        return cls(response.status_code, list(response.headers.items()),
+                   response.get_data(), getattr(request, 'record_count', None))
+    
+    def to_response(self, coalesced=False):
+        response = Response(self.body, status=self.status, headers=self.headers)
+        if coalesced:
+            response.headers['X-Coalesced'] = 'true'
+        return response
+
+
+class SingleFlight:
+    """
+    Runs each distinct query once at a time
+    
+    The first request for a key computes; requests for the same key that
+    arrive while it runs wait and get its captured response. Between threads
+    of a worker this is an in-memory table of in-flight keys. Across workers
+    (shared_dir set), the leader holds an flock on its key's stripe lock
+    file and writes its key digest into it. Duplicates announce themselves
+    in the stripe's wait file and poll the lock while the digest is theirs;
+    a request whose stripe is held for another key computes at once instead
+    of queueing behind it. When the leader finishes and sees waiters, it
+    writes its response to the stripe's result file. Each waiter then reuses
+    that response if it is for the same key and completed after the waiter
+    arrived, and computes otherwise.
+    
+    Args:
+        shared_dir: Directory of the stripe files, or None for in-worker only
+        stripes: Number of stripe lock/result file pairs
+        timeout: Longest a duplicate waits before computing itself (seconds)
+    """
+    
+    def __init__(self, shared_dir=None, stripes=256, timeout=30.0):
+        self.shared_dir = shared_dir
+        self.stripes = stripes
+        self.timeout = timeout
+        self.computed = 0
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+        if shared_dir:
+            os.makedirs(shared_dir, exist_ok=True)
+    
+    def run(self, key, compute):
+        """
+        Compute a CapturedResponse for key, or share a concurrent one
+        
+        Returns:
+            tuple: (CapturedResponse, True if computed by another request)
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = {"done": threading.Event(), "result": None}
+        
+        if not leader:
+            flight["done"].wait(self.timeout)
+            if flight["result"] is not None:
+                self.coalesced += 1
+                return flight["result"], True
+            return self._compute(compute), False
+        
+        try:
+            if self.shared_dir:
+                result, shared = self._run_shared(key, compute)
+            else:
+                result, shared = self._compute(compute), False
+            flight["result"] = result
+            return result, shared
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight["done"].set()
+    
+    def _compute(self, compute):
+        self.computed += 1
+        return compute()
+    
+    def _run_shared(self, key, compute):
+        """Single-flight across workers through the key's stripe files"""
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        stripe = os.path.join(self.shared_dir, f"{int(digest[:8], 16) % self.stripes:04d}")
+        arrived = time.time()
+        
+        with open(stripe + '.lock', 'a+b') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                with open(stripe + '.wait', 'ab') as wait_file:
+                    wait_file.write(b'.')
+                held, result = self._wait_for_leader(lock_file, stripe, digest, arrived)
+                if result is not None:
+                    if held:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+                    self.coalesced += 1
+                    return result, True
+                if not held:
+                    return self._compute(compute), False
+            
+            try:
+                os.ftruncate(lock_file.fileno(), 0)
+                os.write(lock_file.fileno(), digest.encode())
+                result = self._compute(compute)
+                if os.path.exists(stripe + '.wait') and os.path.getsize(stripe + '.wait'):
+                    self._write_result(stripe, digest, result)
+                return result, False
+            finally:
+                os.ftruncate(lock_file.fileno(), 0)
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    
+    def _wait_for_leader(self, lock_file, stripe, digest, arrived):
+        """
+        Poll for the stripe lock while its leader computes the same key
+        
+        Returns:
+            tuple: (True if the lock is now held, the leader's published
+                   response or None)
+        """
+        deadline = arrived + self.timeout
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True, self._read_result(stripe + '.result', digest, arrived)
+            except BlockingIOError:
+                pass
+            # An empty digest is a leader that has not written it yet
+            leader = os.pread(lock_file.fileno(), len(digest), 0).decode()
+            if (leader and leader != digest) or time.time() >= deadline:
+                # Ours may have finished before another key took the stripe
+                return False, self._read_result(stripe + '.result', digest, arrived)
+            time.sleep(0.002)
+    
+    @staticmethod
+    def _write_result(stripe, digest, result):
+        """Publish a response for waiting workers (atomically) and clear the wait file"""
+        header = json.dumps({
+            "key": digest,
+            "completedAt": time.time(),
+            "status": result.status,
+            "headers": result.headers,
+            "records": result.records
+        }).encode()
+        temporary = f"{stripe}.result.{os.getpid()}"
+        with open(temporary, 'wb') as f:
+            f.write(header + b'\n' + result.body)
+        os.replace(temporary, stripe + '.result')
+        with open(stripe + '.wait', 'wb'):
+            pass
+    
+    @staticmethod
+    def _read_result(path, digest, arrived):
+        """A published response for digest completed after `arrived`, or None"""
+        try:
+            with open(path, 'rb') as f:
+                header = json.loads(f.readline())
+                if header["key"] != digest or header["completedAt"] < arrived:
+                    return None
+                return CapturedResponse(header["status"], [tuple(h) for h in header["headers"]],
+                                        f.read(), header["records"])
+        except (OSError, ValueError, KeyError):
+            return None
+
+
+single_flight = SingleFlight(COALESCE_DIR if COALESCE_SHARED else None,
+                             COALESCE_STRIPES, COALESCE_TIMEOUT)
+
+
+def coalesce_key():
+    """Tenant, cluster shard, normalized route and query parameters of the current request"""
+    params = sorted((name, value) for name, value in request.args.items(multi=True) if name != 'profile')
+    return (f"{current_tenant().key} {cluster_shard()} {request.method} {request.path}"
+            f"?{json.dumps(params, separators=(',', ':'))}")
+
+
+def coalesced(f):
+    """Decorator: serve identical concurrent requests from one computation"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if not COALESCE_ENABLED or hasattr(request, 'profiler'):
+            return f(*args, **kwargs)
+        result, shared = single_flight.run(
+            coalesce_key(), lambda: CapturedResponse.capture(f(*args, **kwargs))
+        )
+        request.record_count = result.records
+        return result.to_response(coalesced=shared)
+    
+    return decorated
+
+
+# ==================== CLUSTER ====================
+
+CLUSTER_SIZE = max(len(CLUSTER_PEERS), 1)
+if CLUSTER_PEERS and not 0 <= CLUSTER_NODE < CLUSTER_SIZE:
+    raise ValueError(f"CLUSTER_NODE must be between 0 and {CLUSTER_SIZE - 1}")
+if CLUSTER_SHARD_BY not in ('hour', 'extension'):
+    raise ValueError(f"Unknown CLUSTER_SHARD_BY '{CLUSTER_SHARD_BY}' (use hour or extension)")
+
+# Longest a signed shard request stays valid (seconds)
+CLUSTER_SIGNATURE_MAX_AGE = 60
+
+
+def shard_owns_hour(shard, hour):
+    """Whether a cluster shard owns a timeline hour (always, unless sharding by hour)"""
+    return CLUSTER_SHARD_BY != 'hour' or hour % CLUSTER_SIZE == shard
+
+
+@lru_cache(maxsize=1024)
+def extension_shard(extension):
+    """Cluster shard owning an extension's calls when sharding by extension"""
+    digest = hashlib.blake2b(extension.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') % CLUSTER_SIZE
+
+
+def shard_owns_extension(shard, extension):
+    """Whether a cluster shard owns an extension's calls (always, unless sharding by extension)"""
+    return CLUSTER_SHARD_BY != 'extension' or extension_shard(extension) == shard
+
+
+class KeepAliveConnections:
+    """
+    Keep-alive HTTP connections to one server (a cluster peer or webhook
+    sink), reused across requests
+    
+    Up to `size` idle connections are kept; more are opened when needed and
+    closed after use. A request on a kept connection the peer has closed in
+    the meantime is retried once on a new one. Connections are never shared
+    with forked children.
+    
+    Args:
+        url: Server base URL (http or https, no path)
+        size: Idle connections kept
+        timeout: Connect and read timeout (seconds)
+        check_address: Function of the IP address a new connection reached,
+            returning why it must not be used (raised as PermissionError),
+            or None
+    """
+    
+    def __init__(self, url, size=CLUSTER_POOL_SIZE, timeout=CLUSTER_TIMEOUT, check_address=None):
+        parts = urllib.parse.urlsplit(url)
+        self.url = url
+        self.connection_class = (http.client.HTTPSConnection if parts.scheme == 'https'
+                                 else http.client.HTTPConnection)
+        self.host = parts.hostname
+        self.port = parts.port
+        self.size = size
+        self.timeout = timeout
+        self.check_address = check_address
+        self._idle = []
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+    
+    def _acquire(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked: the parent's sockets are not ours to use
+                self._idle = []
+                self._pid = os.getpid()
+            if self._idle:
+                return self._idle.pop(), True
+        return self.connection_class(self.host, self.port, timeout=self.timeout), False
+    
+    def _release(self, connection):
+        with self._lock:
+            if len(self._idle) < self.size and self._pid == os.getpid():
+                self._idle.append(connection)
+                return
+        connection.close()
+    
+    def request(self, method, target, headers, body=None):
+        """
+        Send a request for a path and query string to the server
+        
+        Returns:
+            tuple: (HTTP status, response headers, body bytes)
+        """
+        for attempt in range(2):
+            connection, reused = self._acquire()
+            try:
+                if not reused and self.check_address is not None:
+                    connection.connect()
+                    error = self.check_address(connection.sock.getpeername()[0])
+                    if error:
+                        raise PermissionError(error)
+                connection.request(method, target, body=body, headers=headers)
+                response = connection.getresponse()
+                content = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            except Exception:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(connection)
+            return response.status, response.headers, content
+    
+    def get(self, target, headers):
+        """
+        GET a path and query string from the server
+        
+        Returns:
+            tuple: (HTTP status, body bytes)
+        """
+        status, _, content = self.request('GET', target, headers)
+        return status, content
+
+
+cluster_peers = [KeepAliveConnections(url) for url in CLUSTER_PEERS]
+_cluster_pool = None
+_cluster_pool_pid = None
+
+
+def get_cluster_pool():
+    """Return this worker's thread pool for peer requests, creating it on first use"""
+    global _cluster_pool, _cluster_pool_pid
+    with worker_init_lock:
+        if _cluster_pool is None or _cluster_pool_pid != os.getpid():
+            _cluster_pool = ThreadPoolExecutor(max_workers=max(CLUSTER_SIZE - 1, 1) * CLUSTER_POOL_SIZE,
+                                               thread_name_prefix='cluster')
+            _cluster_pool_pid = os.getpid()
+        return _cluster_pool
+
+
+def shard_signature(shard, tenant_key, timestamp, path, query):
+    """HMAC over a shard request, so peers only answer other nodes (keyed by SECRET_KEY)"""
+    message = f"{shard}\n{tenant_key}\n{timestamp}\n{path}\n{query}".encode()
+    return hmac.new(SECRET_KEY.encode(), message, hashlib.sha256).hexdigest()
+
+
+def cluster_shard():
+    """
+    Shard a peer asked this node to answer for, or None for client requests
+    
+    Shard requests carry X-Cluster-Shard, X-Cluster-Tenant and a signed,
+    timestamped X-Cluster-Signature. A valid one also sets the request's
+    tenant; an invalid one is treated as a client request (and rejected by
+    reject_forged_shard_requests). Verified once per request.
+    """
+    if not has_request_context():
+        return None
+    shard = getattr(request, 'cluster_shard', False)
+    if shard is not False:
+        return shard
+    request.cluster_shard = None
+    header = request.headers.get('X-Cluster-Shard')
+    if header is None or not CLUSTER_PEERS:
+        return None
+    tenant_key = request.headers.get('X-Cluster-Tenant', '*')
+    timestamp, _, signature = request.headers.get('X-Cluster-Signature', '').partition('.')
+    try:
+        shard = int(header)
+        age = abs(time.time() - int(timestamp))
+    except ValueError:
+        return None
+    expected = shard_signature(shard, tenant_key, timestamp, request.path, request.query_string.decode())
+    if not 0 <= shard < CLUSTER_SIZE or age > CLUSTER_SIGNATURE_MAX_AGE or not hmac.compare_digest(signature, expected):
+        return None
+    request.cluster_shard = shard
+    request.tenant = tenants.get(tenant_key, default_tenant)
+    return shard
+
+
+@app.before_request
+def reject_forged_shard_requests():
+    """Answer shard requests that are not signed by a cluster node with 403"""
+    if 'X-Cluster-Shard' in request.headers and cluster_shard() is None:
+        return error_response(
+            "CLUSTER_AUTH_FAILED", "Shard requests must be signed by a cluster node", 403
+        )
+    return None
+
+
+def fetch_shard(shard, tenant_key, path, query):
+    """
+    Run a query on the peer owning a shard (cluster pool thread)
+    
+    Returns:
+        tuple: (response payload, HTTP status)
+    
+    Raises:
+        OSError, http.client.HTTPException, ValueError: If the peer is
+        unreachable, times out or fails
+    """
+    timestamp = str(int(time.time()))
+    headers = {
+        "X-Cluster-Shard": str(shard),
+        "X-Cluster-Tenant": tenant_key,
+        "X-Cluster-Signature": f"{timestamp}.{shard_signature(shard, tenant_key, timestamp, path, query)}"
+    }
+    status, body = cluster_peers[shard].get(f"{path}?{query}", headers)
+    if status >= 500:
+        raise ValueError(f"HTTP {status}")
+    return json.loads(body), status
+
+
+def scatter(path, params, local):
+    """
+    Run a query on every cluster shard in parallel
+    
+    This node's shard runs in the calling thread; the others are sent to
+    their peers as signed shard requests over pooled keep-alive connections.
+    Every node can compute any shard (timelines are deterministic), so the
+    shard of a peer that fails or times out is computed here instead of
+    failing the query.
+    
+    Args:
+        path: Route path of the query
+        params: Query parameters (dict) sent to every shard
+        local: Function of a shard returning its (payload, HTTP status) here
+    
+    Returns:
+        list: (payload, HTTP status) by shard
+    """
+    tenant_key = current_tenant().key
+    query = urllib.parse.urlencode(sorted((name, value) for name, value in params.items() if value is not None))
+    pool = get_cluster_pool()
+    futures = {
+        shard: pool.submit(fetch_shard, shard, tenant_key, path, query)
+        for shard in range(CLUSTER_SIZE) if shard != CLUSTER_NODE
+    }
+    results = [None] * CLUSTER_SIZE
+    results[CLUSTER_NODE] = local(CLUSTER_NODE)
+    for shard, future in futures.items():
+        try:
+            results[shard] = future.result()
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            logger.warning("Cluster peer %s failed (%s); computing shard %d locally",
+                           CLUSTER_PEERS[shard], e, shard)
+            results[shard] = local(shard)
+    return results
+
+
+def gather_call_records(args):
+    """
+    Answer a /reporting/calls page by scatter-gather across the cluster
+    
+    Every shard scans the page from the same start, with the query pinned
+    in a cursor so all shards resolve the same window, and reports its
+    records' slots and where its scan stopped. Below the earliest stop of a
+    shard with more to scan, every shard's records are known: the page is
+    the first `limit` of them in slot order and the next cursor resumes
+    after the last one, so pages and cursors are a single node's. First
+    pages with an offset are counted out on this node.
+    
+    Returns:
+        tuple: (response payload, HTTP status)
+    """
+    if args.get('offset') and not args.get('cursor'):
+        return query_call_records(args)
+    limit = min(int(args.get('limit', 50)), 500)
+    state, error = resolve_calls_query(args, current_tenant())
+    if error:
+        return error
+    if state.get('skip'):
+        # Cursor of a page still counting out its offset
+        return query_call_records(args)
+    params = {"cursor": encode_cursor(state), "limit": limit}
+    results = scatter(f"{BASE_PATH}/reporting/calls", params,
+                      lambda shard: query_call_records(params, shard=shard))
+    for payload, status in results:
+        if status != 200:
+            return payload, status
+    
+    cutoff = min((payload["shard"]["nextSlot"] for payload, _ in results
+                  if payload["pagination"]["hasMore"]), default=None)
+    merged = sorted(
+        ((slot, record) for payload, _ in results
+         for slot, record in zip(payload["shard"]["slots"], payload["data"])
+         if cutoff is None or slot < cutoff),
+        key=lambda item: item[0]
+    )
+    page = merged[:limit]
+    next_slot = page[-1][0] + 1 if len(merged) > limit else cutoff
+    
+    payload = results[CLUSTER_NODE][0]
+    del payload["shard"]
+    payload["data"] = [record for _, record in page]
+    payload["pagination"].update({
+        "total": len(page),
+        "hasMore": next_slot is not None,
+        "nextCursor": encode_cursor(dict(state, slot=next_slot)) if next_slot is not None else None
+    })
+    return payload, 200
+
+
+def gather_statistics_sketches(window_start, window_end, extension=None):
+    """
+    Merge every cluster shard's call metric digests and call counters over a window
+    
+    Returns:
+        tuple: ({field: TDigest}, {counter: value})
+    """
+    params = {"startDate": window_start.isoformat(), "endDate": window_end.isoformat(),
+              "extension": extension}
+    results = scatter(f"{BASE_PATH}/reporting/statistics", params,
+                      lambda shard: query_statistics(params, shard=shard))
+    parts = {name: [] for name in SKETCH_FIELDS}
+    counts = dict.fromkeys(CALL_COUNTERS, 0)
+    for payload, status in results:
+        if status != 200:
+            raise ValueError(payload["error"]["message"])
+        for name, digest in payload["shard"]["sketches"].items():
+            parts[name].append(TDigest.deserialize(digest))
+        for name, value in payload["shard"]["counts"].items():
+            counts[name] += value
+    return {name: TDigest.merged(digests) for name, digests in parts.items()}, counts
+
+
+# ==================== FAULT INJECTION ====================
+
+# Parameters of each latencyMs distribution
+LATENCY_DISTRIBUTIONS = {
+    "uniform": ("min", "max"),
+    "exponential": ("mean",),
+    "lognormal": ("median", "p99")
+}
+
+# Injectable error statuses: (error code, message)
+FAULT_ERRORS = {
+    429: ("RATE_LIMITED", "Too many requests. Retry after 1 seconds"),
+    500: ("INTERNAL_ERROR", "Internal server error"),
+    502: ("BAD_GATEWAY", "Bad gateway"),
+    503: ("SERVICE_UNAVAILABLE", "Service temporarily unavailable"),
+    504: ("GATEWAY_TIMEOUT", "Gateway timeout")
+}
+
+FAULT_RATES = ("errorRate", "tokenExpiryRate", "disconnectRate")
+
+# Seconds between throttled writes
+FAULT_THROTTLE_INTERVAL = 0.1
+
+# Bodies of unknown length are cut off within this many bytes
+FAULT_DISCONNECT_MAX_BYTES = 1 << 20
+
+
+class InjectedDisconnect(Exception):
+    """Raised from a response body to drop the connection mid-transfer"""
+
+
+def validate_fault_profiles(profiles):
+    """
+    Check fault profiles (see DEFAULT_FAULT_PROFILES)
+    
+    Raises:
+        ValueError: If a route's faults are malformed
+    """
+    def number(value, minimum=0):
+        return isinstance(value, (int, float)) and not isinstance(value, bool) and value >= minimum
+    
+    if not isinstance(profiles, dict):
+        raise ValueError("Fault profiles must be an object of route -> faults")
+    for route, faults in profiles.items():
+        if not isinstance(faults, dict):
+            raise ValueError(f"Faults of '{route}' must be an object")
+        for name, value in faults.items():
+            if name == "latencyMs":
+                if isinstance(value, dict):
+                    distribution = value.get("distribution")
+                    params = LATENCY_DISTRIBUTIONS.get(distribution)
+                    if params is None:
+                        raise ValueError(f"latencyMs distribution of '{route}' must be one of: "
+                                         f"{', '.join(LATENCY_DISTRIBUTIONS)}")
+                    if not all(number(value.get(param)) for param in params):
+                        raise ValueError(f"{distribution} latencyMs of '{route}' needs non-negative "
+                                         f"{', '.join(params)}")
+                elif not number(value):
+                    raise ValueError(f"latencyMs of '{route}' must be a non-negative number or a distribution")
+            elif name in FAULT_RATES:
+                if not number(value) or value > 1:
+                    raise ValueError(f"{name} of '{route}' must be between 0 and 1")
+            elif name == "errorStatuses":
+                if not isinstance(value, list) or not value or not all(status in FAULT_ERRORS for status in value):
+                    raise ValueError(f"errorStatuses of '{route}' must be a list of: "
+                                     f"{', '.join(map(str, FAULT_ERRORS))}")
+            elif name == "bandwidthBytesPerSecond":
+                if not number(value, 1):
+                    raise ValueError(f"bandwidthBytesPerSecond of '{route}' must be at least 1")
+            else:
+                raise ValueError(f"Unknown fault '{name}' for '{route}'")
+
+
+def load_fault_profiles():
+    """Load fault profiles from FAULT_PROFILES_FILE, or use the defaults"""
+    profiles = DEFAULT_FAULT_PROFILES
+    if FAULT_PROFILES_FILE:
+        with open(FAULT_PROFILES_FILE, 'r') as f:
+            profiles = json.load(f)
+    validate_fault_profiles(profiles)
+    return profiles
+
+
+def sample_latency_ms(latency, rng=random):
+    """Draw a delay from a latencyMs setting"""
+    if not isinstance(latency, dict):
+        return latency
+    distribution = latency["distribution"]
+    if distribution == "uniform":
+        return rng.uniform(latency["min"], latency["max"])
+    if distribution == "exponential":
+        return rng.expovariate(1 / latency["mean"]) if latency["mean"] else 0
+    if latency["median"] <= 0:
+        return 0
+    # Lognormal through the median and 99th percentile (z = 2.326)
+    sigma = max(math.log(max(latency["p99"], latency["median"]) / latency["median"]), 0) / 2.326
+    return rng.lognormvariate(math.log(latency["median"]), sigma)
+
+
+class FaultProfiles:
+    """
+    Active fault profiles, shared by all workers through FAULT_STATE_FILE
+    
+    PUT /admin/faults replaces the file; every worker re-reads it when its
+    modification time changes, checking at most once per CHECK_INTERVAL, so
+    new profiles reach all workers within a second without restarting.
+    """
+    
+    CHECK_INTERVAL = 1.0
+    
+    def __init__(self, path, profiles):
+        self.path = path
+        self.profiles = profiles
+        self._resolved = {}
+        self._mtime = None
+        self._checked = 0.0
+    
+    def publish(self, profiles):
+        """Make validated profiles the active ones in every worker"""
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        write_json_atomic(self.path, profiles)
+        self._use(profiles, os.stat(self.path).st_mtime_ns)
+    
+    def _use(self, profiles, mtime):
+        self.profiles = profiles
+        self._resolved = {}
+        self._mtime = mtime
+    
+    def current(self):
+        """Active profiles, picking up changes published by other workers"""
+        now = time.monotonic()
+        if now - self._checked >= self.CHECK_INTERVAL:
+            self._checked = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+                if mtime != self._mtime:
+                    with open(self.path, 'r') as f:
+                        profiles = json.load(f)
+                    validate_fault_profiles(profiles)
+                    self._use(profiles, mtime)
+            except (OSError, ValueError) as e:
+                logger.warning("Keeping current fault profiles, cannot read %s: %s", self.path, e)
+        return self.profiles
+    
+    def resolve(self, route):
+        """Faults of a route, merged over the '*' route key by key"""
+        profiles = self.current()
+        resolved = self._resolved
+        faults = resolved.get(route)
+        if faults is None:
+            faults = {}
+            for route_key in ("*", route):
+                faults.update(profiles.get(route_key, {}))
+            resolved[route] = faults
+        return faults
+
+
+fault_profiles = FaultProfiles(FAULT_STATE_FILE, load_fault_profiles())
+if multiprocessing.parent_process() is None:
+    # Pool processes import the app too: only servers reset the shared profiles
+    fault_profiles.publish(fault_profiles.profiles)
+
+
+def fault_exempt(route):
+    """Routes that never get faults, so the mock can always be checked and reconfigured"""
+    return route in ("/", "/health") or route.startswith("/admin/")
+
+
+@app.before_request
+def inject_request_faults():
+    """
+    Draw the current request's faults from its route's profile: a delay
+    (applied to the response body, see apply_response_faults), an expired
+    token or an error response
+    """
+    if request.method == 'OPTIONS' or request.url_rule is None:
+        return None
+    route = request.url_rule.rule
+    if fault_exempt(route) or cluster_shard() is not None:
+        return None
+    faults = fault_profiles.resolve(route)
+    if not faults:
+        return None
+    
+    request.faults = faults
+    request.fault_labels = []
+    delay = min(sample_latency_ms(faults.get("latencyMs", 0)) / 1000, FAULT_MAX_DELAY_SECONDS)
+    request.fault_delay = delay
+    if delay:
+        request.fault_labels.append(f"latency={round(delay * 1000)}ms")
+    
+    auth_header = request.headers.get('Authorization', '')
+    if auth_header.startswith('Bearer ') and random.random() < faults.get("tokenExpiryRate", 0):
+        revoke_token(auth_header[7:])
+        request.fault_labels.append("token-expiry")
+        return error_response("INVALID_TOKEN", "Invalid or expired bearer token", 401)
+    
+    if random.random() < faults.get("errorRate", 0):
+        status = random.choice(faults.get("errorStatuses", [500, 502, 503]))
+        code, message = FAULT_ERRORS[status]
+        request.fault_labels.append(f"error={status}")
+        headers = {'Retry-After': '1'} if status in (429, 503) else None
+        return error_response(code, message, status, headers=headers)
+    return None
+
+
+def faulty_body(body, delay, rate, cut):
+    """
+    Response body with injected faults
+    
+    The delay and the throttling sleep in the thread sending the body: with
+    gthread workers (see the gunicorn section of the README) a faulty
+    response holds one thread for up to FAULT_MAX_DELAY_SECONDS plus its
+    trickle time, with sync workers the whole worker.
+    
+    Args:
+        body: Original response iterable (closed when done)
+        delay: Seconds to wait before the first byte
+        rate: Bytes per second to trickle the body at, or None
+        cut: Bytes after which the connection is dropped, or None
+    """
+    try:
+        if delay:
+            time.sleep(delay)
+        sent = 0
+        for chunk in body:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            step = max(int(rate * FAULT_THROTTLE_INTERVAL), 1) if rate else max(len(chunk), 1)
+            for start in range(0, len(chunk), step):
+                piece = chunk[start:start + step]
+                if cut is not None and sent + len(piece) > cut:
+                    if cut > sent:
+                        yield piece[:cut - sent]
+                    raise InjectedDisconnect(f"Injected disconnect after {cut} bytes")
+                yield piece
+                sent += len(piece)
+                if rate:
+                    time.sleep(len(piece) / rate)
+        if cut is not None:
+            raise InjectedDisconnect(f"Injected disconnect after {sent} bytes")
+    finally:
+        close = getattr(body, 'close', None)
+        if close is not None:
+            close()
+
+
+@app.after_request
+def apply_response_faults(response):
+    """
+    Apply the request's delay, bandwidth throttling and disconnect to the
+    response body
+    
+    The faults run while the server sends the body, after the request
+    context (and its admission slot) is released. With threaded or async
+    gunicorn workers (--threads / gevent) a delayed or trickled response
+    only holds a thread or greenlet. With FAULT_PROXY_THROTTLE, nginx
+    throttles the bandwidth from its response buffer and the worker is
+    released as soon as the body is buffered.
+    """
+    faults = getattr(request, 'faults', None)
+    if faults is None:
+        return response
+    
+    delay = request.fault_delay
+    rate = faults.get("bandwidthBytesPerSecond")
+    if rate and FAULT_PROXY_THROTTLE:
+        response.headers['X-Accel-Limit-Rate'] = str(int(rate))
+        request.fault_labels.append("throttle=proxy")
+        rate = None
+    elif rate:
+        request.fault_labels.append(f"throttle={int(rate)}B/s")
+    cut = None
+    if request.method != 'HEAD' and random.random() < faults.get("disconnectRate", 0):
+        length = response.content_length
+        cut = random.randint(0, max(length - 1, 0) if length is not None else FAULT_DISCONNECT_MAX_BYTES)
+        request.fault_labels.append("disconnect")
+    
+    if request.fault_labels:
+        response.headers['X-Fault-Injected'] = ','.join(request.fault_labels)
+    if delay or rate or cut is not None:
+        response.response = faulty_body(response.response, delay, rate, cut)
+    return response
+
+
+# ==================== WEBHOOK SUBSCRIPTIONS ====================
+
+# Dispatcher loop interval (seconds)
+WEBHOOK_TICK_SECONDS = 0.1
+
+# Delivery cursors and metrics are persisted at most this often (seconds)
+WEBHOOK_SAVE_SECONDS = 1.0
+
+# Timeline slots read per subscriber and tick, so a backfill cannot stall the others
+WEBHOOK_SCAN_SLOTS = 20000
+
+# Counters of a subscription's delivery metrics
+WEBHOOK_COUNTERS = ("deliveredBatches", "deliveredRecords", "failedAttempts", "retries",
+                    "droppedBatches", "droppedRecords")
+
+if WEBHOOK_DISPATCHER not in ('worker', 'external'):
+    raise ValueError(f"Unknown WEBHOOK_DISPATCHER '{WEBHOOK_DISPATCHER}' (use worker or external)")
+
+# WEBHOOK_ALLOWED_HOSTS, as networks and hostnames
+WEBHOOK_ALLOWED_NETWORKS = []
+WEBHOOK_ALLOWED_NAMES = set()
+for _host in WEBHOOK_ALLOWED_HOSTS:
+    try:
+        WEBHOOK_ALLOWED_NETWORKS.append(ipaddress.ip_network(_host, strict=False))
+    except ValueError:
+        WEBHOOK_ALLOWED_NAMES.add(_host)
+
+
+def webhook_address_error(address):
+    """Why webhooks may not be posted to an IP address, or None if they may"""
+    address = ipaddress.ip_address(address.split('%')[0])
+    if address.version == 6 and address.ipv4_mapped:
+        address = address.ipv4_mapped
+    if address.is_global or any(address in network for network in WEBHOOK_ALLOWED_NETWORKS):
+        return None
+    return f"{address} is not a public address (allow it with WEBHOOK_ALLOWED_HOSTS)"
+
+
+def webhook_host_error(hostname, port):
+    """
+    Why webhooks may not be posted to a host, or None if they may
+    
+    Hosts listed by name in WEBHOOK_ALLOWED_HOSTS are allowed; any other
+    host must only resolve to allowed addresses. Deliveries check the
+    address they connect to again, so a name re-resolving to a private
+    address later is refused too.
+    """
+    if hostname.lower() in WEBHOOK_ALLOWED_NAMES:
+        return None
+    try:
+        addresses = socket.getaddrinfo(hostname, port, type=socket.SOCK_STREAM)
+    except OSError as e:
+        return f"Cannot resolve {hostname}: {e}"
+    for *_, sockaddr in addresses:
+        error = webhook_address_error(sockaddr[0])
+        if error:
+            return f"{hostname}: {error}"
+    return None
+
+
+def webhook_path(subscription_id, suffix='json'):
+    """Path of a subscription's config ('json') or delivery state ('state.json') file"""
+    return os.path.join(WEBHOOK_DIR, f"{subscription_id}.{suffix}")
+
+
+def read_webhook(subscription_id, suffix='json'):
+    """A subscription's config or delivery state, or None if unknown"""
+    if not subscription_id or not all(c in '0123456789abcdef' for c in subscription_id):
+        return None
+    try:
+        with open(webhook_path(subscription_id, suffix)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def webhook_ids():
+    """Ids of all subscriptions"""
+    try:
+        names = os.listdir(WEBHOOK_DIR)
+    except FileNotFoundError:
+        return []
+    return [name[:-5] for name in names if name.endswith('.json') and name.count('.') == 1]
+
+
+class WebhookBatch:
+    """One encoded batch of a subscription, from creation until delivered or dropped"""
+    
+    __slots__ = ('sequence', 'end_slot', 'oldest', 'count', 'body', 'attempts', 'due', 'future', 'done')
+    
+    def __init__(self, sequence, end_slot, oldest, count, body):
+        self.sequence = sequence
+        self.end_slot = end_slot
+        self.oldest = oldest
+        self.count = count
+        self.body = body
+        self.attempts = 0
+        self.due = 0.0
+        self.future = None
+        self.done = False
+
+
+class WebhookSubscription:
+    """
+    Delivery of one subscription, in the dispatching worker
+    
+    Reads the tenant's timeline from the cursor up to the current time and
+    cuts matching calls into batches of maxBatchRecords, or whatever is
+    pending after maxBatchDelayMs. Batches are posted with at most
+    maxInFlight unanswered, and retried with exponential backoff and jitter
+    (honoring Retry-After) on connection errors, 408, 429 and 5xx.
+    
+    The persisted cursor only moves past a batch once it and every earlier
+    batch are delivered (or dropped), so delivery is at-least-once: a
+    dispatcher taking over resends what was in flight.
+    """
+    
+    def __init__(self, config, state):
+        self.id = config["id"]
+        self.config = config
+        self.tenant = tenants.get(config["tenant"], default_tenant)
+        self.extension = config["filters"]["extension"]
+        self.direction = config["filters"]["direction"]
+        self.projection = get_projection(config["filters"]["fields"])
+        parts = urllib.parse.urlsplit(config["url"])
+        self.target = (parts.path or '/') + (f"?{parts.query}" if parts.query else '')
+        self.connections = KeepAliveConnections(
+            f"{parts.scheme}://{parts.netloc}", size=config["maxInFlight"], timeout=WEBHOOK_TIMEOUT,
+            check_address=None if parts.hostname.lower() in WEBHOOK_ALLOWED_NAMES else webhook_address_error
+        )
+        # Next slot to read, and the slot before which everything is delivered
+        self.slot = self.acked = state.get("slot", config["startSlot"])
+        self.sequence = self.acked_sequence = state.get("sequence", 0)
+        self.metrics = {name: 0 for name in WEBHOOK_COUNTERS}
+        self.metrics.update(state.get("metrics", {}))
+        self.pending = []
+        self.pending_since = None
+        self.batches = deque()
+        self.saved = 0.0
+    
+    def collect(self, now):
+        """Read the calls that happened by `now` into the pending records"""
+        backlog = len(self.pending) + sum(batch.count for batch in self.batches)
+        scanned = 0
+        while backlog < WEBHOOK_MAX_PENDING_RECORDS and scanned < WEBHOOK_SCAN_SLOTS:
+            core = dataset_core(self.tenant, self.slot)
+            due = core.call_date if core is not None else dataset_slot_time(self.tenant, self.slot + 1)
+            if due > now:
+                break
+            self.slot += 1
+            scanned += 1
+            if core is None:
+                continue
+            if self.extension and core.extno != self.extension:
+                continue
+            if self.direction and core.direction != self.direction:
+                continue
+            message = wrap_in_kafka_format(self.projection.build(core), core.record_id, offset=self.slot - 1,
+                                           timestamp=int(core.call_date.timestamp() * 1000))
+            if not self.pending:
+                self.pending_since = time.monotonic()
+            self.pending.append((self.slot - 1, core.call_date, message))
+            backlog += 1
+    
+    def flush(self, monotonic_now):
+        """Cut pending records into batches once full or old enough"""
+        size = self.config["maxBatchRecords"]
+        delay = self.config["maxBatchDelayMs"] / 1000
+        while len(self.pending) >= size or (self.pending and monotonic_now - self.pending_since >= delay):
+            taken, self.pending = self.pending[:size], self.pending[size:]
+            self.sequence += 1
+            body = dumps_records({
+                "subscriptionId": self.id,
+                "sequence": self.sequence,
+                "count": len(taken),
+                "messages": [message for _, _, message in taken]
+            }, sort_keys=True, separators=(',', ':')).encode()
+            end_slot = self.pending[0][0] if self.pending else self.slot
+            self.batches.append(WebhookBatch(self.sequence, end_slot, taken[0][1], len(taken), body))
+    
+    def send(self, pool, monotonic_now):
+        """Post due batches, oldest first, up to maxInFlight unanswered"""
+        in_flight = sum(1 for batch in self.batches if batch.future is not None)
+        for batch in self.batches:
+            if in_flight >= self.config["maxInFlight"]:
+                break
+            if batch.future is None and not batch.done and batch.due <= monotonic_now:
+                batch.attempts += 1
+                batch.future = pool.submit(post_webhook_batch, self, batch)
+                in_flight += 1
+    
+    def reap(self, monotonic_now, now):
+        """Record finished deliveries, schedule retries and advance the cursor"""
+        metrics = self.metrics
+        for batch in self.batches:
+            if batch.future is None or not batch.future.done():
+                continue
+            future, batch.future = batch.future, None
+            try:
+                status, retry_after, latency_ms = future.result()
+                error = None if 200 <= status < 300 else f"HTTP {status}"
+            except (OSError, http.client.HTTPException) as e:
+                status, retry_after, latency_ms, error = None, None, None, str(e) or type(e).__name__
+            metrics["lastStatus"] = status
+            if error is None:
+                batch.done = True
+                metrics["deliveredBatches"] += 1
+                metrics["deliveredRecords"] += batch.count
+                metrics["lastDeliveredAt"] = now.isoformat()
+                metrics["lastLatencyMs"] = latency_ms
+                continue
+            
+            metrics["failedAttempts"] += 1
+            metrics["lastError"] = error
+            retryable = status is None or status in (408, 429) or status >= 500
+            if not retryable or batch.attempts >= WEBHOOK_MAX_ATTEMPTS:
+                batch.done = True
+                metrics["droppedBatches"] += 1
+                metrics["droppedRecords"] += batch.count
+                logger.warning("Dropped webhook batch %d of subscription %s after %d attempt(s): %s",
+                               batch.sequence, self.id, batch.attempts, error)
+            else:
+                backoff = min(WEBHOOK_RETRY_BASE_SECONDS * 2 ** (batch.attempts - 1), WEBHOOK_RETRY_MAX_SECONDS)
+                batch.due = monotonic_now + max(retry_after or 0, random.uniform(backoff / 2, backoff))
+                metrics["retries"] += 1
+        
+        while self.batches and self.batches[0].done:
+            batch = self.batches.popleft()
+            self.acked, self.acked_sequence = batch.end_slot, batch.sequence
+        if not self.batches and not self.pending:
+            self.acked = self.slot
+    
+    def lag_seconds(self, now):
+        """Age of the oldest call not delivered yet (0 when caught up)"""
+        if self.batches:
+            oldest = self.batches[0].oldest
+        elif self.pending:
+            oldest = self.pending[0][1]
+        else:
+            oldest = dataset_slot_time(self.tenant, self.slot)
+        return round(max((now - oldest).total_seconds(), 0.0), 3)
+    
+    def save(self, monotonic_now, now):
+        """Persist the delivery cursor and metrics for status reads and takeovers"""
+        self.saved = monotonic_now
+        if not os.path.exists(webhook_path(self.id)):
+            return
+        write_json_atomic(webhook_path(self.id, 'state.json'), {
+            "slot": self.acked,
+            "sequence": self.acked_sequence,
+            "metrics": dict(
+                self.metrics,
+                lagSeconds=self.lag_seconds(now),
+                pendingRecords=len(self.pending) + sum(batch.count for batch in self.batches),
+                inFlight=sum(1 for batch in self.batches if batch.future is not None),
+                updatedAt=now.isoformat()
+            )
+        })
+
+
+def post_webhook_batch(subscription, batch):
+    """
+    POST one batch to its subscriber (webhook pool thread)
+    
+    The body is signed with the subscription's secret (X-Webhook-Signature:
+    sha256=HMAC of the body) so sinks can verify it.
+    
+    Returns:
+        tuple: (HTTP status, Retry-After seconds or None, latency in ms)
+    """
+    signature = hmac.new(subscription.config["secret"].encode(), batch.body, hashlib.sha256).hexdigest()
+    headers = {
+        "Content-Type": "application/json",
+        "X-Webhook-Id": subscription.id,
+        "X-Webhook-Sequence": str(batch.sequence),
+        "X-Webhook-Signature": f"sha256={signature}"
+    }
+    started = time.monotonic()
+    status, response_headers, _ = subscription.connections.request('POST', subscription.target, headers, batch.body)
+    try:
+        retry_after = float(response_headers.get('Retry-After', ''))
+    except ValueError:
+        retry_after = None
+    return status, retry_after, round((time.monotonic() - started) * 1000, 1)
+
+
+class WebhookDispatcher:
+    """
+    Delivers every subscription, from one worker at a time
+    
+    Each worker starts a dispatcher thread with its first request. The one
+    holding an exclusive lock on WEBHOOK_DIR/.dispatcher.lock delivers and
+    the others wait for the lock, so when that worker exits another takes
+    over from the persisted cursors within a second. With
+    WEBHOOK_DISPATCHER=external, web workers never deliver and one or more
+    `python app.py --webhook-dispatcher` processes take the lock instead.
+    """
+    
+    def __init__(self):
+        self.subscriptions = {}
+        self.directory_mtime = None
+    
+    def run(self):
+        os.makedirs(WEBHOOK_DIR, exist_ok=True)
+        with open(os.path.join(WEBHOOK_DIR, '.dispatcher.lock'), 'a') as lock:
+            while True:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except OSError:
+                    time.sleep(1)
+            logger.info("Webhook dispatcher running in process %d", os.getpid())
+            pool = ThreadPoolExecutor(max_workers=WEBHOOK_POOL_SIZE, thread_name_prefix='webhook')
+            while True:
+                try:
+                    self.tick(pool)
+                except Exception as e:
+                    logger.exception("Webhook dispatcher error: %s", e)
+                time.sleep(WEBHOOK_TICK_SECONDS)
+    
+    def refresh(self):
+        """Pick up created and deleted subscriptions"""
+        mtime = os.stat(WEBHOOK_DIR).st_mtime_ns
+        if mtime == self.directory_mtime:
+            return
+        self.directory_mtime = mtime
+        ids = set(webhook_ids())
+        for subscription_id in set(self.subscriptions) - ids:
+            del self.subscriptions[subscription_id]
+            try:
+                os.unlink(webhook_path(subscription_id, 'state.json'))
+            except FileNotFoundError:
+                pass
+        for subscription_id in ids - set(self.subscriptions):
+            config = read_webhook(subscription_id)
+            if config is not None:
+                state = read_webhook(subscription_id, 'state.json') or {}
+                self.subscriptions[subscription_id] = WebhookSubscription(config, state)
+    
+    def tick(self, pool):
+        self.refresh()
+        now = datetime.now()
+        monotonic_now = time.monotonic()
+        for subscription in list(self.subscriptions.values()):
+            subscription.reap(monotonic_now, now)
+            subscription.collect(now)
+            subscription.flush(monotonic_now)
+            subscription.send(pool, monotonic_now)
+            if monotonic_now - subscription.saved >= WEBHOOK_SAVE_SECONDS:
+                subscription.save(monotonic_now, now)
+
+
+_webhook_dispatcher_pid = None
+
+
+@app.before_request
+def start_webhook_dispatcher():
+    """Start this worker's webhook dispatcher thread with its first request (unless external)"""
+    global _webhook_dispatcher_pid
+    if WEBHOOK_DISPATCHER != 'worker' or _webhook_dispatcher_pid == os.getpid():
+        return
+    with worker_init_lock:
+        if _webhook_dispatcher_pid != os.getpid():
+            _webhook_dispatcher_pid = os.getpid()
+            threading.Thread(target=WebhookDispatcher().run, name='webhook-dispatcher', daemon=True).start()
+
+
+def webhook_view(config, include_secret=False):
+    """Public form of a subscription, with its delivery metrics"""
+    state = read_webhook(config["id"], 'state.json') or {}
+    metrics = {name: 0 for name in WEBHOOK_COUNTERS}
+    metrics.update(state.get("metrics", {}))
+    view = {
+        key: config[key]
+        for key in ("id", "url", "filters", "maxBatchRecords", "maxBatchDelayMs", "maxInFlight", "createdAt")
+    }
+    if include_secret:
+        view["secret"] = config["secret"]
+    view["metrics"] = metrics
+    view["links"] = {"self": f"{BASE_PATH}/reporting/subscriptions/{config['id']}"}
+    return view
+
+
+# ==================== API ENDPOINTS ====================
+
+@app.route('/')
+def root():
+    """API root - returns API information"""
+    return jsonify({
+        "name": "Mitel MiContact Center Historical Reporting API",
+        "version": API_VERSION,
+        "description": "Mock API for Mitel MiContact Center Call Detail Records",
+        "documentation": "https://developer.mitel.io/",
+        "authentication": {
+            "required": REQUIRE_AUTH,
+            "type": "Bearer Token",
+            "header": "Authorization: Bearer <token>",
+            "user_management": USER_MGMT_MODE,
+            "note": "Set REQUIRE_AUTH=true to enable authentication"
+        },
+        "endpoints": {
+            "/auth/login": "Get bearer token (POST)",
+            "/auth/logout": "Invalidate token (POST, requires auth)",
+            "/auth/users": "List users (GET, requires auth)",
+            "/admin/profiles/<id>": "Download a stored request profile (GET, admin only)",
+            "/admin/profiles/hot": "Hottest sampled stacks per route (GET, admin only)",
+            "/admin/tenants": "Tenants, per-tenant metrics and cache statistics (GET, admin only)",
+            "/admin/faults": "Get or replace latency/error/throttling/disconnect injection profiles (GET/PUT, admin only)",
+            f"{BASE_PATH}/reporting/calls": "Get historical call records with date filtering",
+            f"{BASE_PATH}/reporting/calls/changes": "Records newer than a RecordId, offset or timestamp (long-poll)",
+            f"{BASE_PATH}/reporting/calls/search": "Calls by CallId or LegID, or by Number or Username prefix (indexed)",
+            f"{BASE_PATH}/reporting/journeys/<CallId>": "Every leg of a call journey (transfers, ringpoints, callback) in one lookup",
+            f"{BASE_PATH}/reporting/calls/aggregate": "Group-by counts, sums, averages, minimums and maximums",
+            f"{BASE_PATH}/reporting/calls/distinct": "Approximate distinct callers (or other field values) per time bucket",
+            f"{BASE_PATH}/reporting/calls/top": "Approximate top calling numbers, busiest extensions, ...",
+            f"{BASE_PATH}/reporting/calls/stream": "Stream call records (Kafka format)",
+            f"{BASE_PATH}/reporting/calls/export": "Export calls as CSV",
+            f"{BASE_PATH}/reporting/exports": "Submit a background export job (POST); poll /<id>, download /<id>/download",
+            f"{BASE_PATH}/reporting/subscriptions": "Push new calls to a webhook in batches (POST), list with delivery metrics (GET)",
+            f"{BASE_PATH}/reporting/agents": "Get agent/extension states (snapshot or changes since a version)",
+            f"{BASE_PATH}/reporting/agents/events": "Agent state changes as server-sent events",
+            f"{BASE_PATH}/reporting/statistics": "Get call statistics",
+            f"{BASE_PATH}/reporting/batch": "Run many reporting queries in one request (POST)",
+            "/health": "Health check endpoint"
+        }
+    })
+
+
+@app.route('/auth/login', methods=['POST'])
+def login():
+    """
+    Authentication endpoint - returns bearer token
+    
+    Request Body:
+    {
+        "username": "user@example.com",
+        "password": "password",
+        "account_id": "12345",  (optional - deprecated, use user's account_id)
+        "expires_in": 7200      (optional - token expiration in seconds, default: 3600)
+    }
+    
+    Response:
+    {
+        "success": true,
+        "access_token": "abc123...",
+        "refresh_token": "xyz789...",
+        "token_type": "Bearer",
+        "expires_in": 7200,
+        "user": {
+            "username": "user@example.com",
+            "account_id": "1",
+            "role": "user",
+            "name": "Regular User"
+        }
+    }
+    
+    Examples:
+        # Default expiration (1 hour)
+        {"username": "user@example.com", "password": "pass123"}
         
-        # Check for Authorization header
-        auth_header = request.headers.get('Authorization')
+        # Custom expiration (2 hours)
+        {"username": "user@example.com", "password": "pass123", "expires_in": 7200}
         
-        if not auth_header:
+        # Long-lived token (24 hours)
+        {"username": "api@example.com", "password": "apikey", "expires_in": 86400}
+    """
+    data = request.get_json() or {}
+    
+    username = data.get('username')
+    password = data.get('password')
+    expires_in = data.get('expires_in')  # Optional custom expiration
+    
+    if not username or not password:
+        return jsonify({
+            "success": False,
+            "error": {
+                "code": "MISSING_CREDENTIALS",
+                "message": "Username and password are required"
+            }
+        }), 400
+    
+    # Validate expires_in if provided
+    if expires_in is not None:
+        try:
+            expires_in = int(expires_in)
+            if expires_in < 60:
+                return jsonify({
+                    "success": False,
+                    "error": {
+                        "code": "INVALID_EXPIRATION",
+                        "message": "Token expiration must be at least 60 seconds"
+                    }
+                }), 400
+            if expires_in > 86400 * 7:  # Max 7 days
+                return jsonify({
+                    "success": False,
+                    "error": {
+                        "code": "INVALID_EXPIRATION",
+                        "message": "Token expiration cannot exceed 7 days (604800 seconds)"
+                    }
+                }), 400
+        except (ValueError, TypeError):
             return jsonify({
                 "success": False,
                 "error": {
-                    "code": "UNAUTHORIZED",
-                    "message": "Missing Authorization header. Include 'Authorization: Bearer <token>'"
+                    "code": "INVALID_EXPIRATION",
+                    "message": "Token expiration must be a valid integer (seconds)"
                 }
-            }), 401
-        
-        # Check Bearer token format
-        if not auth_header.startswith('Bearer '):
-            return jsonify({
-                "success": False,
-                "error": {
-                    "code": "INVALID_AUTH_FORMAT",
-                    "message": "Authorization header must use Bearer token format: 'Bearer <token>'"
+            }), 400
+    
+    # Get users based on configured mode
+    users = get_users()
+    
+    # Validate credentials
+    if username not in users:
+        logger.warning("Login attempt with unknown username: %s", username,
+                       extra={"fields": {"event": "login_failed", "user": username}})
+        return jsonify({
+            "success": False,
+            "error": {
+                "code": "INVALID_CREDENTIALS",
+                "message": "Invalid username or password"
+            }
+        }), 401
+    
+    user = users[username]
+    
+    if user['password'] != password:
+        logger.warning("Login attempt with incorrect password for user: %s", username,
+                       extra={"fields": {"event": "login_failed", "user": username}})
+        return jsonify({
+            "success": False,
+            "error": {
+                "code": "INVALID_CREDENTIALS",
+                "message": "Invalid username or password"
+            }
+        }), 401
+    
+    # Generate token with custom or default expiration
+    account_id = user.get('account_id', '1')
+    access_token, token_expires_in = generate_token(
+        username, account_id, expires_in, role=user.get('role', 'user')
+    )
+    
+    logger.info("User logged in successfully: %s (token expires in %ss)", username, token_expires_in,
+                extra={"fields": {"event": "login", "user": username}})
+    
+    # Return token and user info
+    return jsonify({
+        "success": True,
+        "access_token": access_token,
+        "refresh_token": f"refresh_{access_token[:20]}",
+        "token_type": "Bearer",
+        "expires_in": token_expires_in,
+        "user": {
+            "username": username,
+            "account_id": account_id,
+            "role": user.get('role', 'user'),
+            "name": user.get('name', username)
+        }
+    })
+
+
+@app.route('/auth/logout', methods=['POST'])
+@require_auth
+def logout():
+    """
+    Logout endpoint - invalidates bearer token
+    
+    Headers:
+        Authorization: Bearer <token>
+    
+    Response:
+    {
+        "success": true,
+        "message": "Logged out successfully"
+    }
+    """
+    auth_header = request.headers.get('Authorization', '')
+    if auth_header.startswith('Bearer '):
+        token = auth_header[7:]
+        token_info = validate_token(token)
+        if token_info:
+            username = token_info['username']
+            revoke_token(token)
+            logger.info("User logged out: %s", username,
+                        extra={"fields": {"event": "logout", "user": username}})
+    
+    return jsonify({
+        "success": True,
+        "message": "Logged out successfully"
+    })
+
+
+@app.route('/auth/users', methods=['GET'])
+@require_auth
+def list_users():
+    """
+    List all configured users (for admin/testing)
+    Requires authentication
+    
+    Response:
+    {
+        "success": true,
+        "users": [...]
+    }
+    """
+    users = get_users()
+    
+    # Return users without passwords
+    safe_users = []
+    for username, user_data in users.items():
+        safe_users.append({
+            "username": username,
+            "account_id": user_data.get('account_id', '1'),
+            "role": user_data.get('role', 'user'),
+            "name": user_data.get('name', username)
+        })
+    
+    return jsonify({
+        "success": True,
+        "users": safe_users,
+        "count": len(safe_users),
+        "management_mode": USER_MGMT_MODE
+    })
+
+
+@app.route('/admin/profiles/hot', methods=['GET'])
+@require_admin
+def get_hot_stacks():
+    """
+    Hottest sampled stacks per route from this worker's continuous sampler
+    Requires an admin bearer token and PROFILING_CONTINUOUS=true
+    
+    Query Parameters:
+        - top: Number of stacks per route (default: 20, max: 200)
+        - format: 'json' (default) or 'folded' (flamegraph input)
+        - reset: 'true' to clear the collected samples after reading
+    """
+    sampler = get_continuous_sampler()
+    if sampler is None:
+        return error_response(
+            "PROFILING_DISABLED",
+            "Continuous sampling is disabled. Set PROFILING_CONTINUOUS=true to enable",
+            404
+        )
+    
+    try:
+        top = min(int(request.args.get('top', 20)), 200)
+    except ValueError:
+        top = 0
+    if top < 1:
+        return error_response("INVALID_PARAMETER", "top must be a positive integer", 400)
+    counts = sampler.snapshot()
+    total = sampler.samples
+    if request.args.get('reset', 'false').lower() == 'true':
+        sampler.reset()
+    
+    if request.args.get('format') == 'folded':
+        folded = '\n'.join(f"{stack} {count}" for stack, count in counts.most_common())
+        return Response(folded, mimetype='text/plain')
+    
+    routes = {}
+    for stack, count in counts.most_common():
+        route, _, frames = stack.partition(';')
+        route_stacks = routes.setdefault(route, {"samples": 0, "stacks": []})
+        route_stacks["samples"] += count
+        if len(route_stacks["stacks"]) < top:
+            route_stacks["stacks"].append({"stack": frames, "samples": count})
+    
+    return jsonify({
+        "success": True,
+        "data": routes,
+        "totalSamples": total,
+        "intervalMs": PROFILE_CONTINUOUS_INTERVAL_MS,
+        "worker": os.getpid(),
+        "timestamp": datetime.now().isoformat()
+    })
+
+
+@app.route('/admin/profiles/<profile_id>', methods=['GET'])
+@require_admin
+def get_profile(profile_id):
+    """
+    Download a stored on-demand profile
+    Folded stacks (.folded) for sampled requests, pstats (.prof) for cProfile
+    """
+    if not all(c in '0123456789abcdef' for c in profile_id):
+        return error_response("INVALID_PROFILE_ID", "Invalid profile id", 400)
+    
+    for extension, mimetype in (('folded', 'text/plain'), ('prof', 'application/octet-stream')):
+        path = os.path.join(PROFILE_DIR, f"{profile_id}.{extension}")
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                content = f.read()
+            return Response(
+                content,
+                mimetype=mimetype,
+                headers={
+                    'Content-Disposition': f'attachment; filename={profile_id}.{extension}'
                 }
-            }), 401
-        
-        # Extract token
-        token = auth_header[7:]  # Remove 'Bearer ' prefix
+            )
+    
+    return error_response("PROFILE_NOT_FOUND", f"Profile '{profile_id}' not found", 404)
+
+
+@app.route('/admin/tenants', methods=['GET'])
+@require_admin
+def list_tenants():
+    """
+    Tenants with their dataset settings, per-tenant request metrics of all
+    workers (see TENANT_METRICS_FILE) and this worker's cache statistics
+    Requires an admin bearer token
+    
+    Examples:
+        /admin/tenants
+    """
+    data = [tenant.summary() for tenant in tenants.values()]
+    return jsonify({
+        "success": True,
+        "data": data,
+        "count": len(data),
+        "worker": os.getpid(),
+        "timestamp": datetime.now().isoformat()
+    })
+
+
+@app.route('/admin/faults', methods=['GET', 'PUT'])
+@require_admin
+def admin_faults():
+    """
+    Get or replace the fault injection profiles (see DEFAULT_FAULT_PROFILES)
+    Requires an admin bearer token
+    
+    PUT takes the whole profiles object (route -> faults) and applies it in
+    every worker within a second; an empty object turns injection off.
+    
+    Examples:
+        PUT /admin/faults
+        {"/api/v1/reporting/calls": {"latencyMs": {"distribution": "lognormal", "median": 150, "p99": 2000},
+                                     "errorRate": 0.02, "disconnectRate": 0.01}}
+    """
+    if request.method == 'PUT':
+        profiles = request.get_json(silent=True)
+        try:
+            validate_fault_profiles(profiles)
+        except ValueError as e:
+            return error_response("INVALID_FAULT_PROFILES", str(e), 400)
+        fault_profiles.publish(profiles)
+        logger.info("Fault profiles replaced for %d route(s)", len(profiles))
+    
+    return jsonify({
+        "success": True,
+        "data": {
+            "profiles": fault_profiles.current(),
+            "maxDelaySeconds": FAULT_MAX_DELAY_SECONDS,
+            "proxyThrottle": FAULT_PROXY_THROTTLE
+        },
+        "timestamp": datetime.now().isoformat()
+    })
+
+
+@app.route('/health')
+def health():
+    """Health check endpoint"""
+    health_info = {
+        "status": "healthy",
+        "timestamp": datetime.now().isoformat(),
+        "service": "mitel-micontact-center-api"
+    }
+    health_info["worker"] = {
+        "pid": os.getpid(),
+        "uptimeSeconds": round(time.time() - worker_started["at"], 1),
+        "memory": process_memory()
+    }
+    health_info["startup"] = startup_stats
+    if ADMISSION_CONTROL_ENABLED:
+        health_info["admission"] = {
+            "inFlight": admission.in_flight,
+            "shed": admission.shed,
+            "queueDelayMs": round(admission.queue_delay_ms, 1)
+        }
+    if CLUSTER_PEERS:
+        health_info["cluster"] = {
+            "node": CLUSTER_NODE,
+            "size": CLUSTER_SIZE,
+            "shardBy": CLUSTER_SHARD_BY
+        }
+    return jsonify(health_info)
+
+
+def error_payload(code, message):
+    """Standard error envelope as a dict (see error_response)"""
+    return {
+        "success": False,
+        "error": {
+            "code": code,
+            "message": message
+        }
+    }
+
+
+def resolve_calls_query(args, tenant):
+    """
+    Resolve a /reporting/calls query into the state its cursors carry: date
+    window (defaults resolved against the current time), filters, fields
+    and the slot the page starts at (None for a first page). A cursor
+    already is such a state; other filters are then ignored.
+    
+    Returns:
+        tuple: (state, None), or (None, (error payload, HTTP status))
+    """
+    cursor = args.get('cursor')
+    if cursor:
+        try:
+            state = decode_cursor(cursor)
+        except ValueError as e:
+            return None, (error_payload("INVALID_CURSOR", str(e)), 400)
+        if (state.get('tenant', '*') != tenant.key or state.get('seed') != tenant.seed
+                or state.get('traffic', 'flat') != tenant.traffic.signature):
+            return None, (error_payload("INVALID_CURSOR", "Cursor belongs to a different dataset"), 400)
+        return state, None
+    
+    start_date_str = args.get('startDate')
+    end_date_str = args.get('endDate')
+    
+    # Parse and validate dates
+    try:
+        start_date = parse_date_param(start_date_str, 'startDate', end_of_day=False)
+        end_date = parse_date_param(end_date_str, 'endDate', end_of_day=True)
+    except ValueError as e:
+        return None, (error_payload("INVALID_DATE_FORMAT", str(e)), 400)
+    
+    # Validate date range
+    if start_date and end_date and start_date > end_date:
+        return None, (error_payload("INVALID_DATE_RANGE", "startDate must be before or equal to endDate"), 400)
+    
+    # Historical data only: the timeline stops at the current time
+    window_start, window_end = dataset_window(start_date, end_date)
+    window_end = min(window_end, datetime.now().replace(microsecond=0))
+    return {
+        "tenant": tenant.key,
+        "seed": tenant.seed,
+        "traffic": tenant.traffic.signature,
+        "start": window_start.isoformat(),
+        "end": window_end.isoformat(),
+        "startDate": start_date_str,
+        "endDate": end_date_str,
+        "extension": args.get('extension'),
+        "direction": args.get('direction'),
+        "fields": args.get('fields'),
+        "slot": None
+    }, None
+
+
+def query_call_records(args, core_cache=None, shard=None):
+    """
+    Run a /reporting/calls query against the current tenant's call timeline
+    
+    Records are returned in Call_date (and RecordId) order. A page scans
+    timeline slots from its start position, which is computed directly from
+    the date range, the offset (when unfiltered) or the cursor, so the cost
+    of a page does not grow with its position. At most limit * PAGE_SCAN_FACTOR
+    slots are scanned per page; when more remain, `nextCursor` resumes the
+    scan where this page stopped. Filtered offsets are counted out within
+    that budget too: a page that runs out of it while skipping returns no
+    records, and its cursor carries the records still to skip.
+    
+    Args:
+        args: Query parameters (request.args or a dict)
+        core_cache: Optional {slot: core} dict shared between queries, so
+                    queries over overlapping ranges generate each call once
+        shard: Only return the records of this cluster shard, plus their
+               slots and where the scan stopped, for gather_call_records
+               to merge
+    
+    Returns:
+        tuple: (response payload, HTTP status)
+    """
+    # Parse parameters
+    limit = min(int(args.get('limit', 50)), 500)
+    tenant = current_tenant()
+    state, error = resolve_calls_query(args, tenant)
+    if error:
+        return error
+    # Offsets only apply to first pages; cursors carry their position (and
+    # what is left of a filtered offset)
+    offset = max(0, int(args.get('offset', 0))) if state['slot'] is None else 0
+    extension = state['extension']
+    direction = state['direction']
+    fields = state['fields']
+    start_date_str = state['startDate']
+    end_date_str = state['endDate']
+    window_start = datetime.fromisoformat(state['start'])
+    window_end = datetime.fromisoformat(state['end'])
+    position = state['slot']
+    
+    # Compile the field projection (validated once per distinct value)
+    try:
+        projection = get_projection(fields)
+    except ValueError as e:
+        return error_payload("INVALID_FIELDS", str(e)), 400
+    
+    def core_at(slot):
+        if core_cache is None:
+            return dataset_core(tenant, slot)
+        core = core_cache.get(slot)
+        if core is None:
+            core = core_cache[slot] = dataset_core(tenant, slot)
+        return core
+    
+    first_slot = dataset_slot(tenant, window_start)
+    last_slot = dataset_slot(tenant, window_end)
+    skip = state.get('skip', 0)
+    if position is None:
+        position = first_slot
+        if extension or direction or tenant.traffic.shaped:
+            # Filtered (or thinned) offsets have to be counted out
+            skip = offset
+        elif offset:
+            # Unfiltered, every slot in the window holds one record: seek directly
+            if core_at(first_slot).call_date < window_start:
+                position += 1
+            position += offset
+    
+    # Scan the timeline
+    records = []
+    slots = []
+    slot = position
+    scanned = 0
+    max_scan = limit * PAGE_SCAN_FACTOR
+    while slot <= last_slot and len(records) < limit and scanned < max_scan:
+        if shard is not None:
+            hour = slot // tenant.slots_per_hour
+            if not shard_owns_hour(shard, hour):
+                # Jump to the shard's next hour
+                slot = (hour + (shard - hour) % CLUSTER_SIZE) * tenant.slots_per_hour
+                continue
+        core = core_at(slot)
+        slot += 1
+        scanned += 1
+        if core is None or not window_start <= core.call_date <= window_end:
+            continue
         
-        # Validate token
-        token_info = validate_token(token)
-        if not token_info:
-            return jsonify({
-                "success": False,
-                "error": {
-                    "code": "INVALID_TOKEN",
-                    "message": "Invalid or expired bearer token"
-                }
-            }), 401
+        # Apply filters (on core values, before building the record)
+        if extension and core.extno != extension:
+            continue
+        if direction and core.direction != direction:
+            continue
+        if shard is not None and not shard_owns_extension(shard, core.extno):
+            continue
+        if skip:
+            skip -= 1
+            continue
         
-        # Token valid - add user info to request context
-        request.user_info = token_info
-        return f(*args, **kwargs)
+        records.append(projection.build(core))
+        slots.append(slot - 1)
     
-    return decorated_function
+    has_more = slot <= last_slot
+    state = dict(state, slot=slot, skip=skip)
+    if not skip:
+        del state['skip']
+    next_cursor = encode_cursor(state) if has_more else None
+    
+    logger.debug("Generated %d call records (date range: %s to %s)",
+                 len(records), start_date_str, end_date_str)
+    
+    payload = {
+        "success": True,
+        "data": records,
+        "filters": {
+            "startDate": start_date_str,
+            "endDate": end_date_str,
+            "extension": extension,
+            "direction": direction,
+            "fields": fields
+        },
+        "pagination": {
+            "limit": limit,
+            "offset": offset,
+            "total": len(records),
+            "hasMore": has_more,
+            "nextCursor": next_cursor
+        },
+        "timestamp": datetime.now().isoformat()
+    }
+    if shard is not None:
+        payload["shard"] = {"slots": slots, "nextSlot": slot}
+    return payload, 200
 
 
-# ==================== API ENDPOINTS ====================
+@app.route(f'{BASE_PATH}/reporting/calls', methods=['GET'])
+@require_auth
+@coalesced
+def get_call_records():
+    """
+    Get Call Detail Records - Mitel MiContact Center format
+    
+    Query Parameters:
+        - startDate: Start date/time (ISO 8601: YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS)
+        - endDate: End date/time (ISO 8601: YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS)
+        - extension: Filter by extension number
+        - direction: Filter by direction (I/O/B)
+        - limit: Max records to return (default: 50, max: 500)
+        - offset: Pagination offset (default: 0)
+        - fields: Comma-separated CDR fields to return (default: all)
+        - cursor: `pagination.nextCursor` of the previous page; continues that
+          query (its filters and date range) from where the page stopped
+    
+    Records are returned in Call_date order from a deterministic timeline
+    (see DATASET_SEED), so the same query always returns the same records.
+    
+    Examples:
+        /api/v1/reporting/calls?startDate=2025-11-20&endDate=2025-11-22
+        /api/v1/reporting/calls?startDate=2025-11-20T00:00:00&endDate=2025-11-22T23:59:59
+        /api/v1/reporting/calls?extension=694311&limit=50
+        /api/v1/reporting/calls?direction=I&startDate=2025-11-20
+        /api/v1/reporting/calls?fields=RecordId,Extno,Call_date,Duration
+        /api/v1/reporting/calls?cursor=eyJkaXJlY3Rpb24iOm51bGws...
+    """
+    try:
+        if CLUSTER_PEERS and cluster_shard() is None:
+            payload, status = gather_call_records(request.args)
+        else:
+            payload, status = query_call_records(request.args, shard=cluster_shard())
+        if status == 200:
+            request.record_count = len(payload["data"])
+        return jsonify(payload), status
+    
+    except Exception as e:
+        logger.exception("Error: %s", e)
+        return jsonify({
+            "success": False,
+            "error": {
+                "code": "INTERNAL_ERROR",
+                "message": str(e)
+            }
+        }), 500
 
-@app.route('/')
-def root():
-    """API root - returns API information"""
-    return jsonify({
-        "name": "Mitel MiContact Center Historical Reporting API",
-        "version": API_VERSION,
-        "description": "Mock API for Mitel MiContact Center Call Detail Records",
-        "documentation": "https://developer.mitel.io/",
-        "authentication": {
-            "required": REQUIRE_AUTH,
-            "type": "Bearer Token",
-            "header": "Authorization: Bearer <token>",
-            "user_management": USER_MGMT_MODE,
-            "note": "Set REQUIRE_AUTH=true to enable authentication"
+
+def query_call_search(args):
+    """
+    Run a /reporting/calls/search query: the calls of one CallId or LegID,
+    or of the Numbers or Usernames starting with a prefix
+    
+    Each hour of the date range is answered from its cached SearchIndex,
+    so only matching calls are generated; a LegID carries its call's
+    timestamp, so only that hour is looked up. Matches are returned in
+    Call_date order, with the /reporting/calls filters, fields and cursors.
+    
+    Args:
+        args: Query parameters (request.args or a dict)
+    
+    Returns:
+        tuple: (response payload, HTTP status)
+    """
+    limit = min(int(args.get('limit', 50)), 500)
+    tenant = current_tenant()
+    state, error = resolve_calls_query(args, tenant)
+    if error:
+        return error
+    
+    if state['slot'] is None:
+        searched = [(param, args.get(param)) for param in SEARCH_PARAMETERS if args.get(param)]
+        if len(searched) != 1:
+            return error_payload(
+                "INVALID_SEARCH", f"Give exactly one of {', '.join(SEARCH_PARAMETERS)}"
+            ), 400
+        state['search'] = list(searched[0])
+        # Searches default to the whole searchable range (a LegID's to its
+        # hour, a timeline CallId's to its journey's hour), not the last hour
+        if not state['startDate'] and not state['endDate']:
+            window_end = datetime.fromisoformat(state['end'])
+            param, value = state['search']
+            hour = leg_id_hour(value) if param == "legId" else None
+            slot = journey_call_slot(tenant, value) if param == "callId" else None
+            if hour is not None:
+                hour_start = DATASET_EPOCH + timedelta(hours=hour)
+                state['start'] = hour_start.isoformat()
+                state['end'] = min(window_end, hour_start + timedelta(seconds=3599)).isoformat()
+            elif slot is not None:
+                frame_start = slot - slot % tenant.slots_per_hour
+                state['start'] = dataset_slot_time(tenant, frame_start).replace(microsecond=0).isoformat()
+                state['end'] = min(
+                    window_end, dataset_slot_time(tenant, frame_start + tenant.slots_per_hour)
+                ).replace(microsecond=0).isoformat()
+            else:
+                state['start'] = (window_end - timedelta(days=SEARCH_MAX_DAYS)).isoformat()
+    elif 'search' not in state:
+        return error_payload("INVALID_CURSOR", "Cursor does not belong to a search"), 400
+    
+    param, value = state['search']
+    field, match = SEARCH_PARAMETERS[param]
+    extension = state['extension']
+    direction = state['direction']
+    fields = state['fields']
+    window_start = datetime.fromisoformat(state['start'])
+    window_end = datetime.fromisoformat(state['end'])
+    if window_end - window_start > timedelta(days=SEARCH_MAX_DAYS):
+        return error_payload(
+            "INVALID_DATE_RANGE", f"Date range must not exceed {SEARCH_MAX_DAYS} days"
+        ), 400
+    
+    try:
+        projection = get_projection(fields)
+    except ValueError as e:
+        return error_payload("INVALID_FIELDS", str(e)), 400
+    
+    first = int((window_start - DATASET_EPOCH).total_seconds())
+    last = int((window_end - DATASET_EPOCH).total_seconds())
+    position = state['slot'] or 0
+    hours = range(max(0, first // 3600, position // tenant.slots_per_hour), last // 3600 + 1)
+    if field == "LegID":
+        hour = leg_id_hour(value)
+        hours = [hour] if hour in hours else []
+    key_ranges = search_key_ranges(field, value)
+    filters = tuple(
+        (name, DIMENSION_CODES[name].get(code))
+        for name, code in (("Extno", extension), ("Direction", direction)) if code
+    )
+    if not key_ranges or any(code is None for _, code in filters):
+        hours = []
+    
+    # Build cold blocks in the process pool a window ahead of the scan, so a
+    # long cold search is spread over the pool and one stopping early
+    # builds at most one window too many
+    prefetch_hours = max(24, -(-PARALLEL_MIN_RECORDS // tenant.slots_per_hour))
+    records = []
+    next_slot = None
+    for number, hour in enumerate(hours):
+        if number % prefetch_hours == 0 and len(hours) > 1:
+            prefetch_timeline_blocks(tenant, hour, min(hour + prefetch_hours, hours[-1] + 1) - 1)
+        index = hour_search_index(tenant, hour)
+        block = index.block
+        for i in index.lookup(field, key_ranges):
+            slot = block.slots[i]
+            if slot < position or not first <= block.times[i] <= last:
+                continue
+            if any(block.columns[name][i] != code for name, code in filters):
+                continue
+            core = dataset_core(tenant, slot)
+            # Hashed keys can collide: confirm exact matches on the value
+            if match == "exact" and CDR_FIELDS[field](core) != value:
+                continue
+            if len(records) == limit:
+                next_slot = slot
+                break
+            records.append(projection.build(core))
+        if next_slot is not None:
+            break
+    
+    has_more = next_slot is not None
+    next_cursor = encode_cursor(dict(state, slot=next_slot)) if has_more else None
+    
+    return {
+        "success": True,
+        "data": records,
+        "search": {
+            "field": field,
+            "value": value,
+            "match": match
         },
-        "endpoints": {
-            "/auth/login": "Get bearer token (POST)",
-            "/auth/logout": "Invalidate token (POST, requires auth)",
-            "/auth/users": "List users (GET, requires auth)",
-            f"{BASE_PATH}/reporting/calls": "Get historical call records with date filtering",
-            f"{BASE_PATH}/reporting/calls/stream": "Stream call records (Kafka format)",
-            f"{BASE_PATH}/reporting/calls/export": "Export calls as CSV",
-            f"{BASE_PATH}/reporting/agents": "Get agent/extension information",
-            f"{BASE_PATH}/reporting/statistics": "Get call statistics",
-            "/health": "Health check endpoint"
-        }
-    })
+        "filters": {
+            "startDate": state['startDate'],
+            "endDate": state['endDate'],
+            "extension": extension,
+            "direction": direction,
+            "fields": fields
+        },
+        "period": {
+            "start": window_start.isoformat(),
+            "end": window_end.isoformat()
+        },
+        "pagination": {
+            "limit": limit,
+            "total": len(records),
+            "hasMore": has_more,
+            "nextCursor": next_cursor
+        },
+        "timestamp": datetime.now().isoformat()
+    }, 200
 
 
-@app.route('/auth/login', methods=['POST'])
-def login():
+@app.route(f'{BASE_PATH}/reporting/calls/search', methods=['GET'])
+@require_auth
+@coalesced
+def search_call_records():
     """
-    Authentication endpoint - returns bearer token
+    Find the calls of a CallId or LegID, or of a Number or Username prefix,
+    without scanning the date range
     
-    Request Body:
-    {
-        "username": "user@example.com",
-        "password": "password",
-        "account_id": "12345",  (optional - deprecated, use user's account_id)
-        "expires_in": 7200      (optional - token expiration in seconds, default: 3600)
-    }
+    Query Parameters (exactly one of):
+        - callId: Calls with this CallId
+        - legId: The call leg with this LegID
+        - number: Calls whose Number starts with this prefix (+33... or 0...)
+        - username: Calls whose Username starts with this prefix (case-insensitive)
     
-    Response:
-    {
-        "success": true,
-        "access_token": "abc123...",
-        "refresh_token": "xyz789...",
-        "token_type": "Bearer",
-        "expires_in": 7200,
-        "user": {
-            "username": "user@example.com",
-            "account_id": "1",
-            "role": "user",
-            "name": "Regular User"
-        }
-    }
+    Other Query Parameters:
+        - startDate, endDate: Date range (ISO 8601, at most SEARCH_MAX_DAYS;
+          default: the last SEARCH_MAX_DAYS days, the hour of the legId or
+          the journey of the callId)
+        - extension, direction, fields, limit, cursor: as for /reporting/calls
     
     Examples:
-        # Default expiration (1 hour)
-        {"username": "user@example.com", "password": "pass123"}
-        
-        # Custom expiration (2 hours)
-        {"username": "user@example.com", "password": "pass123", "expires_in": 7200}
-        
-        # Long-lived token (24 hours)
-        {"username": "api@example.com", "password": "apikey", "expires_in": 86400}
+        /api/v1/reporting/calls/search?callId=K20589626
+        /api/v1/reporting/calls/search?number=%2B3332&startDate=2025-11-20&endDate=2025-11-22
+        /api/v1/reporting/calls/search?username=ptp&direction=I&fields=RecordId,Call_date,Username
     """
-    data = request.get_json() or {}
+    try:
+        payload, status = query_call_search(request.args)
+        if status == 200:
+            request.record_count = len(payload["data"])
+        return jsonify(payload), status
     
-    username = data.get('username')
-    password = data.get('password')
-    expires_in = data.get('expires_in')  # Optional custom expiration
+    except Exception as e:
+        logger.exception("Error: %s", e)
+        return jsonify({
+            "success": False,
+            "error": {
+                "code": "INTERNAL_ERROR",
+                "message": str(e)
+            }
+        }), 500
+
+
+def query_journey(args, call_id=None):
+    """
+    Look up a whole call journey of the current tenant's timeline by CallId
     
-    if not username or not password:
+    A timeline CallId gives the journey's first slot (see dataset_journey), so
+    every leg comes back from one lookup, whatever the journey's date. Legs
+    that have not started yet are left out.
+    
+    Args:
+        args: Query parameters (request.args or a dict): fields, and callId
+              when call_id is not given
+        call_id: CallId of the journey
+    
+    Returns:
+        tuple: (response payload, HTTP status)
+    """
+    call_id = call_id or args.get('callId') or ''
+    try:
+        projection = get_projection(args.get('fields'))
+    except ValueError as e:
+        return error_payload("INVALID_FIELDS", str(e)), 400
+    
+    now = datetime.now()
+    legs = dataset_journey(current_tenant(), call_id)
+    if not legs or legs[0].call_date > now:
+        return error_payload("JOURNEY_NOT_FOUND", f"No call journey with CallId '{call_id}'"), 404
+    first = legs[0]
+    journey = first.journey
+    started = [core for core in legs if core.call_date <= now]
+    
+    return {
+        "success": True,
+        "data": {
+            "CallId": call_id,
+            "journeyType": journey.kind,
+            "legs": journey.legs,
+            "complete": len(started) == journey.legs,
+            "JourneyOutcome": first.journey_outcome,
+            "startDate": first.call_date.isoformat(),
+            "totalDuration": journey.total_duration,
+            "records": [projection.build(core) for core in started]
+        },
+        "timestamp": now.isoformat()
+    }, 200
+
+
+@app.route(f'{BASE_PATH}/reporting/journeys/<call_id>', methods=['GET'])
+@require_auth
+def get_journey(call_id):
+    """
+    Get every leg of a call journey (transfers, group ringpoints, callback)
+    in one lookup, without a date range
+    
+    Query Parameters:
+        - fields: Comma-separated CDR fields of the leg records (default: all)
+    
+    Legs are returned in call order: Call_legId counts them, each leg's
+    PreviousLegID is the LegID of the leg before it, and JourneyOutcome,
+    totalDuration, JourneyWaitTime and ContactPoints describe the journey.
+    
+    Examples:
+        /api/v1/reporting/journeys/K20589626
+        /api/v1/reporting/journeys/K20589626?fields=Call_legId,Extno,Call_date,Duration,Call_outcome
+    """
+    try:
+        payload, status = query_journey(request.args, call_id)
+        if status == 200:
+            request.record_count = len(payload["data"]["records"])
+        return jsonify(payload), status
+    
+    except Exception as e:
+        logger.exception("Error: %s", e)
         return jsonify({
             "success": False,
             "error": {
-                "code": "MISSING_CREDENTIALS",
-                "message": "Username and password are required"
+                "code": "INTERNAL_ERROR",
+                "message": str(e)
             }
-        }), 400
+        }), 500
+
+
+# Long-polls of this worker waiting for new records (CHANGES_MAX_WAITERS)
+long_poll_slots = threading.BoundedSemaphore(max(1, CHANGES_MAX_WAITERS))
+
+
+def query_call_changes(args):
+    """
+    Run a /reporting/calls/changes query: records of the current tenant's
+    timeline newer than a mark
     
-    # Validate expires_in if provided
-    if expires_in is not None:
+    The mark is a RecordId, a Kafka offset (the record's timeline slot) or a
+    timestamp. Each is mapped directly to a timeline slot, and the scan
+    starts there and stops at the current time, so the work done is
+    proportional to the new records only. With `wait`, an empty result is
+    held until the next call on the timeline is due or the wait runs out,
+    unless CHANGES_MAX_WAITERS polls of this worker are already waiting.
+    
+    Args:
+        args: Query parameters (request.args or a dict)
+    
+    Returns:
+        tuple: (response payload, HTTP status)
+    """
+    limit = max(1, min(int(args.get('limit', 100)), 500))
+    wait = min(max(float(args.get('wait', 0)), 0.0), CHANGES_MAX_WAIT)
+    extension = args.get('extension')
+    direction = args.get('direction')
+    fields = args.get('fields')
+    message_format = args.get('format', 'json').lower()
+    tenant = current_tenant()
+    
+    if message_format not in ('json', 'kafka'):
+        return error_payload("INVALID_FORMAT", "format must be one of: json, kafka"), 400
+    try:
+        projection = get_projection(fields)
+    except ValueError as e:
+        return error_payload("INVALID_FIELDS", str(e)), 400
+    
+    marks = [name for name in ('sinceRecordId', 'sinceOffset', 'since') if args.get(name)]
+    if len(marks) > 1:
+        return error_payload(
+            "INVALID_SINCE", "Give only one of sinceRecordId, sinceOffset or since"
+        ), 400
+    
+    # Map the mark to the first slot to scan; calls at or before `after` are old
+    after = None
+    if not marks:
+        # No mark: start from now, so the high-water mark can be used to tail
+        after = datetime.now().replace(microsecond=0)
+        position = dataset_slot(tenant, after)
+    elif marks[0] == 'since':
         try:
-            expires_in = int(expires_in)
-            if expires_in < 60:
-                return jsonify({
-                    "success": False,
-                    "error": {
-                        "code": "INVALID_EXPIRATION",
-                        "message": "Token expiration must be at least 60 seconds"
-                    }
-                }), 400
-            if expires_in > 86400 * 7:  # Max 7 days
-                return jsonify({
-                    "success": False,
-                    "error": {
-                        "code": "INVALID_EXPIRATION",
-                        "message": "Token expiration cannot exceed 7 days (604800 seconds)"
-                    }
-                }), 400
-        except (ValueError, TypeError):
-            return jsonify({
-                "success": False,
-                "error": {
-                    "code": "INVALID_EXPIRATION",
-                    "message": "Token expiration must be a valid integer (seconds)"
-                }
-            }), 400
+            after = dataset_time(parse_date_param(args['since'], 'since'))
+        except ValueError as e:
+            return error_payload("INVALID_DATE_FORMAT", str(e)), 400
+        position = max(0, dataset_slot(tenant, after))
+    else:
+        try:
+            mark = int(args[marks[0]])
+        except ValueError:
+            return error_payload("INVALID_SINCE", f"{marks[0]} must be an integer"), 400
+        if marks[0] == 'sinceRecordId':
+            mark -= DATASET_RECORD_ID_BASE
+        position = max(0, mark + 1)
+    
+    deadline = time.monotonic() + wait
+    records = []
+    max_scan = limit * PAGE_SCAN_FACTOR
+    waiting = False
+    try:
+        while True:
+            now = datetime.now()
+            scanned = 0
+            while len(records) < limit and scanned < max_scan:
+                core = dataset_core(tenant, position)
+                due = core.call_date if core is not None else dataset_slot_time(tenant, position + 1)
+                if due > now:
+                    # Not happened yet: this is where the next poll resumes
+                    break
+                position += 1
+                scanned += 1
+                if core is None:
+                    continue
+                if after is not None and core.call_date <= after:
+                    continue
+                if extension and core.extno != extension:
+                    continue
+                if direction and core.direction != direction:
+                    continue
+                records.append((position - 1, core))
+            
+            has_more = scanned == max_scan or len(records) == limit
+            remaining = deadline - time.monotonic()
+            if records or has_more or remaining <= 0:
+                break
+            
+            if not waiting:
+                waiting = long_poll_slots.acquire(blocking=False)
+                if not waiting:
+                    # Every long-poll slot of this worker is taken: answer now
+                    if has_request_context():
+                        request.retry_after = 1
+                    break
+            
+            # Nothing new: sleep until the next call on the timeline is due
+            next_due = (due - datetime.now()).total_seconds()
+            pause = min(remaining, max(next_due, 0.0) + 0.05)
+            time.sleep(pause)
+            if has_request_context():
+                request.idle_ms = getattr(request, 'idle_ms', 0.0) + pause * 1000
+    finally:
+        if waiting:
+            long_poll_slots.release()
+    
+    # High-water mark: the last slot scanned, matched or not
+    mark_slot = position - 1
+    mark_core = dataset_core(tenant, mark_slot) if mark_slot >= 0 else None
+    if mark_core is not None:
+        mark_time = mark_core.call_date
+    else:
+        mark_time = dataset_slot_time(tenant, max(mark_slot + 1, 0))
+    if after is not None and after > mark_time:
+        mark_time = after
+    
+    if message_format == 'kafka':
+        data = [wrap_in_kafka_format(projection.build(core), core.record_id, offset=slot)
+                for slot, core in records]
+    else:
+        data = [projection.build(core) for _, core in records]
+    
+    return {
+        "success": True,
+        "data": data,
+        "count": len(data),
+        "hasMore": has_more,
+        "highWaterMark": {
+            "recordId": DATASET_RECORD_ID_BASE + mark_slot,
+            "offset": mark_slot,
+            "timestamp": mark_time.isoformat()
+        },
+        "filters": {
+            "extension": extension,
+            "direction": direction,
+            "fields": fields
+        },
+        "timestamp": datetime.now().isoformat()
+    }, 200
+
+
+@app.route(f'{BASE_PATH}/reporting/calls/changes', methods=['GET'])
+@require_auth
+def get_call_changes():
+    """
+    Get only the call records added since the client's last poll (delta sync)
     
-    # Get users based on configured mode
-    users = get_users()
+    Query Parameters (give at most one mark; default: now):
+        - sinceRecordId: Return records with a higher RecordId
+        - sinceOffset: Return Kafka messages with a higher offset
+        - since: Return records with a later Call_date (ISO 8601)
     
-    # Validate credentials
-    if username not in users:
-        logger.warning(f"Login attempt with unknown username: {username}")
-        return jsonify({
-            "success": False,
-            "error": {
-                "code": "INVALID_CREDENTIALS",
-                "message": "Invalid username or password"
-            }
-        }), 401
+    Other Query Parameters:
+        - wait: Long-poll up to this many seconds for new records
+          (default: 0, max: CHANGES_MAX_WAIT)
+        - limit: Max records to return (default: 100, max: 500)
+        - format: json (records) or kafka (messages keyed by RecordId, with
+          the timeline offset) (default: json)
+        - extension, direction, fields: as for /reporting/calls
     
-    user = users[username]
+    Pass `highWaterMark.recordId` (or `.offset`) of the response as the next
+    poll's mark. It advances over records dropped by filters too, so a
+    filtered poll never rescans them. When `hasMore` is true, poll again
+    right away. An empty response with Retry-After was not held (the
+    worker's long-poll slots are taken): wait that long before polling.
     
-    if user['password'] != password:
-        logger.warning(f"Login attempt with incorrect password for user: {username}")
+    Examples:
+        /api/v1/reporting/calls/changes?sinceRecordId=78897460&wait=20
+        /api/v1/reporting/calls/changes?sinceOffset=558000&format=kafka
+        /api/v1/reporting/calls/changes?since=2025-11-20T10:00:00&extension=694311
+    """
+    try:
+        payload, status = query_call_changes(request.args)
+        if status == 200:
+            request.record_count = payload["count"]
+        response = jsonify(payload)
+        response.status_code = status
+        response.headers['Cache-Control'] = 'no-store'
+        if getattr(request, 'retry_after', None):
+            # Not held: too many long-polls waiting on this worker
+            response.headers['Retry-After'] = str(request.retry_after)
+        return response
+    
+    except ValueError as e:
+        return error_response("INVALID_PARAMETER", str(e), 400)
+    except Exception as e:
+        logger.exception("Error: %s", e)
         return jsonify({
             "success": False,
             "error": {
-                "code": "INVALID_CREDENTIALS",
-                "message": "Invalid username or password"
+                "code": "INTERNAL_ERROR",
+                "message": str(e)
             }
-        }), 401
+        }), 500
+
+
+def resolve_window(args):
+    """
+    Parse startDate/endDate into a timeline window, clamped to now and at
+    most AGGREGATE_MAX_DAYS long
     
-    # Generate token with custom or default expiration
-    account_id = user.get('account_id', '1')
-    access_token, token_expires_in = generate_token(username, account_id, expires_in)
+    Returns:
+        tuple: ((start, end), None), or (None, (error payload, HTTP status))
+    """
+    try:
+        start_date = parse_date_param(args.get('startDate'), 'startDate', end_of_day=False)
+        end_date = parse_date_param(args.get('endDate'), 'endDate', end_of_day=True)
+    except ValueError as e:
+        return None, (error_payload("INVALID_DATE_FORMAT", str(e)), 400)
+    if start_date and end_date and start_date > end_date:
+        return None, (error_payload("INVALID_DATE_RANGE", "startDate must be before or equal to endDate"), 400)
+    window_start, window_end = dataset_window(start_date, end_date)
+    window_end = min(window_end, datetime.now().replace(microsecond=0))
+    if window_end - window_start > timedelta(days=AGGREGATE_MAX_DAYS):
+        return None, (error_payload(
+            "INVALID_DATE_RANGE", f"Date range must not exceed {AGGREGATE_MAX_DAYS} days"
+        ), 400)
+    return (window_start, window_end), None
+
+
+def parse_aggregate_metrics(metrics_param):
+    """
+    Parse a `metrics=` parameter: `count` or `<function>:<field>` items,
+    e.g. count,avg:Duration,max:waitTime
     
-    logger.info(f"User logged in successfully: {username} (token expires in {token_expires_in}s)")
+    Returns:
+        tuple: ([(name, function, field)], numeric fields used, in order)
     
-    # Return token and user info
-    return jsonify({
-        "success": True,
-        "access_token": access_token,
-        "refresh_token": f"refresh_{access_token[:20]}",
-        "token_type": "Bearer",
-        "expires_in": token_expires_in,
-        "user": {
-            "username": username,
-            "account_id": account_id,
-            "role": user.get('role', 'user'),
-            "name": user.get('name', username)
-        }
-    })
+    Raises:
+        ValueError: On an unknown function or field
+    """
+    specs = []
+    metric_fields = []
+    for name in (item.strip() for item in (metrics_param or 'count').split(',')):
+        if not name:
+            continue
+        function, _, field = name.partition(':')
+        if function not in AGGREGATE_FUNCTIONS:
+            raise ValueError(f"Unknown metric function '{function}'. "
+                             f"Use one of: {', '.join(AGGREGATE_FUNCTIONS)}")
+        if function == 'count':
+            field = None
+        elif field not in AGGREGATE_METRIC_FIELDS:
+            raise ValueError(f"Metric '{name}' needs a numeric field: "
+                             f"{', '.join(AGGREGATE_METRIC_FIELDS)}")
+        elif field not in metric_fields:
+            metric_fields.append(field)
+        specs.append((name, function, field))
+    if not specs:
+        raise ValueError("metrics must list at least one metric")
+    return specs, tuple(metric_fields)
 
 
-@app.route('/auth/logout', methods=['POST'])
-@require_auth
-def logout():
+def query_call_aggregates(args):
     """
-    Logout endpoint - invalidates bearer token
+    Run a /reporting/calls/aggregate query over the current tenant's call timeline
     
-    Headers:
-        Authorization: Bearer <token>
+    Whole hours are answered from cached per-hour rollups, built in one
+    pass over the hour's column block; only the partial hours at the edges
+    of the date range are folded call by call. Only aggregated rows are
+    returned.
     
-    Response:
-    {
-        "success": true,
-        "message": "Logged out successfully"
-    }
+    Args:
+        args: Query parameters (request.args or a dict)
+    
+    Returns:
+        tuple: (response payload, HTTP status)
     """
-    auth_header = request.headers.get('Authorization', '')
-    if auth_header.startswith('Bearer '):
-        token = auth_header[7:]
-        if token in active_tokens:
-            username = active_tokens[token]['username']
-            del active_tokens[token]
-            logger.info(f"User logged out: {username}")
+    group_by = [name.strip() for name in args.get('groupBy', '').split(',') if name.strip()]
+    extension = args.get('extension')
+    direction = args.get('direction')
+    start_date_str = args.get('startDate')
+    end_date_str = args.get('endDate')
     
-    return jsonify({
+    buckets = [name for name in group_by if name in TIME_BUCKETS]
+    dims = tuple(name for name in group_by if name not in TIME_BUCKETS)
+    unknown = [name for name in dims if name not in AGGREGATE_DIMENSIONS]
+    if unknown or len(buckets) > 1 or len(set(group_by)) != len(group_by):
+        return error_payload(
+            "INVALID_GROUP_BY",
+            f"groupBy takes distinct fields ({', '.join(AGGREGATE_DIMENSIONS)}) "
+            f"and at most one time bucket ({', '.join(TIME_BUCKETS)})"
+        ), 400
+    bucket = TIME_BUCKETS[buckets[0]] if buckets else None
+    
+    try:
+        specs, metric_fields = parse_aggregate_metrics(args.get('metrics'))
+    except ValueError as e:
+        return error_payload("INVALID_METRICS", str(e)), 400
+    
+    window, error = resolve_window(args)
+    if error:
+        return error
+    window_start, window_end = window
+    
+    groups = {}
+    width = len(metric_fields)
+    filters = tuple(
+        (name, DIMENSION_CODES[name].get(value))
+        for name, value in (("Extno", extension), ("Direction", direction)) if value
+    )
+    if window_start <= window_end and all(code is not None for _, code in filters):
+        tenant = current_tenant()
+        first = int((window_start - DATASET_EPOCH).total_seconds())
+        last = int((window_end - DATASET_EPOCH).total_seconds())
+        prefetch_timeline_blocks(tenant, first // 3600, last // 3600)
+        for hour in range(max(0, first // 3600), last // 3600 + 1):
+            hour_start = DATASET_EPOCH + timedelta(hours=hour)
+            prefix = (bucket(hour_start),) if bucket else ()
+            if first <= hour * 3600 and (hour + 1) * 3600 - 1 <= last:
+                partial = hour_rollup(tenant, hour, dims, metric_fields, filters)
+            else:
+                partial = fold_block(timeline_block(tenant, hour), dims, metric_fields, filters, (first, last))
+            merge_rollup(groups, partial, width, prefix)
+    
+    rows = []
+    for key in sorted(groups):
+        acc = groups[key]
+        row = {}
+        if bucket:
+            row[buckets[0]] = key[0]
+            key = key[1:]
+        for name, code in zip(dims, key):
+            row[name] = AGGREGATE_DIMENSIONS[name][code]
+        for name, function, field in specs:
+            if function == 'count':
+                row[name] = acc[0]
+                continue
+            j = metric_fields.index(field)
+            value = {
+                'sum': acc[1 + j],
+                'avg': acc[1 + j] / acc[0],
+                'min': acc[1 + width + j],
+                'max': acc[1 + 2 * width + j]
+            }[function]
+            row[name] = round(value, 2) if isinstance(value, float) else value
+        rows.append(row)
+    
+    return {
         "success": True,
-        "message": "Logged out successfully"
-    })
+        "data": rows,
+        "count": len(rows),
+        "groupBy": group_by,
+        "metrics": [name for name, _, _ in specs],
+        "filters": {
+            "startDate": start_date_str,
+            "endDate": end_date_str,
+            "extension": extension,
+            "direction": direction
+        },
+        "period": {
+            "start": window_start.isoformat(),
+            "end": window_end.isoformat()
+        },
+        "timestamp": datetime.now().isoformat()
+    }, 200
 
 
-@app.route('/auth/users', methods=['GET'])
+@app.route(f'{BASE_PATH}/reporting/calls/aggregate', methods=['GET'])
 @require_auth
-def list_users():
+@coalesced
+def get_call_aggregates():
     """
-    List all configured users (for admin/testing)
-    Requires authentication
+    Aggregate call records server-side and return only the aggregated rows
     
-    Response:
-    {
-        "success": true,
-        "users": [...]
-    }
+    Query Parameters:
+        - groupBy: Comma-separated fields to group by (see AGGREGATE_DIMENSIONS,
+          e.g. Extno, Direction, Call_outcome) plus at most one time bucket:
+          hour, day, week, month, hourOfDay, dayOfWeek (default: no grouping)
+        - metrics: Comma-separated metrics: count, or sum/avg/min/max over a
+          numeric field as <function>:<field>, e.g. avg:Duration (default: count)
+        - startDate, endDate: Date range (ISO 8601, at most AGGREGATE_MAX_DAYS)
+        - extension: Filter by extension number
+        - direction: Filter by direction (I/O/B)
+    
+    Aggregates cover the same timeline /reporting/calls pages through.
+    
+    Examples:
+        /api/v1/reporting/calls/aggregate?groupBy=Extno&metrics=count,avg:Duration,avg:waitTime
+        /api/v1/reporting/calls/aggregate?groupBy=hour,Call_outcome&startDate=2025-11-20&endDate=2025-11-20
+        /api/v1/reporting/calls/aggregate?groupBy=dayOfWeek&metrics=count,max:Ring_time&direction=I
     """
-    users = get_users()
+    try:
+        payload, status = query_call_aggregates(request.args)
+        return jsonify(payload), status
     
-    # Return users without passwords
-    safe_users = []
-    for username, user_data in users.items():
-        safe_users.append({
-            "username": username,
-            "account_id": user_data.get('account_id', '1'),
-            "role": user_data.get('role', 'user'),
-            "name": user_data.get('name', username)
+    except Exception as e:
+        logger.exception("Error: %s", e)
+        return jsonify({
+            "success": False,
+            "error": {
+                "code": "INTERNAL_ERROR",
+                "message": str(e)
+            }
+        }), 500
+
+
+def parse_sketch_field(args):
+    """Validate the `field=` of a sketch query (default: Number)"""
+    field = args.get('field', 'Number')
+    if field not in SKETCH_KEY_FIELDS:
+        raise ValueError(f"field must be one of: {', '.join(SKETCH_KEY_FIELDS)}")
+    return field
+
+
+def query_call_distinct(args):
+    """
+    Run a /reporting/calls/distinct query: approximate distinct values of a
+    field per time bucket, from merged per-hour HyperLogLog sketches
+    
+    Returns:
+        tuple: (response payload, HTTP status)
+    """
+    try:
+        field = parse_sketch_field(args)
+    except ValueError as e:
+        return error_payload("INVALID_FIELD", str(e)), 400
+    bucket_name = args.get('bucket')
+    if bucket_name and bucket_name not in TIME_BUCKETS:
+        return error_payload("INVALID_BUCKET", f"bucket must be one of: {', '.join(TIME_BUCKETS)}"), 400
+    include_sketch = args.get('includeSketch', 'false').lower() == 'true'
+    window, error = resolve_window(args)
+    if error:
+        return error
+    
+    parts = {}
+    if window[0] <= window[1]:
+        parts = window_key_sketches(current_tenant(), window[0], window[1], field, bucket_name)
+    
+    standard_error = HyperLogLog().standard_error
+    rows = []
+    for key in sorted(parts, key=lambda key: (key is None, key)):
+        hlls, summaries = parts[key]
+        sketch = HyperLogLog.merged(hlls)
+        estimate = sketch.estimate()
+        row = {bucket_name: key} if bucket_name else {}
+        row.update({
+            "distinct": round(estimate),
+            "lowerBound": math.floor(estimate * (1 - 1.96 * standard_error)),
+            "upperBound": math.ceil(estimate * (1 + 1.96 * standard_error)),
+            "calls": sum(summary.total for summary in summaries)
         })
+        if include_sketch:
+            row["sketch"] = sketch.serialize()
+        rows.append(row)
     
-    return jsonify({
+    return {
         "success": True,
-        "users": safe_users,
-        "count": len(safe_users),
-        "management_mode": USER_MGMT_MODE
-    })
+        "data": rows,
+        "count": len(rows),
+        "field": field,
+        "bucket": bucket_name,
+        "error": {
+            "standardError": round(standard_error, 4),
+            "confidence": 0.95,
+            "sketchBytes": 1 << HLL_PRECISION
+        },
+        "period": {
+            "start": window[0].isoformat(),
+            "end": window[1].isoformat()
+        },
+        "timestamp": datetime.now().isoformat()
+    }, 200
 
 
-@app.route('/health')
-def health():
-    """Health check endpoint"""
-    return jsonify({
-        "status": "healthy",
-        "timestamp": datetime.now().isoformat(),
-        "service": "mitel-micontact-center-api"
-    })
+def query_call_top(args):
+    """
+    Run a /reporting/calls/top query: the most frequent values of a field,
+    from merged per-hour space-saving sketches
+    
+    Returns:
+        tuple: (response payload, HTTP status)
+    """
+    try:
+        field = parse_sketch_field(args)
+    except ValueError as e:
+        return error_payload("INVALID_FIELD", str(e)), 400
+    k = max(1, min(int(args.get('k', 20)), HEAVY_HITTER_CAPACITY))
+    include_sketch = args.get('includeSketch', 'false').lower() == 'true'
+    window, error = resolve_window(args)
+    if error:
+        return error
+    
+    summaries = []
+    if window[0] <= window[1]:
+        for _, hour_summaries in window_key_sketches(current_tenant(), window[0], window[1], field).values():
+            summaries.extend(hour_summaries)
+    summary = SpaceSaving.merged(summaries)
+    
+    rows = [
+        {
+            "value": sketch_key_label(field, key),
+            "count": count,
+            "lowerBound": lower,
+            "guaranteed": guaranteed
+        }
+        for key, count, lower, guaranteed in summary.top(k)
+    ]
+    payload = {
+        "success": True,
+        "data": rows,
+        "count": len(rows),
+        "field": field,
+        "totalCalls": summary.total,
+        "error": {
+            "maxOverestimate": max((row["count"] - row["lowerBound"] for row in rows), default=0),
+            "unlistedMax": summary.floor,
+            "counters": summary.capacity
+        },
+        "period": {
+            "start": window[0].isoformat(),
+            "end": window[1].isoformat()
+        },
+        "timestamp": datetime.now().isoformat()
+    }
+    if include_sketch:
+        payload["sketch"] = {
+            "capacity": summary.capacity,
+            "floor": summary.floor,
+            "total": summary.total,
+            "counters": [
+                [sketch_key_label(field, key), count, summary.errors[key]]
+                for key, count in summary.counts.items()
+            ]
+        }
+    return payload, 200
 
 
-@app.route(f'{BASE_PATH}/reporting/calls', methods=['GET'])
+@app.route(f'{BASE_PATH}/reporting/calls/distinct', methods=['GET'])
 @require_auth
-def get_call_records():
+@coalesced
+def get_call_distinct():
     """
-    Get Call Detail Records - Mitel MiContact Center format
+    Approximate number of distinct values of a field (e.g. unique callers)
+    
+    Backed by one HyperLogLog sketch per timeline hour and field, merged over
+    the requested window and bucket.
     
     Query Parameters:
-        - startDate: Start date/time (ISO 8601: YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS)
-        - endDate: End date/time (ISO 8601: YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS)
-        - extension: Filter by extension number
-        - direction: Filter by direction (I/O/B)
-        - limit: Max records to return (default: 50, max: 500)
-        - offset: Pagination offset (default: 0)
+        - field: Number (default) or a groupable field (see SKETCH_KEY_FIELDS)
+        - bucket: Time bucket: hour, day, week, month, hourOfDay, dayOfWeek
+          (default: one count for the whole range)
+        - startDate, endDate: Date range (ISO 8601, at most AGGREGATE_MAX_DAYS)
+        - includeSketch: true to return each bucket's registers (base64) for
+          merging elsewhere (register-wise maximum)
+    
+    `error.standardError` is the relative standard error of each count;
+    lowerBound/upperBound are its 95% confidence interval.
     
     Examples:
-        /api/v1/reporting/calls?startDate=2025-11-20&endDate=2025-11-22
-        /api/v1/reporting/calls?startDate=2025-11-20T00:00:00&endDate=2025-11-22T23:59:59
-        /api/v1/reporting/calls?extension=694311&limit=50
-        /api/v1/reporting/calls?direction=I&startDate=2025-11-20
+        /api/v1/reporting/calls/distinct?bucket=day&startDate=2025-11-01&endDate=2025-11-30
+        /api/v1/reporting/calls/distinct?field=Username
     """
     try:
-        # Parse parameters
-        limit = min(int(request.args.get('limit', 50)), 500)
-        offset = int(request.args.get('offset', 0))
-        extension = request.args.get('extension')
-        direction = request.args.get('direction')
-        start_date_str = request.args.get('startDate')
-        end_date_str = request.args.get('endDate')
-        
-        # Parse and validate dates
-        try:
-            start_date = parse_date_param(start_date_str, 'startDate', end_of_day=False)
-            end_date = parse_date_param(end_date_str, 'endDate', end_of_day=True)
-        except ValueError as e:
-            return jsonify({
-                "success": False,
-                "error": {
-                    "code": "INVALID_DATE_FORMAT",
-                    "message": str(e)
-                }
-            }), 400
-        
-        # Validate date range
-        if start_date and end_date and start_date > end_date:
-            return jsonify({
-                "success": False,
-                "error": {
-                    "code": "INVALID_DATE_RANGE",
-                    "message": "startDate must be before or equal to endDate"
-                }
-            }), 400
-        
-        # Generate records
-        records = []
-        attempts = 0
-        max_attempts = limit * 3  # Avoid infinite loop with filters
-        
-        while len(records) < limit and attempts < max_attempts:
-            record = generate_call_record(start_date, end_date)
-            attempts += 1
-            
-            # Apply filters
-            if extension and record['Extno'] != extension:
-                continue
-            if direction and record['Direction'] != direction:
-                continue
-            
-            records.append(record)
-        
-        logger.info(f"Generated {len(records)} call records (date range: {start_date_str} to {end_date_str})")
-        
+        payload, status = query_call_distinct(request.args)
+        return jsonify(payload), status
+    
+    except Exception as e:
+        logger.exception("Error: %s", e)
         return jsonify({
-            "success": True,
-            "data": records,
-            "filters": {
-                "startDate": start_date_str,
-                "endDate": end_date_str,
-                "extension": extension,
-                "direction": direction
-            },
-            "pagination": {
-                "limit": limit,
-                "offset": offset,
-                "total": len(records),
-                "hasMore": False  # Mock response
-            },
-            "timestamp": datetime.now().isoformat()
-        })
+            "success": False,
+            "error": {
+                "code": "INTERNAL_ERROR",
+                "message": str(e)
+            }
+        }), 500
+
+
+@app.route(f'{BASE_PATH}/reporting/calls/top', methods=['GET'])
+@require_auth
+@coalesced
+def get_call_top():
+    """
+    Most frequent values of a field (e.g. top calling numbers, busiest extensions)
+    
+    Backed by one space-saving sketch (HEAVY_HITTER_CAPACITY counters) per
+    timeline hour and field, merged over the requested window.
+    
+    Query Parameters:
+        - field: Number (default) or a groupable field (see SKETCH_KEY_FIELDS)
+        - k: Number of values to return (default: 20)
+        - startDate, endDate: Date range (ISO 8601, at most AGGREGATE_MAX_DAYS)
+        - includeSketch: true to also return the merged counters
     
+    Each value's true count is between `lowerBound` and `count`; `guaranteed`
+    marks values certainly in the top k. No unlisted value occurs more than
+    `error.unlistedMax` times.
+    
+    Examples:
+        /api/v1/reporting/calls/top?k=20&startDate=2025-11-01&endDate=2025-11-30
+        /api/v1/reporting/calls/top?field=Extno&k=5
+    """
+    try:
+        payload, status = query_call_top(request.args)
+        return jsonify(payload), status
+    
+    except ValueError as e:
+        return error_response("INVALID_PARAMETER", str(e), 400)
     except Exception as e:
-        logger.error(f"Error: {str(e)}")
+        logger.exception("Error: %s", e)
         return jsonify({
             "success": False,
             "error": {
@@ -771,10 +7380,46 @@ def stream_call_records():
     Query Parameters:
         - startDate: Start date (ISO 8601)
         - endDate: End date (ISO 8601)
-        - limit: Number of messages (default: 50, max: 500)
+        - limit: Number of messages (default: 50, max: STREAM_MAX_LIMIT, 500 by default)
+        - fields: Comma-separated CDR fields in each message value (default: all)
+        - speed: Replay the call timeline from startDate (default: now) on a
+          simulated clock running this many times faster than real time
+          (max: SIMULATION_MAX_SPEED). Messages are sent as newline-delimited
+          JSON, each when the clock reaches its call, with the call time as
+          Kafka timestamp and its timeline slot as offset. The replay stops
+          at endDate, `limit` messages (default and max:
+          SIMULATION_MAX_RECORDS) or after SIMULATION_MAX_SECONDS. At most
+          SIMULATION_MAX_REPLAYS replays run per worker (503 beyond), and
+          record quotas are charged the messages the replay can reach.
+    
+    Requests for PARALLEL_MIN_RECORDS or more messages are generated in the
+    process pool and the JSON body is streamed range by range.
+    
+    Examples:
+        /api/v1/reporting/calls/stream?limit=100
+        /api/v1/reporting/calls/stream?startDate=2025-11-17T08:00:00&endDate=2025-11-17T12:00:00&speed=240
     """
     try:
-        limit = min(int(request.args.get('limit', 50)), 500)
+        speed = request.args.get('speed')
+        if speed is not None:
+            try:
+                speed = float(speed)
+            except ValueError:
+                speed = 0.0
+            if not 0 < speed <= SIMULATION_MAX_SPEED:
+                return jsonify({
+                    "success": False,
+                    "error": {
+                        "code": "INVALID_SPEED",
+                        "message": f"speed must be a number > 0 and <= {SIMULATION_MAX_SPEED:g}"
+                    }
+                }), 400
+            default_limit = SIMULATION_MAX_RECORDS
+            max_limit = SIMULATION_MAX_RECORDS
+        else:
+            default_limit = 50
+            max_limit = STREAM_MAX_LIMIT
+        limit = min(int(request.args.get('limit', default_limit)), max_limit)
         start_date_str = request.args.get('startDate')
         end_date_str = request.args.get('endDate')
         
@@ -791,27 +7436,72 @@ def stream_call_records():
                 }
             }), 400
         
+        # Compile the field projection (validated once per distinct value)
+        try:
+            projection = get_projection(request.args.get('fields'))
+        except ValueError as e:
+            return jsonify({
+                "success": False,
+                "error": {
+                    "code": "INVALID_FIELDS",
+                    "message": str(e)
+                }
+            }), 400
+        
+        filters = {
+            "startDate": start_date_str,
+            "endDate": end_date_str,
+            "fields": request.args.get('fields')
+        }
+        tenant = current_tenant()
+        
+        if speed is not None:
+            clock = SimulatedClock(dataset_time(start_date) if start_date else datetime.now(), speed)
+            if not replay_slots.acquire(blocking=False):
+                return error_response(
+                    "TOO_MANY_REPLAYS",
+                    f"{SIMULATION_MAX_REPLAYS} replays are already running. Retry after 1 seconds",
+                    503,
+                    headers={'Retry-After': '1'}
+                )
+            request.record_count = replay_record_limit(request.args, tenant)
+            body, release = hold_slot(
+                replay_slots,
+                replay_timeline(tenant, clock, dataset_time(end_date) if end_date else None, limit,
+                                projection, clock.origin + SIMULATION_MAX_SECONDS)
+            )
+            response = Response(body, mimetype='application/x-ndjson')
+            response.call_on_close(release)
+            # Deliver each message when it is sent, not when the proxy buffer fills
+            response.headers['X-Accel-Buffering'] = 'no'
+            return response
+        
+        if limit >= PARALLEL_MIN_RECORDS:
+            request.record_count = limit
+            return Response(
+                generate_stream_body(tenant, request.args.get('fields'), limit, start_date, end_date,
+                                     filters),
+                mimetype='application/json'
+            )
+        
         messages = []
-        for _ in range(limit):
-            record = generate_call_record(start_date, end_date)
-            message = wrap_in_kafka_format(record)
+        for core in generate_call_cores(limit, start_date, end_date, tenant=tenant):
+            message = wrap_in_kafka_format(projection.build(core), core.record_id)
             messages.append(message)
         
-        logger.info(f"Generated {len(messages)} Kafka-formatted messages")
+        request.record_count = len(messages)
+        logger.debug("Generated %d Kafka-formatted messages", len(messages))
         
         return jsonify({
             "success": True,
             "messages": messages,
             "count": len(messages),
-            "filters": {
-                "startDate": start_date_str,
-                "endDate": end_date_str
-            },
+            "filters": filters,
             "timestamp": datetime.now().isoformat()
         })
     
     except Exception as e:
-        logger.error(f"Error: {str(e)}")
+        logger.exception("Error: %s", e)
         return jsonify({
             "success": False,
             "error": {
@@ -831,10 +7521,37 @@ def export_calls_csv():
     Query Parameters:
         - startDate: Start date (ISO 8601)
         - endDate: End date (ISO 8601)
-        - limit: Number of records (default: 100, max: 1000)
+        - limit: Number of records (default: 100, max: CSV_EXPORT_MAX_LIMIT for
+          CSV, 1000 by default, and COLUMNAR_EXPORT_MAX_LIMIT for arrow/parquet)
+        - fields: Comma-separated CDR fields in each value cell (default: all)
+        - format: 'csv' (default, Kafka-style), 'arrow' (Arrow IPC stream)
+          or 'parquet'. Columnar formats have one typed column per CDR field
+          and are streamed in row groups of EXPORT_ROW_GROUP_SIZE records
+    
+    Exports of PARALLEL_MIN_RECORDS or more records are split into ranges,
+    generated in the process pool and streamed back in order.
     """
     try:
-        limit = min(int(request.args.get('limit', 100)), 1000)
+        export_format = request.args.get('format', 'csv').lower()
+        if export_format not in EXPORT_FORMATS:
+            return jsonify({
+                "success": False,
+                "error": {
+                    "code": "INVALID_FORMAT",
+                    "message": f"format must be one of: {', '.join(EXPORT_FORMATS)}"
+                }
+            }), 400
+        if export_format != "csv" and pa is None:
+            return jsonify({
+                "success": False,
+                "error": {
+                    "code": "FORMAT_UNAVAILABLE",
+                    "message": f"format={export_format} requires pyarrow to be installed"
+                }
+            }), 501
+        
+        default_limit, max_limit = export_limits(export_format)
+        limit = min(int(request.args.get('limit', default_limit)), max_limit)
         start_date_str = request.args.get('startDate')
         end_date_str = request.args.get('endDate')
         
@@ -851,26 +7568,17 @@ def export_calls_csv():
                 }
             }), 400
         
-        # CSV header
-        csv_lines = ["timestamp,timestampType,partition,offset,key,value,headers,exceededFields"]
-        
-        for _ in range(limit):
-            record = generate_call_record(start_date, end_date)
-            message = wrap_in_kafka_format(record)
-            
-            # Format as CSV line (matching your source file)
-            line = (
-                f"{message['timestamp']},"
-                f"{message['timestampType']},"
-                f"{message['partition']},"
-                f"{message['offset']},"
-                f'"{json.dumps(message["key"])}",'
-                f'"{json.dumps(message["value"])}",'
-                f"[],"
-            )
-            csv_lines.append(line)
-        
-        csv_content = '\n'.join(csv_lines)
+        # Compile the field projection (validated once per distinct value)
+        try:
+            projection = get_projection(request.args.get('fields'))
+        except ValueError as e:
+            return jsonify({
+                "success": False,
+                "error": {
+                    "code": "INVALID_FIELDS",
+                    "message": str(e)
+                }
+            }), 400
         
         # Generate filename with date range if provided
         filename = "mitel_call_records"
@@ -878,18 +7586,51 @@ def export_calls_csv():
             filename += f"_{start_date_str}"
         if end_date_str:
             filename += f"_to_{end_date_str}"
-        filename += ".csv"
+        mimetype, extension = EXPORT_FORMATS[export_format]
+        filename += f".{extension}"
+        
+        if export_format != "csv":
+            request.record_count = limit
+            return Response(
+                generate_columnar_export(current_tenant(), export_format, request.args.get('fields'),
+                                         limit, start_date, end_date),
+                mimetype=mimetype,
+                headers={
+                    'Content-Disposition': f'attachment; filename={filename}'
+                }
+            )
+        
+        if limit >= PARALLEL_MIN_RECORDS:
+            request.record_count = limit
+            chunks = generate_record_chunks(current_tenant(), 'csv', request.args.get('fields'), limit,
+                                            start_date, end_date, PARALLEL_CHUNK_SIZE)
+            return Response(
+                itertools.chain([KAFKA_CSV_HEADER.encode()], chunks),
+                mimetype=mimetype,
+                headers={
+                    'Content-Disposition': f'attachment; filename={filename}'
+                }
+            )
+        
+        csv_lines = [KAFKA_CSV_HEADER]
+        tenant = current_tenant()
+        for core in generate_call_cores(limit, start_date, end_date, tenant=tenant):
+            message = wrap_in_kafka_format(projection.build(core), core.record_id)
+            csv_lines.append(kafka_csv_line(message))
+        
+        request.record_count = len(csv_lines) - 1
+        csv_content = '\n'.join(csv_lines)
         
         return Response(
             csv_content,
-            mimetype='text/csv',
+            mimetype=mimetype,
             headers={
                 'Content-Disposition': f'attachment; filename={filename}'
             }
         )
     
     except Exception as e:
-        logger.error(f"Error: {str(e)}")
+        logger.exception("Error: %s", e)
         return jsonify({
             "success": False,
             "error": {
@@ -899,86 +7640,792 @@ def export_calls_csv():
         }), 500
 
 
-@app.route(f'{BASE_PATH}/reporting/agents', methods=['GET'])
+@app.route(f'{BASE_PATH}/reporting/exports', methods=['POST'])
 @require_auth
-def get_agents():
-    """Get list of agents/extensions"""
-    agents = []
-    for ext in EXTENSIONS:
-        agents.append({
-            "extension": ext,
-            "username": random.choice(USERNAMES),
-            "groupNumber": random.choice(GROUP_NUMBERS),
-            "deviceId": random.choice(DEVICE_IDS),
-            "status": random.choice(["Available", "Busy", "Away", "Offline"])
-        })
+def create_export_job():
+    """
+    Submit an export job
     
-    return jsonify({
+    The export is written in the background to a gzip file, which is then
+    downloaded from /reporting/exports/<id>/download. Records are the same
+    as /reporting/calls returns for the date range and filters, in Call_date
+    order, as Kafka messages.
+    
+    Request Body (JSON):
+        - startDate: Start date (ISO 8601)
+        - endDate: End date (ISO 8601, default: now)
+        - extension: Filter by extension number
+        - direction: Filter by call direction (I/O/B)
+        - fields: Comma-separated CDR fields in each message value (default: all)
+        - format: 'csv' (default, Kafka-style CSV) or 'ndjson' (one message per line)
+    
+    Returns:
+        202 with the job status; poll its `links.self` until `status` is
+        'completed' (or 'failed')
+    
+    Example:
+        POST /api/v1/reporting/exports
+        {"startDate": "2025-11-01", "endDate": "2025-11-30", "format": "ndjson"}
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return error_response("INVALID_REQUEST", "Request body must be a JSON object", 400)
+    export_format = str(data.get('format', 'csv')).lower()
+    if export_format not in EXPORT_JOB_FORMATS:
+        return error_response(
+            "INVALID_FORMAT", f"format must be one of: {', '.join(EXPORT_JOB_FORMATS)}", 400
+        )
+    
+    args = {name: str(data[name]) for name in ('startDate', 'endDate', 'extension', 'direction', 'fields')
+            if data.get(name) is not None}
+    tenant = current_tenant()
+    state, error = resolve_calls_query(args, tenant)
+    if error:
+        payload, status = error
+        return jsonify(payload), status
+    try:
+        get_projection(state['fields'])
+    except ValueError as e:
+        return error_response("INVALID_FIELDS", str(e), 400)
+    window = datetime.fromisoformat(state['end']) - datetime.fromisoformat(state['start'])
+    if window > timedelta(days=EXPORT_JOB_MAX_DAYS):
+        return error_response(
+            "INVALID_DATE_RANGE", f"Date range must not exceed {EXPORT_JOB_MAX_DAYS} days", 400
+        )
+    
+    job = submit_export_job(tenant, state, export_format)
+    response = jsonify({"success": True, "data": export_job_view(job)})
+    response.status_code = 202
+    response.headers['Location'] = f"{BASE_PATH}/reporting/exports/{job['id']}"
+    return response
+
+
+def find_export_job(job_id):
+    """The current tenant's export job by id, or None"""
+    job = read_export_job(job_id)
+    if job is None or job["tenant"] != current_tenant().key:
+        return None
+    return job
+
+
+@app.route(f'{BASE_PATH}/reporting/exports/<job_id>', methods=['GET'])
+@require_auth
+def get_export_job(job_id):
+    """
+    Get an export job's status and progress
+    
+    `status` is 'queued', 'running', 'completed' or 'failed'. `progress`
+    holds the records written so far and the share of the date range
+    scanned; completed jobs have a `file` (records, compressed size, and
+    whether EXPORT_JOB_MAX_RECORDS truncated it) and a download link.
+    """
+    job = find_export_job(job_id)
+    if job is None:
+        return error_response("EXPORT_NOT_FOUND", f"Export job '{job_id}' not found", 404)
+    return jsonify({"success": True, "data": export_job_view(job)})
+
+
+@app.route(f'{BASE_PATH}/reporting/exports/<job_id>/download', methods=['GET'])
+@require_auth
+def download_export_job(job_id):
+    """
+    Download a completed export job's gzip file
+    
+    Supports `Range` requests (with `If-Range`), so interrupted downloads
+    resume where they stopped. The file is sent with sendfile when the
+    server supports it (gunicorn does), without going through Python.
+    """
+    job = find_export_job(job_id)
+    if job is None:
+        return error_response("EXPORT_NOT_FOUND", f"Export job '{job_id}' not found", 404)
+    if job["status"] != "completed":
+        return error_response(
+            "EXPORT_NOT_READY", f"Export job '{job_id}' is {export_job_view(job)['status']}", 409
+        )
+    
+    suffix = EXPORT_JOB_FORMATS[job["format"]]
+    filename = "mitel_call_records"
+    if job["filters"]["startDate"]:
+        filename += f"_{job['filters']['startDate']}"
+    if job["filters"]["endDate"]:
+        filename += f"_to_{job['filters']['endDate']}"
+    return send_file(
+        export_job_path(job_id, suffix),
+        mimetype='application/gzip',
+        as_attachment=True,
+        download_name=f"{filename}.{suffix}",
+        conditional=True,
+        max_age=0
+    )
+
+
+@app.route(f'{BASE_PATH}/reporting/subscriptions', methods=['POST'])
+@require_auth
+def create_subscription():
+    """
+    Subscribe a webhook to the call timeline
+    
+    New calls (from startDate, default: now) matching the filters are pushed
+    to the URL as they happen, in POSTed batches of Kafka messages:
+    {"subscriptionId", "sequence", "count", "messages"}. Each batch is signed
+    with the subscription's secret, returned only in this response. A
+    tenant has at most WEBHOOK_MAX_SUBSCRIPTIONS subscriptions.
+    
+    Request Body (JSON):
+        - url: http(s) URL receiving the batches; private, loopback and
+          link-local hosts only when listed in WEBHOOK_ALLOWED_HOSTS
+        - extension: Filter by extension number
+        - direction: Filter by call direction (I/O/B)
+        - fields: Comma-separated CDR fields in each message value (default: all)
+        - startDate: Replay calls from this time first, at most
+          WEBHOOK_MAX_BACKFILL_HOURS back (ISO 8601, default: now)
+        - maxBatchRecords: Records per batch (default: WEBHOOK_BATCH_RECORDS)
+        - maxBatchDelayMs: Longest wait before a partial batch is sent
+          (default: WEBHOOK_BATCH_DELAY_MS)
+        - maxInFlight: Unanswered batches at a time; 1 keeps batches in order
+          (default: 1, max: WEBHOOK_MAX_IN_FLIGHT)
+    
+    Example:
+        POST /api/v1/reporting/subscriptions
+        {"url": "http://sink.local:8080/cdr", "direction": "I", "maxBatchRecords": 200}
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return error_response("INVALID_REQUEST", "Request body must be a JSON object", 400)
+    url = data.get('url')
+    parts = urllib.parse.urlsplit(url) if isinstance(url, str) else None
+    try:
+        port = parts.port if parts is not None else None
+    except ValueError:
+        parts = None
+    if parts is None or parts.scheme not in ('http', 'https') or not parts.hostname:
+        return error_response("INVALID_URL", "url must be an http or https URL", 400)
+    host_error = webhook_host_error(parts.hostname, port or (443 if parts.scheme == 'https' else 80))
+    if host_error:
+        return error_response("URL_NOT_ALLOWED", host_error, 400)
+    
+    try:
+        max_batch_records = int(data.get('maxBatchRecords', WEBHOOK_BATCH_RECORDS))
+        max_batch_delay_ms = int(data.get('maxBatchDelayMs', WEBHOOK_BATCH_DELAY_MS))
+        max_in_flight = int(data.get('maxInFlight', 1))
+    except (TypeError, ValueError):
+        max_batch_records = max_batch_delay_ms = max_in_flight = None
+    if (max_batch_records is None or not 1 <= max_batch_records <= WEBHOOK_MAX_BATCH_RECORDS
+            or max_batch_delay_ms < 0 or not 1 <= max_in_flight <= WEBHOOK_MAX_IN_FLIGHT):
+        return error_response(
+            "INVALID_BATCHING",
+            f"maxBatchRecords must be 1-{WEBHOOK_MAX_BATCH_RECORDS}, maxBatchDelayMs at least 0 "
+            f"and maxInFlight 1-{WEBHOOK_MAX_IN_FLIGHT}",
+            400
+        )
+    
+    filters = {name: str(data[name]) if data.get(name) is not None else None
+               for name in ('extension', 'direction', 'fields')}
+    try:
+        get_projection(filters['fields'])
+    except ValueError as e:
+        return error_response("INVALID_FIELDS", str(e), 400)
+    try:
+        start = parse_date_param(data.get('startDate'), 'startDate', end_of_day=False)
+    except ValueError as e:
+        return error_response("INVALID_DATE_FORMAT", str(e), 400)
+    
+    if start is not None and start < datetime.now() - timedelta(hours=WEBHOOK_MAX_BACKFILL_HOURS):
+        return error_response(
+            "INVALID_DATE_RANGE", f"startDate must be within the last {WEBHOOK_MAX_BACKFILL_HOURS:g} hours", 400
+        )
+    
+    tenant = current_tenant()
+    subscriptions = sum(1 for subscription_id in webhook_ids()
+                        if (read_webhook(subscription_id) or {}).get("tenant") == tenant.key)
+    if subscriptions >= WEBHOOK_MAX_SUBSCRIPTIONS:
+        return error_response(
+            "TOO_MANY_SUBSCRIPTIONS",
+            f"This tenant already has {WEBHOOK_MAX_SUBSCRIPTIONS} subscriptions; delete one first", 409
+        )
+    start = min(start or datetime.now(), datetime.now())
+    start_slot = dataset_slot(tenant, start)
+    core = dataset_core(tenant, start_slot)
+    if core is not None and core.call_date < start:
+        start_slot += 1
+    
+    config = {
+        "id": uuid.uuid4().hex,
+        "tenant": tenant.key,
+        "url": url,
+        "filters": filters,
+        "maxBatchRecords": max_batch_records,
+        "maxBatchDelayMs": max_batch_delay_ms,
+        "maxInFlight": max_in_flight,
+        "startSlot": start_slot,
+        "secret": base64.urlsafe_b64encode(os.urandom(24)).decode(),
+        "createdAt": datetime.now().isoformat()
+    }
+    os.makedirs(WEBHOOK_DIR, exist_ok=True)
+    write_json_atomic(webhook_path(config["id"]), config)
+    logger.info("Webhook subscription %s created for %s", config["id"], url)
+    
+    response = jsonify({"success": True, "data": webhook_view(config, include_secret=True)})
+    response.status_code = 201
+    response.headers['Location'] = f"{BASE_PATH}/reporting/subscriptions/{config['id']}"
+    return response
+
+
+@app.route(f'{BASE_PATH}/reporting/subscriptions', methods=['GET'])
+@require_auth
+def list_subscriptions():
+    """
+    List the current tenant's webhook subscriptions with their delivery
+    metrics: delivered, retried and dropped batches and records, failed
+    attempts, records pending, batches in flight, last status, error and
+    latency, and lagSeconds (age of the oldest call not delivered yet)
+    """
+    tenant_key = current_tenant().key
+    data = []
+    for subscription_id in sorted(webhook_ids()):
+        config = read_webhook(subscription_id)
+        if config is not None and config["tenant"] == tenant_key:
+            data.append(webhook_view(config))
+    return jsonify({"success": True, "data": data, "count": len(data)})
+
+
+def find_subscription(subscription_id):
+    """The current tenant's subscription config by id, or None"""
+    config = read_webhook(subscription_id)
+    if config is None or config["tenant"] != current_tenant().key:
+        return None
+    return config
+
+
+@app.route(f'{BASE_PATH}/reporting/subscriptions/<subscription_id>', methods=['GET', 'DELETE'])
+@require_auth
+def subscription(subscription_id):
+    """Get a webhook subscription with its delivery metrics, or delete it (stops deliveries)"""
+    config = find_subscription(subscription_id)
+    if config is None:
+        return error_response("SUBSCRIPTION_NOT_FOUND", f"Subscription '{subscription_id}' not found", 404)
+    if request.method == 'DELETE':
+        os.unlink(webhook_path(subscription_id))
+        logger.info("Webhook subscription %s deleted", subscription_id)
+    return jsonify({"success": True, "data": webhook_view(config)})
+
+
+def query_agents(args=None):
+    """
+    Run a /reporting/agents query against the current tenant's agents
+    
+    Without sinceVersion, returns a snapshot of all agents. With it, returns
+    only the agents that changed after that version (their current state)
+    and the changes themselves, or a full snapshot with "reset": true if
+    changes that old are no longer kept.
+    
+    Returns:
+        tuple: (response payload, HTTP status)
+    """
+    args = args or {}
+    agent_states = current_tenant().agents
+    since = args.get('sinceVersion')
+    delta = None
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            return error_payload("INVALID_VERSION", "sinceVersion must be an integer"), 400
+        delta = agent_states.changes(since)
+    
+    if delta is None:
+        version, agents = agent_states.snapshot()
+        payload = {
+            "success": True,
+            "data": agents,
+            "count": len(agents),
+            "version": version,
+            "timestamp": datetime.now().isoformat()
+        }
+        if since is not None:
+            payload["reset"] = True
+        return payload, 200
+    
+    version, changes = delta
+    changed = sorted({index for _, index, _ in changes})
+    agents = [agent_states.agent(index) for index in changed]
+    return {
         "success": True,
         "data": agents,
         "count": len(agents),
+        "changes": [agent_states.change(change) for change in changes],
+        "version": version,
+        "reset": False,
         "timestamp": datetime.now().isoformat()
-    })
+    }, 200
 
 
-@app.route(f'{BASE_PATH}/reporting/statistics', methods=['GET'])
+@app.route(f'{BASE_PATH}/reporting/agents', methods=['GET'])
 @require_auth
-def get_statistics():
+def get_agents():
     """
-    Get call statistics and KPIs
-    Mitel MiContact Center format
+    Get agents/extensions and their current state
+    
+    States (Available, Busy, Away, Offline) follow the call timeline and the
+    agents' shift schedules. Snapshots are built once per state version, so
+    polling is cheap; follow changes with sinceVersion or the SSE feed at
+    /reporting/agents/events instead of re-reading full snapshots.
+    
+    Query Parameters:
+        - sinceVersion: Return only agents changed after this version (the
+          "version" of a previous response)
+    
+    Examples:
+        /api/v1/reporting/agents
+        /api/v1/reporting/agents?sinceVersion=186912345
+    """
+    payload, status = query_agents(request.args)
+    return jsonify(payload), status
+
+
+def agent_event_stream(agent_states, since, deadline):
+    """
+    Yield an agent state engine's feed as server-sent events
+    
+    Starts with a "snapshot" event (or the changes after `since`, when still
+    kept), then sends a "state" event per change as it becomes due, with the
+    change's version as event id, until the deadline.
+    """
+    def event(name, version, data):
+        return f"id: {version}\nevent: {name}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+    
+    def snapshot():
+        version, agents = agent_states.snapshot()
+        return version, event("snapshot", version, {"version": version, "data": agents})
+    
+    yield f"retry: 1000\n\n"
+    delta = agent_states.changes(since) if since is not None else None
+    if delta is None:
+        last, message = snapshot()
+        yield message
+    else:
+        last = since
+    
+    idle = 0.0
+    while True:
+        delta = agent_states.changes(last)
+        if delta is None:
+            # Fell behind the change log
+            last, message = snapshot()
+            yield message
+            idle = 0.0
+        elif delta[1]:
+            for change in delta[1]:
+                yield event("state", change[0], agent_states.change(change))
+            last = delta[0]
+            idle = 0.0
+        
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        # Sleep until the engine's next change is due
+        due = agent_states.next_due - timeline_seconds(datetime.now())
+        pause = min(max(due, 0.0) + 0.05, AGENT_HEARTBEAT_SECONDS - idle, remaining)
+        time.sleep(max(pause, 0.0))
+        idle += pause
+        if idle >= AGENT_HEARTBEAT_SECONDS:
+            yield ": keep-alive\n\n"
+            idle = 0.0
+
+
+# Agent event feeds of this worker open (AGENT_STREAM_MAX_CLIENTS)
+agent_stream_slots = threading.BoundedSemaphore(max(1, AGENT_STREAM_MAX_CLIENTS))
+
+
+@app.route(f'{BASE_PATH}/reporting/agents/events', methods=['GET'])
+@require_auth
+def get_agent_events():
+    """
+    Follow agent state changes as server-sent events (text/event-stream)
+    
+    Sends a "snapshot" event, then a "state" event per change. Connections
+    last up to AGENT_STREAM_MAX_SECONDS; EventSource clients reconnect with
+    Last-Event-ID and only receive the changes they missed. Each feed holds
+    a worker thread: beyond AGENT_STREAM_MAX_CLIENTS per worker, feeds are
+    refused with 503 and clients should poll /reporting/agents?sinceVersion=.
     
     Query Parameters:
-        - startDate: Start date for statistics (ISO 8601)
-        - endDate: End date for statistics (ISO 8601)
+        - sinceVersion: Resume after this version (same as Last-Event-ID)
+    
+    Examples:
+        /api/v1/reporting/agents/events
+        /api/v1/reporting/agents/events?sinceVersion=186912345
+    """
+    since = request.headers.get('Last-Event-ID') or request.args.get('sinceVersion')
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            return jsonify({
+                "success": False,
+                "error": {
+                    "code": "INVALID_VERSION",
+                    "message": "sinceVersion must be an integer"
+                }
+            }), 400
+    
+    if not agent_stream_slots.acquire(blocking=False):
+        return error_response(
+            "TOO_MANY_STREAMS",
+            f"{AGENT_STREAM_MAX_CLIENTS} agent event feeds are already open on this worker; "
+            f"poll {BASE_PATH}/reporting/agents?sinceVersion= instead",
+            503,
+            headers={'Retry-After': '5'}
+        )
+    body, release = hold_slot(agent_stream_slots, agent_event_stream(
+        current_tenant().agents, since, time.monotonic() + AGENT_STREAM_MAX_SECONDS
+    ))
+    response = Response(body, mimetype='text/event-stream')
+    response.call_on_close(release)
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def query_statistics(args, shard=None):
     """
-    start_date_str = request.args.get('startDate')
-    end_date_str = request.args.get('endDate')
+    Run a /reporting/statistics query
+    
+    Call metrics (averages and percentiles of Duration, waitTime, Ring_time
+    and HoldDuration) are computed over the current tenant's call timeline
+    by merging the per-hour, per-extension t-digests covering the period, so
+    any window and extension costs a merge of a few small sketches. Call
+    volume, service level, journey and handle time metrics are summed from
+    per-hour call counters the same way (see CALL_COUNTERS), and agent
+    metrics come from the agent state engine. In a cluster, each shard
+    merges its own digests and counters and the node answering the request
+    merges theirs.
+    
+    Args:
+        args: Query parameters (request.args or a dict)
+        shard: Only summarize this cluster shard's calls, and include its
+               serialized digests for gather_statistics_sketches
+    
+    Returns:
+        tuple: (response payload, HTTP status)
+    """
+    start_date_str = args.get('startDate')
+    end_date_str = args.get('endDate')
+    extension = args.get('extension')
+    
+    try:
+        start_date = parse_date_param(start_date_str, 'startDate', end_of_day=False)
+        end_date = parse_date_param(end_date_str, 'endDate', end_of_day=True)
+    except ValueError as e:
+        return error_payload("INVALID_DATE_FORMAT", str(e)), 400
+    if start_date and end_date and start_date > end_date:
+        return error_payload("INVALID_DATE_RANGE", "startDate must be before or equal to endDate"), 400
+    
+    try:
+        percentiles = [float(p) for p in args.get('percentiles', '50,90,99').split(',') if p.strip()]
+    except ValueError:
+        percentiles = None
+    if not percentiles or not all(0 <= p <= 100 for p in percentiles):
+        return error_payload(
+            "INVALID_PERCENTILES", "percentiles must be comma-separated numbers between 0 and 100"
+        ), 400
     
     # Default to last 24 hours if not specified
-    if not start_date_str:
-        start_date = datetime.now() - timedelta(days=1)
+    if not start_date:
+        start_date = (end_date or datetime.now()) - timedelta(days=1)
         start_date_str = start_date.isoformat()
     if not end_date_str:
         end_date_str = datetime.now().isoformat()
+    window_start, window_end = dataset_window(start_date, end_date)
+    window_end = min(window_end, datetime.now().replace(microsecond=0))
+    if window_end - window_start > timedelta(days=AGGREGATE_MAX_DAYS):
+        return error_payload(
+            "INVALID_DATE_RANGE", f"Date range must not exceed {AGGREGATE_MAX_DAYS} days"
+        ), 400
     
-    return jsonify({
+    tenant = current_tenant()
+    extension_code = DIMENSION_CODES["Extno"].get(extension) if extension else None
+    if (extension and extension_code is None) or window_start > window_end:
+        sketches = {name: TDigest() for name in SKETCH_FIELDS}
+        counts = dict.fromkeys(CALL_COUNTERS, 0)
+    elif CLUSTER_PEERS and shard is None:
+        sketches, counts = gather_statistics_sketches(window_start, window_end, extension)
+    else:
+        sketches = window_sketches(tenant, window_start, window_end, extension_code, shard)
+        counts = window_call_counts(tenant, window_start, window_end, extension_code, shard)
+    
+    # Agents are one per extension; active ones are logged in right now
+    agent_states = tenant.agents
+    agent_states.advance()
+    if extension:
+        indexes = [tenant.extension_index[extension]] if extension in tenant.extension_index else []
+    else:
+        indexes = range(len(tenant.extensions))
+    
+    def rounded(value):
+        return None if value is None else round(value, 1)
+    
+    def ratio(numerator, denominator, digits=1):
+        return round(counts[numerator] / counts[denominator], digits) if counts[denominator] else None
+    
+    payload = {
         "success": True,
         "data": {
             "callVolume": {
-                "totalCalls": random.randint(500, 2000),
-                "inboundCalls": random.randint(300, 1000),
-                "outboundCalls": random.randint(200, 1000),
-                "answeredCalls": random.randint(400, 1800),
-                "missedCalls": random.randint(50, 200)
+                "totalCalls": counts["calls"],
+                "inboundCalls": counts["inbound"],
+                "outboundCalls": counts["outbound"],
+                "answeredCalls": counts["answered"],
+                "missedCalls": counts["missed"]
             },
             "callMetrics": {
-                "averageDuration": random.randint(120, 300),
-                "averageWaitTime": random.randint(15, 60),
-                "averageHoldTime": random.randint(10, 45),
-                "serviceLevel": round(random.uniform(0.85, 0.98), 2)
+                "averageDuration": rounded(sketches["Duration"].mean),
+                "averageWaitTime": rounded(sketches["waitTime"].mean),
+                "averageHoldTime": rounded(sketches["HoldDuration"].mean),
+                "serviceLevel": ratio("inboundInTarget", "inbound", 2),
+                "percentiles": {
+                    name: {
+                        f"p{p:g}": rounded(digest.quantile(p / 100)) for p in percentiles
+                    }
+                    for name, digest in sketches.items()
+                }
             },
             "journeyMetrics": {
-                "totalJourneys": random.randint(400, 1800),
-                "completedJourneys": random.randint(350, 1700),
-                "averageContactPoints": round(random.uniform(1.0, 2.5), 2),
-                "averageExperienceRating": round(random.uniform(3.5, 4.8), 1)
+                "totalJourneys": counts["journeys"],
+                "completedJourneys": counts["completedJourneys"],
+                "averageContactPoints": ratio("contactPoints", "journeys", 2),
+                "averageExperienceRating": ratio("rating", "rated")
             },
             "agentMetrics": {
-                "totalAgents": len(EXTENSIONS),
-                "activeAgents": random.randint(5, len(EXTENSIONS)),
-                "averageHandleTime": random.randint(180, 360)
+                "totalAgents": len(indexes),
+                "activeAgents": sum(1 for index in indexes if agent_states.states[index] != OFFLINE),
+                "averageHandleTime": ratio("talkTime", "answered", 0)
             }
         },
         "period": {
             "startDate": start_date_str,
-            "endDate": end_date_str
+            "endDate": end_date_str,
+            "extension": extension
+        },
+        "timestamp": datetime.now().isoformat()
+    }
+    if shard is not None:
+        payload["shard"] = {"sketches": {name: digest.serialize() for name, digest in sketches.items()},
+                            "counts": counts}
+    return payload, 200
+
+
+@app.route(f'{BASE_PATH}/reporting/statistics', methods=['GET'])
+@require_auth
+@coalesced
+def get_statistics():
+    """
+    Get call statistics and KPIs
+    Mitel MiContact Center format
+    
+    Query Parameters:
+        - startDate: Start date for statistics (ISO 8601, default: 24 hours before endDate)
+        - endDate: End date for statistics (ISO 8601, default: now)
+        - extension: Only calls of this extension
+        - percentiles: Comma-separated percentiles of call metrics (default: 50,90,99)
+    
+    Example:
+        /api/v1/reporting/statistics?startDate=2025-11-20&endDate=2025-11-20&percentiles=50,95,99.9
+    """
+    payload, status = query_statistics(request.args, shard=cluster_shard())
+    return jsonify(payload), status
+
+
+# Sub-query routes accepted by /reporting/batch
+BATCH_QUERIES = {
+    "calls": query_call_records,
+    "search": query_call_search,
+    "journeys": query_journey,
+    "aggregate": query_call_aggregates,
+    "distinct": query_call_distinct,
+    "top": query_call_top,
+    "statistics": query_statistics,
+    "agents": query_agents
+}
+
+
+@app.route(f'{BASE_PATH}/reporting/batch', methods=['POST'])
+@require_auth
+def batch_reporting():
+    """
+    Run many reporting queries in one round trip
+    
+    The token is validated once for the whole batch, and /calls sub-queries
+    share generated timeline slots, so overlapping ranges are generated once.
+    
+    Request Body:
+    {
+        "queries": [
+            {"id": "ext-694311", "route": "calls", "params": {"extension": "694311", "limit": 20}},
+            {"id": "stats", "route": "statistics", "params": {"startDate": "2025-11-20"}}
+        ]
+    }
+    
+    Routes: 'calls', 'search', 'journeys' (with a callId parameter), 'aggregate', 'distinct', 'top',
+    'statistics', 'agents' (same parameters as the GET endpoints). At most BATCH_MAX_QUERIES
+    sub-queries per batch.
+    
+    Response:
+    {
+        "success": true,
+        "results": {
+            "ext-694311": {"status": 200, "body": {...}},
+            "stats": {"status": 200, "body": {...}}
         },
+        "count": 2
+    }
+    """
+    data = request.get_json(silent=True) or {}
+    queries = data.get('queries')
+    
+    if not isinstance(queries, list) or not queries:
+        return error_response("INVALID_BATCH", "Request body must contain a non-empty 'queries' list", 400)
+    if len(queries) > BATCH_MAX_QUERIES:
+        return error_response(
+            "INVALID_BATCH", f"A batch may contain at most {BATCH_MAX_QUERIES} queries", 400
+        )
+    
+    # Validate the whole batch before running anything
+    plan = []
+    for index, query in enumerate(queries):
+        if not isinstance(query, dict):
+            return error_response("INVALID_BATCH", f"Query {index} must be an object", 400)
+        query_id = str(query.get('id', index))
+        route = query.get('route')
+        params = query.get('params') or {}
+        if route not in BATCH_QUERIES:
+            return error_response(
+                "INVALID_BATCH",
+                f"Query '{query_id}': route must be one of: {', '.join(BATCH_QUERIES)}",
+                400
+            )
+        if not isinstance(params, dict):
+            return error_response("INVALID_BATCH", f"Query '{query_id}': params must be an object", 400)
+        if any(query_id == planned[0] for planned in plan):
+            return error_response("INVALID_BATCH", f"Duplicate query id '{query_id}'", 400)
+        plan.append((query_id, route, {key: str(value) for key, value in params.items()}))
+    
+    core_cache = {}
+    results = {}
+    record_count = 0
+    for query_id, route, params in plan:
+        try:
+            if route == "calls":
+                payload, status = query_call_records(params, core_cache)
+                if status == 200:
+                    record_count += len(payload["data"])
+            else:
+                payload, status = BATCH_QUERIES[route](params)
+        except (ValueError, TypeError) as e:
+            payload, status = error_payload("INVALID_PARAMETER", str(e)), 400
+        results[query_id] = {"status": status, "body": payload}
+    
+    request.record_count = record_count
+    return jsonify({
+        "success": True,
+        "results": results,
+        "count": len(results),
         "timestamp": datetime.now().isoformat()
     })
 
 
-if __name__ == '__main__':
+# ==================== WARMUP ====================
+
+# Startup timings, filled in by warmup() and reported by /health
+startup_stats = {}
+worker_started = {"pid": os.getpid(), "at": time.time()}
+
+
+def mark_worker_started():
+    """Record when this (forked) worker started"""
+    worker_started["pid"] = os.getpid()
+    worker_started["at"] = time.time()
+
+
+os.register_at_fork(after_in_child=mark_worker_started)
+
+
+def warmup(hours=WARMUP_HOURS):
+    """
+    Build shared caches once, before workers are forked
+    
+    Compiles the full record projection and its JSON templates, builds the
+    column blocks, t-digests, call counters, caller sketches and search
+    indexes of the last `hours` completed timeline hours and starts the
+    agent state engine, for every tenant. Everything built is then moved to
+    the collector's permanent generation (gc.freeze), so the collector
+    never writes to those objects and their copy-on-write pages stay shared
+    with the forked workers. Block columns live in array buffers, which
+    reference counting does not touch either.
+    """
+    started = time.perf_counter()
+    FULL_PROJECTION.template(True)
+    FULL_PROJECTION.template(False)
+    
+    last_hour = int((datetime.now() - DATASET_EPOCH).total_seconds()) // 3600 - 1
+    first_hour = max(0, last_hour - hours + 1)
+    for tenant in tenants.values():
+        for hour in range(first_hour, last_hour + 1):
+            completed_timeline_block(tenant, hour)
+            hour_sketches(tenant, hour)
+            hour_call_counts(tenant, hour)
+            hour_key_sketches(tenant, hour, "Number")
+            hour_search_index(tenant, hour)
+        tenant.agents.advance()
+    
+    gc.collect()
+    gc.freeze()
+    startup_stats.update({
+        "initMs": round((started - INIT_STARTED) * 1000, 1),
+        "warmupMs": round((time.perf_counter() - started) * 1000, 1),
+        "warmedHours": max(0, last_hour - first_hour + 1),
+        "tenants": len(tenants),
+        "frozenObjects": gc.get_freeze_count()
+    })
+    logger.info("Warmup built %d timeline hours in %.0f ms (module init %.0f ms)",
+                startup_stats["warmedHours"], startup_stats["warmupMs"], startup_stats["initMs"],
+                extra={"fields": dict(startup_stats)})
+
+
+def process_memory():
+    """
+    This process's memory in MB from /proc/self/smaps_rollup (Linux):
+    rss, pss (shared pages split between the processes sharing them) and
+    private (pages only this process has written). None when unavailable.
+    """
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            values = {}
+            for line in f:
+                name, _, rest = line.partition(':')
+                if name in ('Rss', 'Pss', 'Private_Clean', 'Private_Dirty'):
+                    values[name] = int(rest.split()[0]) / 1024
+    except (OSError, ValueError, IndexError):
+        return None
+    return {
+        "rssMb": round(values.get('Rss', 0), 1),
+        "pssMb": round(values.get('Pss', 0), 1),
+        "privateMb": round(values.get('Private_Clean', 0) + values.get('Private_Dirty', 0), 1)
+    }
+
+
+# Warm up at import: once in the gunicorn master with --preload. Process-pool
+# children (multiprocessing) only generate records and skip it.
+if WARMUP_HOURS > 0 and multiprocessing.parent_process() is None:
+    warmup()
+else:
+    startup_stats["initMs"] = round((time.perf_counter() - INIT_STARTED) * 1000, 1)
+
+
+if __name__ == '__main__' and '--webhook-dispatcher' in sys.argv[1:]:
+    # Deliver webhooks from this process (WEBHOOK_DISPATCHER=external)
+    WebhookDispatcher().run()
+elif __name__ == '__main__':
     print("=" * 70)
     print("Mitel MiContact Center Historical Reporting API - Mock Server")
     print("=" * 70)
@@ -986,16 +8433,25 @@ if __name__ == '__main__':
     print(f"Base Path: {BASE_PATH}")
     print("\nEndpoints:")
     print(f"  - {BASE_PATH}/reporting/calls")
+    print(f"  - {BASE_PATH}/reporting/calls/changes")
+    print(f"  - {BASE_PATH}/reporting/calls/search")
+    print(f"  - {BASE_PATH}/reporting/journeys/<CallId>")
+    print(f"  - {BASE_PATH}/reporting/calls/aggregate")
+    print(f"  - {BASE_PATH}/reporting/calls/distinct")
+    print(f"  - {BASE_PATH}/reporting/calls/top")
     print(f"  - {BASE_PATH}/reporting/calls/stream")
     print(f"  - {BASE_PATH}/reporting/calls/export")
     print(f"  - {BASE_PATH}/reporting/agents")
+    print(f"  - {BASE_PATH}/reporting/agents/events")
     print(f"  - {BASE_PATH}/reporting/statistics")
+    print(f"  - {BASE_PATH}/reporting/batch (POST)")
     print("\nFeatures:")
     print("  ✓ Date range filtering (startDate/endDate)")
     print("  ✓ Extension and direction filtering")
     print("  ✓ Kafka message format support")
     print("  ✓ CSV export with exact format match")
     print(f"  ✓ Bearer token authentication: {'ENABLED' if REQUIRE_AUTH else 'DISABLED'}")
+    print(f"  ✓ Admin request profiling: {'ENABLED' if PROFILING_ENABLED else 'DISABLED'}")
     print("\nAuthentication:")
     if REQUIRE_AUTH:
         print(f"  - Auth is ENABLED (set REQUIRE_AUTH=false to disable)")
@@ -1011,7 +8467,7 @@ if __name__ == '__main__':
     else:
         print("  - Auth is DISABLED (set REQUIRE_AUTH=true to enable)")
         print("  - All endpoints accessible without authentication")
-    print("\nStarting server on http://0.0.0.0:5000")
+    print(f"\nStarting server on http://0.0.0.0:{PORT}")
     print("=" * 70)
     
-    app.run(host='0.0.0.0', port=5000, debug=False)
+    app.run(host='0.0.0.0', port=PORT, debug=False)
@@ -108,7 +108,9 @@ Type=simple
 User=$USER
 WorkingDirectory=$APP_DIR
 Environment="PATH=$APP_DIR/venv/bin"
-ExecStart=$APP_DIR/venv/bin/gunicorn --bind 0.0.0.0:5000 --workers 4 --timeout 120 app:app
+# Clients connect to port 5000 directly, without a proxy
+Environment="RATE_LIMIT_PROXY_HOPS=0"
+ExecStart=$APP_DIR/venv/bin/gunicorn --bind 0.0.0.0:5000 --workers 4 --worker-class gthread --threads 32 --timeout 120 --preload app:app
 Restart=always
 RestartSec=10
 
@@ -5,12 +5,79 @@ Tests all Mitel-compliant endpoints
 """
 
 import requests
+import gzip
 import json
+import os
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 # API base URL
 BASE_URL = "http://localhost:5000"
 API_PATH = "/api/v1/reporting"
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+
+@contextmanager
+def local_server(port, log_file=None, workers=None, **env):
+    """
+    Run a separate server of app.py on port with extra settings (for
+    features disabled by default); yields its base URL. Its output goes
+    to log_file (an open file) when given. With `workers`, it runs under
+    gunicorn with that many threaded worker processes, preloaded as in the
+    Dockerfile.
+    """
+    state_dir = tempfile.mkdtemp(prefix="mitel-test-")
+    settings = {
+        "PORT": str(port),
+        "WARMUP_HOURS": "0",
+        "LOG_LEVEL": "WARNING",
+        "RATE_LIMIT_STATE_FILE": os.path.join(state_dir, "rate-limits.bin"),
+        "TENANT_METRICS_FILE": os.path.join(state_dir, "tenant-metrics.bin"),
+        "TOKEN_DIR": os.path.join(state_dir, "tokens"),
+        "FAULT_STATE_FILE": os.path.join(state_dir, "faults.json"),
+        "WEBHOOK_DIR": os.path.join(state_dir, "webhooks"),
+        "COALESCE_DIR": os.path.join(state_dir, "coalesce"),
+        "EXPORT_JOB_DIR": os.path.join(state_dir, "exports"),
+        "PROFILE_DIR": os.path.join(state_dir, "profiles")
+    }
+    settings.update(env)
+    output = log_file or subprocess.DEVNULL
+    command = [sys.executable, APP_PATH]
+    if workers:
+        command = [sys.executable, "-m", "gunicorn", "--bind", f"127.0.0.1:{port}",
+                   "--workers", str(workers), "--worker-class", "gthread", "--threads", "8",
+                   "--preload", "--chdir", os.path.dirname(APP_PATH), "app:app"]
+    process = subprocess.Popen(command, env=dict(os.environ, **settings),
+                               stdout=output, stderr=output)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        for _ in range(100):
+            try:
+                requests.get(f"{url}/health", timeout=1)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        yield url
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def admin_headers(url=BASE_URL):
+    """Bearer token header of the default admin user"""
+    login = requests.post(
+        f"{url}/auth/login",
+        json={"username": "admin@mitel.com", "password": "admin123"},
+        timeout=5
+    ).json()
+    return {"Authorization": f"Bearer {login['access_token']}"}
 
 def test_health():
     """Test health endpoint"""
@@ -48,6 +115,24 @@ def test_root():
         return False
 
 
+def test_health_startup():
+    """Test health endpoint reports warmup and worker stats"""
+    print("\n🔍 Testing /health startup and worker stats...")
+    try:
+        data = requests.get(f"{BASE_URL}/health", timeout=5).json()
+        startup = data.get('startup', {})
+        worker = data.get('worker', {})
+        if 'initMs' in startup and worker.get('pid'):
+            print("✅ Health startup stats passed")
+            print(f"Startup: {startup}, worker memory: {worker.get('memory')}")
+            return True
+        print(f"❌ Missing startup/worker stats: {data}")
+        return False
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
 def test_calls():
     """Test calls endpoint"""
     print(f"\n🔍 Testing {API_PATH}/calls...")
@@ -116,6 +201,56 @@ def test_calls_stream():
         return False
 
 
+def test_calls_stream_replay():
+    """Test paced timeline replay on a simulated clock"""
+    print(f"\n🔍 Testing {API_PATH}/calls/stream?speed= replay...")
+    try:
+        response = requests.get(
+            f"{BASE_URL}{API_PATH}/calls/stream?startDate=2025-11-17T09:00:00"
+            f"&endDate=2025-11-17T09:10:00&speed=1200&fields=RecordId,Call_date",
+            timeout=30
+        )
+        if response.status_code != 200:
+            print(f"❌ Failed with status {response.status_code}")
+            return False
+        messages = [json.loads(line) for line in response.text.splitlines()]
+        dates = [m['value']['Call_date'] for m in messages]
+        offsets = [m['offset'] for m in messages]
+        if (messages and offsets == sorted(offsets)
+                and all('2025-11-17T09:00:00' <= d <= '2025-11-17T09:10:00' for d in dates)):
+            print(f"✅ Stream replay passed")
+            print(f"Messages: {len(messages)}, first: {dates[0]}, last: {dates[-1]}")
+            return True
+        print(f"❌ Unexpected replay: {dates}")
+        return False
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
+def test_parallel_generation():
+    """Test streams and exports generated in the process pool, range by range"""
+    print(f"\n🔍 Testing process-pool generation of {API_PATH}/calls/stream and /calls/export...")
+    try:
+        with local_server(5106, PARALLEL_WORKERS="2", PARALLEL_MIN_RECORDS="100",
+                          PARALLEL_CHUNK_SIZE="64") as url:
+            params = {"limit": 500, "fields": "RecordId,Extno,Call_date",
+                      "startDate": "2025-11-20", "endDate": "2025-11-21"}
+            stream = requests.get(f"{url}{API_PATH}/calls/stream", params=params, timeout=30).json()
+            export = requests.get(f"{url}{API_PATH}/calls/export", params={"limit": 1000}, timeout=30)
+        values = [message['value'] for message in stream['messages']]
+        record_ids = [value['RecordId'] for value in values]
+        lines = export.text.strip().split('\n')
+        print(f"✅ Parallel generation passed: {len(values)} stream messages, {len(lines) - 1} CSV rows")
+        return (stream['count'] == 500 and record_ids == list(range(record_ids[0], record_ids[0] + 500))
+                and all(set(value) == {"RecordId", "Extno", "Call_date"} for value in values)
+                and all("2025-11-20" <= value['Call_date'] < "2025-11-22" for value in values)
+                and export.status_code == 200 and len(lines) == 1001)
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
 def test_calls_export():
     """Test calls export endpoint"""
     print(f"\n🔍 Testing {API_PATH}/calls/export...")
@@ -135,6 +270,145 @@ def test_calls_export():
         return False
 
 
+def test_calls_export_parquet():
+    """Test calls export endpoint with Parquet format"""
+    print(f"\n🔍 Testing {API_PATH}/calls/export?format=parquet...")
+    try:
+        response = requests.get(f"{BASE_URL}{API_PATH}/calls/export?format=parquet&limit=10", timeout=5)
+        if response.status_code == 200 and response.content[:4] == b"PAR1":
+            print(f"✅ Parquet export passed")
+            print(f"Bytes returned: {len(response.content)}")
+            return True
+        else:
+            print(f"❌ Parquet export failed: {response.status_code}")
+            return False
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
+def test_export_jobs():
+    """Test export job submission, progress polling and ranged download"""
+    print(f"\n🔍 Testing {API_PATH}/exports...")
+    try:
+        response = requests.post(
+            f"{BASE_URL}{API_PATH}/exports",
+            json={"startDate": "2025-11-20T09:00:00", "endDate": "2025-11-20T10:00:00", "format": "ndjson"},
+            timeout=5
+        )
+        if response.status_code != 202:
+            print(f"❌ Export job submission failed: {response.status_code}")
+            return False
+        job = response.json()['data']
+        for _ in range(120):
+            if job['status'] in ('completed', 'failed'):
+                break
+            time.sleep(0.5)
+            job = requests.get(f"{BASE_URL}{API_PATH}/exports/{job['id']}", timeout=5).json()['data']
+        if job['status'] != 'completed':
+            print(f"❌ Export job did not complete: {job['status']} {job.get('error')}")
+            return False
+        
+        download = f"{BASE_URL}{API_PATH}/exports/{job['id']}/download"
+        full = requests.get(download, timeout=10)
+        partial = requests.get(download, headers={"Range": "bytes=10-"}, timeout=10)
+        lines = gzip.decompress(full.content).decode().splitlines()
+        print(f"✅ Export job passed: {job['file']['records']} records, {job['file']['size']} bytes")
+        print(f"Range request: {partial.status_code} {partial.headers.get('Content-Range')}")
+        return (len(lines) == job['file']['records'] and partial.status_code == 206
+                and partial.content == full.content[10:])
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
+def test_webhook_subscription():
+    """Test that a subscription pushes batches to a local HTTP sink"""
+    print(f"\n🔍 Testing {API_PATH}/subscriptions...")
+    batches = []
+    
+    class Sink(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        
+        def do_POST(self):
+            batches.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+            self.send_response(204)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        
+        def log_message(self, *args):
+            pass
+    
+    sink = ThreadingHTTPServer(("127.0.0.1", 0), Sink)
+    threading.Thread(target=sink.serve_forever, daemon=True).start()
+    try:
+        # Loopback sinks have to be allowed explicitly
+        with local_server(5121, WEBHOOK_ALLOWED_HOSTS="127.0.0.1") as base_url:
+            start = (datetime.now() - timedelta(hours=1)).isoformat(timespec='seconds')
+            response = requests.post(
+                f"{base_url}{API_PATH}/subscriptions",
+                json={"url": f"http://127.0.0.1:{sink.server_port}/cdr", "startDate": start,
+                      "maxBatchRecords": 100, "maxBatchDelayMs": 200},
+                timeout=5
+            )
+            if response.status_code != 201:
+                print(f"❌ Subscription failed: {response.status_code}")
+                return False
+            subscription = response.json()['data']
+            url = f"{base_url}{API_PATH}/subscriptions/{subscription['id']}"
+            for _ in range(40):
+                if batches:
+                    break
+                time.sleep(0.25)
+            time.sleep(1.5)
+            metrics = requests.get(url, timeout=5).json()['data']['metrics']
+            requests.delete(url, timeout=5)
+        records = sum(batch['count'] for batch in batches)
+        print(f"✅ Webhook subscription passed: {len(batches)} batch(es), {records} records")
+        print(f"Delivered {metrics['deliveredRecords']} records, lag {metrics.get('lagSeconds')}s")
+        return (bool(batches) and all(len(batch['messages']) <= 100 for batch in batches)
+                and 'key' in batches[0]['messages'][0] and metrics['deliveredRecords'] > 0)
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+    finally:
+        sink.shutdown()
+
+
+def test_webhook_subscription_limits():
+    """Test that webhooks to private hosts, deep backfills and extra subscriptions are refused"""
+    print(f"\n🔍 Testing {API_PATH}/subscriptions limits...")
+    try:
+        with local_server(5122, WEBHOOK_ALLOWED_HOSTS="127.0.0.2", WEBHOOK_MAX_SUBSCRIPTIONS="1",
+                          WEBHOOK_MAX_BACKFILL_HOURS="24") as url:
+            subscriptions = f"{url}{API_PATH}/subscriptions"
+            
+            def create(target, **body):
+                response = requests.post(subscriptions, json=dict(body, url=target), timeout=5)
+                return response.status_code, response.json().get('error', {}).get('code')
+            
+            refused = [create(target) for target in (
+                "http://127.0.0.1:9/cdr", "http://10.1.2.3/cdr", "http://169.254.169.254/latest",
+                "http://[::ffff:127.0.0.1]:9/cdr", "http://localhost:9/cdr"
+            )]
+            backfill = create("http://127.0.0.2:9/cdr",
+                              startDate=(datetime.now() - timedelta(days=3)).isoformat(timespec='seconds'))
+            allowed = create("http://127.0.0.2:9/cdr")
+            extra = create("http://127.0.0.2:9/other")
+            for subscription in requests.get(subscriptions, timeout=5).json()['data']:
+                requests.delete(f"{subscriptions}/{subscription['id']}", timeout=5)
+        if (set(refused) != {(400, 'URL_NOT_ALLOWED')} or backfill != (400, 'INVALID_DATE_RANGE')
+                or allowed != (201, None) or extra != (409, 'TOO_MANY_SUBSCRIPTIONS')):
+            print(f"❌ Private hosts {refused}, backfill {backfill}, allowed {allowed}, extra {extra}")
+            return False
+        print(f"✅ Subscription limits passed: {len(refused)} private hosts refused, "
+              f"backfill {backfill[0]}, second subscription {extra[0]}")
+        return True
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
 def test_agents():
     """Test agents endpoint"""
     print(f"\n🔍 Testing {API_PATH}/agents...")
@@ -156,6 +430,58 @@ def test_agents():
         return False
 
 
+def test_agents_changes():
+    """Test agent state versions, deltas and the SSE feed"""
+    print(f"\n🔍 Testing {API_PATH}/agents?sinceVersion= and {API_PATH}/agents/events...")
+    try:
+        snapshot = requests.get(f"{BASE_URL}{API_PATH}/agents", timeout=5).json()
+        version = snapshot['version']
+        delta = requests.get(f"{BASE_URL}{API_PATH}/agents?sinceVersion={version}", timeout=5).json()
+        if delta.get('reset') or delta['version'] < version:
+            print(f"❌ Unexpected delta: {delta}")
+            return False
+        
+        with requests.get(f"{BASE_URL}{API_PATH}/agents/events", stream=True, timeout=10) as response:
+            lines = []
+            for line in response.iter_lines(decode_unicode=True):
+                lines.append(line)
+                if line.startswith('data:'):
+                    break
+        event = json.loads(lines[-1][len('data:'):])
+        if 'event: snapshot' in lines and len(event['data']) == snapshot['count']:
+            print(f"✅ Agent changes passed")
+            print(f"Version: {version}, changes since: {len(delta['changes'])}")
+            return True
+        print(f"❌ Unexpected SSE start: {lines}")
+        return False
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
+def test_agent_stream_cap():
+    """Test that agent event feeds beyond the per-worker cap are steered to polling"""
+    print(f"\n🔍 Testing {API_PATH}/agents/events feed cap...")
+    try:
+        with local_server(5110, AGENT_STREAM_MAX_CLIENTS="1") as url:
+            with requests.get(f"{url}{API_PATH}/agents/events", stream=True, timeout=10) as feed:
+                # Keep the line iterator: dropping it closes the connection
+                lines = feed.iter_lines()
+                next(lines)
+                refused = requests.get(f"{url}{API_PATH}/agents/events", timeout=10)
+                version = requests.get(f"{url}{API_PATH}/agents", timeout=5).json()['version']
+                poll = requests.get(f"{url}{API_PATH}/agents?sinceVersion={version}", timeout=5)
+        if (feed.status_code != 200 or refused.status_code != 503 or poll.status_code != 200
+                or refused.json()['error']['code'] != 'TOO_MANY_STREAMS'):
+            print(f"❌ Feed {feed.status_code}, second feed {refused.status_code}, poll {poll.status_code}")
+            return False
+        print(f"✅ Agent feed cap passed: {refused.json()['error']['message']}")
+        return True
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
 def test_statistics():
     """Test statistics endpoint"""
     print(f"\n🔍 Testing {API_PATH}/statistics...")
@@ -179,6 +505,62 @@ def test_statistics():
         return False
 
 
+def test_statistics_percentiles():
+    """Test statistics percentiles"""
+    print(f"\n🔍 Testing {API_PATH}/statistics percentiles...")
+    try:
+        response = requests.get(
+            f"{BASE_URL}{API_PATH}/statistics?startDate=2025-11-20&endDate=2025-11-20"
+            f"&extension=694311&percentiles=50,90,99",
+            timeout=30
+        )
+        if response.status_code != 200:
+            print(f"❌ Failed with status {response.status_code}")
+            return False
+        duration = response.json()['data']['callMetrics']['percentiles']['Duration']
+        if 0 <= duration['p50'] <= duration['p90'] <= duration['p99'] <= 600:
+            print(f"✅ Statistics percentiles passed")
+            print(f"Duration: {duration}")
+            return True
+        print(f"❌ Unexpected percentiles: {duration}")
+        return False
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
+def test_statistics_counts():
+    """Test statistics counts match the aggregated timeline"""
+    print(f"\n🔍 Testing {API_PATH}/statistics counts...")
+    try:
+        params = "startDate=2025-11-20T06:30:00&endDate=2025-11-21T09:15:00&extension=694311"
+        stats = requests.get(f"{BASE_URL}{API_PATH}/statistics?{params}", timeout=30).json()['data']
+        rows = requests.get(
+            f"{BASE_URL}{API_PATH}/calls/aggregate?{params}&groupBy=Direction,Unanswer", timeout=30
+        ).json()['data']
+        volume = stats['callVolume']
+        expected = {
+            "totalCalls": sum(row['count'] for row in rows),
+            "inboundCalls": sum(row['count'] for row in rows if row['Direction'] == 'I'),
+            "outboundCalls": sum(row['count'] for row in rows if row['Direction'] == 'O'),
+            "answeredCalls": sum(row['count'] for row in rows if row['Unanswer'] == '0'),
+            "missedCalls": sum(row['count'] for row in rows if row['Unanswer'] == '1')
+        }
+        again = requests.get(f"{BASE_URL}{API_PATH}/statistics?{params}", timeout=30).json()['data']
+        if volume != expected or again['callVolume'] != volume or again['journeyMetrics'] != stats['journeyMetrics']:
+            print(f"❌ Counts {volume} (then {again['callVolume']}), aggregate {expected}")
+            return False
+        if not 0 <= stats['callMetrics']['serviceLevel'] <= 1 or stats['agentMetrics']['totalAgents'] != 1:
+            print(f"❌ Unexpected metrics: {stats}")
+            return False
+        print(f"✅ Statistics counts passed")
+        print(f"Calls: {volume}, journeys: {stats['journeyMetrics']}")
+        return True
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
 def test_calls_date_filter():
     """Test calls endpoint with date range filter"""
     print(f"\n🔍 Testing {API_PATH}/calls with date range filter...")
@@ -234,6 +616,736 @@ def test_calls_date_filter_datetime():
         return False
 
 
+def test_calls_cursor_pagination():
+    """Test calls endpoint cursor pagination"""
+    print(f"\n🔍 Testing {API_PATH}/calls cursor pagination...")
+    try:
+        first = requests.get(
+            f"{BASE_URL}{API_PATH}/calls?startDate=2025-11-20&endDate=2025-11-20&limit=5",
+            timeout=5
+        )
+        if first.status_code != 200:
+            print(f"❌ First page failed: {first.status_code}")
+            return False
+        cursor = first.json()['pagination'].get('nextCursor')
+        if not cursor:
+            print("❌ No nextCursor returned")
+            return False
+        second = requests.get(f"{BASE_URL}{API_PATH}/calls?cursor={cursor}", timeout=5)
+        if second.status_code != 200:
+            print(f"❌ Second page failed: {second.status_code}")
+            return False
+        first_ids = [r['RecordId'] for r in first.json()['data']]
+        second_ids = [r['RecordId'] for r in second.json()['data']]
+        if second_ids and min(second_ids) > max(first_ids):
+            print(f"✅ Cursor pagination passed")
+            print(f"Page 1: {first_ids[0]}..{first_ids[-1]}, page 2: {second_ids[0]}..{second_ids[-1]}")
+            return True
+        print("❌ Second page does not continue the first")
+        return False
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
+def test_calls_changes():
+    """Test calls changes endpoint (delta sync)"""
+    print(f"\n🔍 Testing {API_PATH}/calls/changes...")
+    try:
+        first = requests.get(
+            f"{BASE_URL}{API_PATH}/calls/changes?since=2025-11-20T10:00:00&limit=5",
+            timeout=5
+        )
+        if first.status_code != 200:
+            print(f"❌ First poll failed: {first.status_code}")
+            return False
+        mark = first.json()['highWaterMark']['recordId']
+        second = requests.get(
+            f"{BASE_URL}{API_PATH}/calls/changes?sinceRecordId={mark}&limit=5",
+            timeout=5
+        )
+        if second.status_code != 200:
+            print(f"❌ Second poll failed: {second.status_code}")
+            return False
+        first_ids = [r['RecordId'] for r in first.json()['data']]
+        second_ids = [r['RecordId'] for r in second.json()['data']]
+        if len(first_ids) == 5 and second_ids and min(second_ids) > mark >= max(first_ids):
+            print(f"✅ Calls changes passed")
+            print(f"Poll 1: {first_ids[0]}..{first_ids[-1]}, poll 2: {second_ids[0]}..{second_ids[-1]}")
+            return True
+        print("❌ Second poll does not continue after the high-water mark")
+        return False
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
+def test_changes_waiter_cap():
+    """Test that long-polls beyond the per-worker cap are answered at once"""
+    print(f"\n🔍 Testing {API_PATH}/calls/changes long-poll cap...")
+    try:
+        with local_server(5107, CHANGES_MAX_WAITERS="1") as url:
+            params = {"wait": 3, "extension": "none"}
+
+            def poll():
+                started = time.time()
+                response = requests.get(f"{url}{API_PATH}/calls/changes", params=params, timeout=10)
+                return response, time.time() - started
+
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                held = executor.submit(poll)
+                time.sleep(0.5)
+                refused, refused_elapsed = poll()
+                held, held_elapsed = held.result()
+        print(f"✅ Long-poll cap passed: held {held_elapsed:.1f}s, refused after {refused_elapsed:.2f}s "
+              f"(Retry-After {refused.headers.get('Retry-After')})")
+        return (held.status_code == refused.status_code == 200 and held_elapsed >= 2.5
+                and refused_elapsed < 1 and refused.headers.get('Retry-After') == '1'
+                and 'Retry-After' not in held.headers)
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
+def test_calls_aggregate():
+    """Test calls aggregation endpoint"""
+    print(f"\n🔍 Testing {API_PATH}/calls/aggregate...")
+    try:
+        response = requests.get(
+            f"{BASE_URL}{API_PATH}/calls/aggregate?groupBy=Extno&metrics=count,avg:Duration"
+            f"&startDate=2025-11-20T10:00:00&endDate=2025-11-20T11:59:59",
+            timeout=30
+        )
+        if response.status_code != 200:
+            print(f"❌ Failed with status {response.status_code}")
+            return False
+        rows = response.json()['data']
+        calls = []
+        url = (f"{BASE_URL}{API_PATH}/calls?startDate=2025-11-20T10:00:00&endDate=2025-11-20T11:59:59"
+               f"&extension={rows[0]['Extno']}&limit=500")
+        while url:
+            page = requests.get(url, timeout=30).json()
+            calls.extend(page['data'])
+            cursor = page['pagination']['nextCursor']
+            url = f"{BASE_URL}{API_PATH}/calls?cursor={cursor}&limit=500" if cursor else None
+        if rows[0]['count'] == len(calls) and 0 <= rows[0]['avg:Duration'] <= 600:
+            print(f"✅ Calls aggregate passed")
+            print(f"Groups: {len(rows)}, {rows[0]}")
+            return True
+        print(f"❌ Count {rows[0]['count']} does not match the {len(calls)} records")
+        return False
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
+def test_calls_distinct_and_top():
+    """Test distinct-count and heavy-hitter endpoints"""
+    print(f"\n🔍 Testing {API_PATH}/calls/distinct and {API_PATH}/calls/top...")
+    try:
+        distinct = requests.get(
+            f"{BASE_URL}{API_PATH}/calls/distinct?bucket=day&startDate=2025-11-20&endDate=2025-11-21",
+            timeout=30
+        )
+        top = requests.get(
+            f"{BASE_URL}{API_PATH}/calls/top?field=Extno&k=3&startDate=2025-11-20&endDate=2025-11-21",
+            timeout=30
+        )
+        if distinct.status_code != 200 or top.status_code != 200:
+            print(f"❌ Failed with status {distinct.status_code} / {top.status_code}")
+            return False
+        days = distinct.json()['data']
+        counts = [row['count'] for row in top.json()['data']]
+        if (len(days) == 2
+                and all(row['lowerBound'] <= row['distinct'] <= min(row['upperBound'], row['calls'])
+                        for row in days)
+                and len(counts) == 3 and counts == sorted(counts, reverse=True)):
+            print(f"✅ Distinct and top passed")
+            print(f"Distinct callers: {[row['distinct'] for row in days]}, top extensions: {top.json()['data']}")
+            return True
+        print(f"❌ Unexpected results: {days}, {counts}")
+        return False
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
+def test_calls_search():
+    """Test indexed call search"""
+    print(f"\n🔍 Testing {API_PATH}/calls/search...")
+    try:
+        window = "startDate=2025-11-20T10:00:00&endDate=2025-11-20T10:59:59"
+        calls = requests.get(f"{BASE_URL}{API_PATH}/calls?{window}&limit=500", timeout=30).json()['data']
+        call = calls[len(calls) // 2]
+        by_leg = requests.get(
+            f"{BASE_URL}{API_PATH}/calls/search?legId={call['LegID']}", timeout=30
+        )
+        if by_leg.status_code != 200:
+            print(f"❌ LegID lookup failed with status {by_leg.status_code}")
+            return False
+        prefix = call['Number'][:7]
+        found = []
+        url = f"{BASE_URL}{API_PATH}/calls/search?number={requests.utils.quote(prefix)}&{window}&limit=2"
+        while url:
+            page = requests.get(url, timeout=30).json()
+            found.extend(page['data'])
+            cursor = page['pagination']['nextCursor']
+            url = f"{BASE_URL}{API_PATH}/calls/search?cursor={cursor}&limit=2" if cursor else None
+        expected = [c for c in calls if c['Number'].startswith(prefix)]
+        if by_leg.json()['data'] == [call] and found == expected:
+            print(f"✅ Calls search passed")
+            print(f"LegID: 1 call, Number {prefix}*: {len(found)} calls")
+            return True
+        print(f"❌ Search returned {len(found)} calls, expected {len(expected)}")
+        return False
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
+def test_journeys():
+    """Test call journey lookup"""
+    print(f"\n🔍 Testing {API_PATH}/journeys...")
+    try:
+        calls = requests.get(
+            f"{BASE_URL}{API_PATH}/calls?startDate=2025-11-20T10:00:00&endDate=2025-11-20T10:59:59&limit=500",
+            timeout=30
+        ).json()['data']
+        head = next(c for c in calls if c['Call_legId'] == '1' and int(c['Call_legs']) > 1)
+        response = requests.get(f"{BASE_URL}{API_PATH}/journeys/{head['CallId']}", timeout=5)
+        if response.status_code != 200:
+            print(f"❌ Failed with status {response.status_code}")
+            return False
+        journey = response.json()['data']
+        legs = journey['records']
+        linked = all(leg['PreviousLegID'] == before['LegID'] for before, leg in zip(legs, legs[1:]))
+        if (legs != [c for c in calls if c['CallId'] == head['CallId']] or not linked
+                or [leg['Call_legId'] for leg in legs] != [str(i) for i in range(1, journey['legs'] + 1)]):
+            print("❌ Journey legs are not linked or do not match the call records")
+            return False
+        # A callback is returned minutes after the abandoned call, not seconds
+        callback = [c for c in calls if c['CallId'] == next(
+            c['CallId'] for c in calls if c['Call_legId'] == '1' and c['JourneyOutcome'] == '703')]
+        returned_after = (datetime.fromisoformat(callback[-1]['Call_date'])
+                          - datetime.fromisoformat(callback[0]['Call_date'])).total_seconds()
+        if len(callback) != 2 or not 120 <= returned_after <= 3600:
+            print(f"❌ Callback {callback[0]['CallId']} returned after {returned_after:.0f}s")
+            return False
+        print(f"✅ Journeys passed")
+        print(f"{journey['CallId']}: {journey['journeyType']}, {journey['legs']} legs, "
+              f"outcome {journey['JourneyOutcome']}; callback {callback[0]['CallId']} returned after "
+              f"{returned_after:.0f}s")
+        return True
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
+def test_calls_coalescing():
+    """Test identical concurrent queries share one computation"""
+    print(f"\n🔍 Testing coalescing of concurrent {API_PATH}/calls/aggregate queries...")
+    try:
+        url = (f"{BASE_URL}{API_PATH}/calls/aggregate?groupBy=Direction&metrics=count,max:Duration"
+               f"&startDate=2025-06-01&endDate=2025-06-03")
+        with ThreadPoolExecutor(max_workers=6) as pool:
+            responses = list(pool.map(lambda _: requests.get(url, timeout=60), range(6)))
+        if any(r.status_code != 200 for r in responses):
+            print(f"❌ Failed with status {[r.status_code for r in responses]}")
+            return False
+        shared = sum(1 for r in responses if r.headers.get('X-Coalesced') == 'true')
+        if len({r.content for r in responses}) == 1 and shared >= 1:
+            print(f"✅ Coalescing passed")
+            print(f"Requests: {len(responses)}, served from a shared result: {shared}")
+            return True
+        print(f"❌ Responses differ or none coalesced (shared: {shared})")
+        return False
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
+def test_coalescing_other_keys():
+    """Test a query never waits for a different query sharing its coalescing stripe"""
+    print("\n🔍 Testing coalescing of different queries on one stripe...")
+    try:
+        with local_server(5108, COALESCE_STRIPES="1") as url:
+            slow_url = f"{url}{API_PATH}/calls/aggregate?groupBy=Extno&startDate=2025-03-01&endDate=2025-03-10"
+            quick_url = f"{url}{API_PATH}/calls/aggregate?startDate=2025-11-20T10:00:00&endDate=2025-11-20T10:30:00"
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                started = time.time()
+                slow = pool.submit(requests.get, slow_url, timeout=120)
+                time.sleep(0.5)
+                quick = requests.get(quick_url, timeout=120)
+                quick_seconds = time.time() - started
+                slow_response = slow.result()
+                slow_seconds = time.time() - started
+        if quick.status_code != 200 or slow_response.status_code != 200:
+            print(f"❌ Failed with status {quick.status_code}, {slow_response.status_code}")
+            return False
+        if quick_seconds * 2 >= slow_seconds or quick.headers.get('X-Coalesced') == 'true':
+            print(f"❌ Quick query took {quick_seconds:.1f}s, slow one {slow_seconds:.1f}s")
+            return False
+        print(f"✅ Stripe coalescing passed: quick query {quick_seconds:.1f}s, slow one {slow_seconds:.1f}s")
+        return True
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
+def test_calls_fields_projection():
+    """Test calls endpoint with a field projection"""
+    print(f"\n🔍 Testing {API_PATH}/calls with fields projection...")
+    try:
+        response = requests.get(
+            f"{BASE_URL}{API_PATH}/calls?fields=RecordId,Extno,Duration&limit=5",
+            timeout=5
+        )
+        if response.status_code == 200:
+            data = response.json()
+            keys = set(data['data'][0].keys()) if data.get('data') else set()
+            if keys == {"RecordId", "Extno", "Duration"}:
+                print(f"✅ Fields projection passed")
+                print(f"Fields returned: {sorted(keys)}")
+                return True
+            print(f"❌ Unexpected fields: {sorted(keys)}")
+            return False
+        else:
+            print(f"❌ Fields projection failed: {response.status_code}")
+            return False
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
+def test_batch():
+    """Test batch reporting endpoint"""
+    print(f"\n🔍 Testing {API_PATH}/batch...")
+    try:
+        response = requests.post(
+            f"{BASE_URL}{API_PATH}/batch",
+            json={"queries": [
+                {"id": "ext", "route": "calls", "params": {"extension": "694311", "limit": 5}},
+                {"id": "stats", "route": "statistics", "params": {}}
+            ]},
+            timeout=5
+        )
+        if response.status_code == 200:
+            results = response.json().get('results', {})
+            print(f"✅ Batch endpoint passed")
+            for query_id, result in results.items():
+                print(f"{query_id}: status {result.get('status')}")
+            return set(results) == {"ext", "stats"}
+        else:
+            print(f"❌ Batch endpoint failed: {response.status_code}")
+            return False
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
+def test_batch_placeholder_injection():
+    """Test batch parameters cannot forge the record placeholders of the response"""
+    print(f"\n🔍 Testing {API_PATH}/batch with a forged record placeholder...")
+    try:
+        forged = "\x00record\x00"
+        response = requests.post(
+            f"{BASE_URL}{API_PATH}/batch",
+            json={"queries": [
+                {"id": "forged", "route": "calls", "params": {"extension": forged, "limit": 5}},
+                {"id": "calls", "route": "calls", "params": {"limit": 3}}
+            ]},
+            timeout=10
+        )
+        results = response.json()['results']
+        echoed = results['forged']['body']['filters']['extension']
+        records = results['calls']['body']['data']
+        if response.status_code != 200 or echoed != forged or len(records) != 3:
+            print(f"❌ Unexpected response: {response.status_code} {echoed!r} {len(records)} records")
+            return False
+        if not all(isinstance(record, dict) and 'RecordId' in record for record in records):
+            print(f"❌ Records were not written in place: {records}")
+            return False
+        print(f"✅ Batch placeholder injection passed")
+        return True
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
+def test_admin_profiles_requires_admin():
+    """Test that profiling endpoints reject requests without an admin token"""
+    print("\n🔍 Testing /admin/profiles/hot without admin token...")
+    try:
+        response = requests.get(f"{BASE_URL}/admin/profiles/hot", timeout=5)
+        if response.status_code == 401:
+            print("✅ Profiling endpoint correctly requires admin token")
+            return True
+        else:
+            print(f"❌ Expected 401, got: {response.status_code}")
+            return False
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
+def test_json_access_log():
+    """Test that requests are logged as JSON lines, and sampled out per level"""
+    print("\n🔍 Testing JSON access log pipeline...")
+    try:
+        lines = {}
+        for port, rates in ((5102, ""), (5103, "INFO=0")):
+            with tempfile.TemporaryFile('w+') as log_file:
+                with local_server(port, log_file, LOG_LEVEL="INFO", LOG_FORMAT="json",
+                                  LOG_SAMPLE_RATES=rates) as url:
+                    for _ in range(3):
+                        requests.get(f"{url}{API_PATH}/calls", params={"limit": 1}, timeout=10)
+                    time.sleep(0.5)
+                log_file.seek(0)
+                lines[rates] = [json.loads(line) for line in log_file if line.startswith('{')]
+        access = [entry for entry in lines[""] if entry.get('route') == f"{API_PATH}/calls"]
+        sampled = [entry for entry in lines["INFO=0"] if entry.get('event') == 'request']
+        print(f"✅ Access log passed: {len(access)} request line(s), {len(sampled)} with INFO=0")
+        return (len(access) == 3 and access[0]['event'] == 'request'
+                and access[0]['status'] == 200 and 'latencyMs' in access[0] and not sampled)
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
+def test_rate_limits():
+    """Test record quotas (negative limits included) and spoofed X-Forwarded-For entries"""
+    print("\n🔍 Testing rate limits and record quotas...")
+    rules = {
+        "*": {"*": {"rate": 100, "burst": 100, "recordsPerMinute": 900}},
+        f"{API_PATH}/agents": {"*": {"rate": 0.1, "burst": 3}}
+    }
+    try:
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as rules_file:
+            json.dump(rules, rules_file)
+        with local_server(5104, RATE_LIMIT_ENABLED="true", RATE_LIMITS_FILE=rules_file.name) as url:
+            quota = [requests.get(f"{url}{API_PATH}/calls", params={"limit": limit}, timeout=10).status_code
+                     for limit in (500, -1000000, 500)]
+            spoofed = [
+                requests.get(f"{url}{API_PATH}/agents", timeout=5,
+                             headers={"X-Forwarded-For": f"192.0.2.{i}, 198.51.100.1"}).status_code
+                for i in range(5)
+            ]
+            # Batched searches pay their limits like /calls/search does
+            searches = [{"id": str(i), "route": "search", "params": {"legId": "1", "limit": 500}}
+                        for i in range(2)]
+            batch = [requests.post(f"{url}{API_PATH}/batch", json={"queries": searches[:count]}, timeout=10,
+                                   headers={"X-Forwarded-For": "203.0.113.7"}).status_code
+                     for count in (2, 1)]
+        os.unlink(rules_file.name)
+        if (quota != [200, 200, 429] or spoofed[:3] != [200] * 3 or spoofed[3:] != [429] * 2
+                or batch != [200, 429]):
+            print(f"❌ Quota {quota}, spoofed addresses {spoofed}, batched searches {batch}")
+            return False
+        print(f"✅ Rate limits passed: quota {quota}, spoofed addresses {spoofed}, batched searches {batch}")
+        return True
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
+def test_replay_limits():
+    """Test the per-worker replay cap and the record quota cost of replays"""
+    print(f"\n🔍 Testing {API_PATH}/calls/stream?speed= limits...")
+    rules = {"*": {"*": {"rate": 100, "burst": 100, "recordsPerMinute": 900}}}
+    try:
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as rules_file:
+            json.dump(rules, rules_file)
+        with local_server(5109, RATE_LIMIT_ENABLED="true", RATE_LIMITS_FILE=rules_file.name,
+                          SIMULATION_MAX_REPLAYS="1", SIMULATION_MAX_SECONDS="2") as url:
+            stream = f"{url}{API_PATH}/calls/stream"
+            held = requests.get(stream, params={"speed": 60}, stream=True, timeout=10)
+            refused = requests.get(stream, params={"speed": 60}, timeout=10)
+            held.close()
+            time.sleep(2.5)
+            again = requests.get(stream, params={"speed": 60}, timeout=10)
+            caps = [held.status_code, refused.status_code, again.status_code]
+            quota = [
+                # About 61 reachable messages, then 500 records, then a replay
+                # that can reach 7201 messages in SIMULATION_MAX_SECONDS
+                requests.get(stream, params={"speed": 3600, "startDate": "2025-11-17T08:00:00",
+                                             "endDate": "2025-11-17T08:10:00"}, timeout=10).status_code,
+                requests.get(f"{url}{API_PATH}/calls", params={"limit": 500}, timeout=10).status_code,
+                requests.get(stream, params={"speed": 3600, "startDate": "2025-11-17T08:00:00"},
+                             timeout=10).status_code
+            ]
+        os.unlink(rules_file.name)
+        if caps != [200, 503, 200] or refused.headers.get('Retry-After') != '1' or quota != [200, 200, 429]:
+            print(f"❌ Concurrent replays {caps}, quota {quota}")
+            return False
+        print(f"✅ Replay limits passed: concurrent replays {caps}, quota {quota}")
+        return True
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
+def test_admission_control():
+    """Test that slow routes are shed, probed again later, and queued requests shed"""
+    print("\n🔍 Testing admission control...")
+    try:
+        with local_server(5105, ADMISSION_CONTROL_ENABLED="true", ADMISSION_LATENCY_TARGET_MS="100",
+                          ADMISSION_PROBE_SECONDS="1") as url:
+            end = datetime.now() - timedelta(days=1)
+            params = {"groupBy": "Extno", "startDate": (end - timedelta(days=6)).strftime('%Y-%m-%d'),
+                      "endDate": end.strftime('%Y-%m-%d')}
+            aggregate = f"{url}{API_PATH}/calls/aggregate"
+            statuses = [requests.get(aggregate, params=params, timeout=30).status_code for _ in range(2)]
+            time.sleep(1.1)
+            statuses.append(requests.get(aggregate, params=params, timeout=30).status_code)
+            queued = requests.get(f"{url}{API_PATH}/agents", timeout=5,
+                                  headers={"X-Request-Start": f"t={time.time() - 5:.3f}"})
+            health = requests.get(f"{url}/health", timeout=5).json()
+        print(f"✅ Admission control passed: aggregate {statuses}, queued request {queued.status_code}")
+        print(f"Admission stats: {health.get('admission')}")
+        return (statuses == [200, 503, 200] and queued.status_code == 503
+                and queued.json()['error']['code'] == 'SERVICE_OVERLOADED')
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
+def test_profiled_stream():
+    """Test that an on-demand profile covers a streamed body"""
+    print(f"\n🔍 Testing profiled {API_PATH}/calls/stream...")
+    try:
+        with local_server(5101, PROFILING_ENABLED="true", PROFILING_CONTINUOUS="true") as url:
+            headers = dict(admin_headers(url), **{"X-Profile": "cprofile"})
+            response = requests.get(f"{url}{API_PATH}/calls/stream", params={"limit": 500},
+                                    headers=headers, timeout=10)
+            profile_url = response.headers.get('X-Profile-Url')
+            if response.status_code != 200 or not profile_url:
+                print(f"❌ Profiled stream failed: {response.status_code}")
+                return False
+            profile = requests.get(f"{url}{profile_url}", headers=headers, timeout=5)
+            bad_top = requests.get(f"{url}/admin/profiles/hot", params={"top": "x"},
+                                   headers=headers, timeout=5)
+        print(f"✅ Profiled stream passed: {len(profile.content)} byte profile")
+        return (profile.status_code == 200 and b'wrap_in_kafka_format' in profile.content
+                and bad_top.status_code == 400)
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
+def test_admin_tenants():
+    """Test that records and metrics are partitioned by the token's tenant"""
+    print("\n🔍 Testing /admin/tenants...")
+    try:
+        response = requests.get(f"{BASE_URL}/admin/tenants", timeout=5)
+        if response.status_code != 401:
+            print(f"❌ Expected 401 without token, got: {response.status_code}")
+            return False
+        login = requests.post(
+            f"{BASE_URL}/auth/login",
+            json={"username": "admin@mitel.com", "password": "admin123"},
+            timeout=5
+        ).json()
+        headers = {"Authorization": f"Bearer {login['access_token']}"}
+        calls = requests.get(f"{BASE_URL}{API_PATH}/calls", params={"limit": 5},
+                             headers=headers, timeout=10).json()
+        response = requests.get(f"{BASE_URL}/admin/tenants", headers=headers, timeout=5)
+        if response.status_code != 200:
+            print(f"❌ Tenants endpoint failed: {response.status_code}")
+            return False
+        tenants = {tenant['account']: tenant for tenant in response.json()['data']}
+        tenant = tenants.get(login['user']['account_id'], tenants.get('*'))
+        tenant_ids = {record['TenantId'] for record in calls['data']}
+        print(f"✅ Tenants endpoint passed: {len(tenants)} tenant(s)")
+        print(f"Account {login['user']['account_id']} -> tenant {tenant['tenantId']}, "
+              f"{tenant['metrics']['requests']} request(s), records TenantId {sorted(tenant_ids)}")
+        return tenant_ids <= {tenant['tenantId']} and tenant['metrics']['requests'] >= 1
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
+def test_tenant_metrics_shared():
+    """Test that /admin/tenants counts the requests of every worker process"""
+    print("\n🔍 Testing /admin/tenants metrics across workers...")
+    try:
+        with local_server(5111, workers=2) as url:
+            headers = admin_headers(url)
+            for _ in range(20):
+                requests.get(f"{url}{API_PATH}/agents", headers={"Connection": "close"}, timeout=10)
+            reports = []
+            for _ in range(6):
+                response = requests.get(f"{url}/admin/tenants", timeout=5,
+                                        headers=dict(headers, Connection="close")).json()
+                tenant = {tenant['account']: tenant for tenant in response['data']}['*']
+                reports.append((response['worker'], tenant['metrics']['requests']))
+        if not all(requests_ >= 20 for _, requests_ in reports):
+            print(f"❌ Requests seen by (worker, requests): {reports}")
+            return False
+        print(f"✅ Shared tenant metrics passed: {len({worker for worker, _ in reports})} worker(s) "
+              f"report {[requests_ for _, requests_ in reports]} requests")
+        return True
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
+def test_token_revocation_shared():
+    """Test that tokens work on every worker and an injected expiry revokes them on all"""
+    print("\n🔍 Testing bearer tokens across workers...")
+    try:
+        with local_server(5120, workers=2, REQUIRE_AUTH="true") as url:
+            admin = admin_headers(url)
+            user = dict(admin_headers(url), Connection="close")
+            agents = f"{url}{API_PATH}/agents"
+            before = {requests.get(agents, headers=user, timeout=10).status_code for _ in range(20)}
+            # Workers pick up new fault profiles within a second
+            published = requests.put(f"{url}/admin/faults", json={f"{API_PATH}/agents": {"tokenExpiryRate": 1}},
+                                     headers=admin, timeout=5).status_code
+            time.sleep(2.1)
+            expired = requests.get(agents, headers=user, timeout=10)
+            requests.put(f"{url}/admin/faults", json={}, headers=admin, timeout=5)
+            time.sleep(2.1)
+            after = {requests.get(agents, headers=user, timeout=10).status_code for _ in range(20)}
+            other = requests.get(agents, headers=admin, timeout=10).status_code
+        if before != {200} or expired.status_code != 401 or after != {401} or other != 200:
+            print(f"❌ Before {before}, profile {published}, expiry {expired.status_code}, "
+                  f"after {after}, other token {other}")
+            return False
+        print(f"✅ Shared tokens passed: valid on all workers {before}, revoked on all {after}")
+        return True
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
+def test_admin_faults():
+    """Test that fault profiles set by an admin delay a route's responses"""
+    print("\n🔍 Testing /admin/faults...")
+    try:
+        login = requests.post(
+            f"{BASE_URL}/auth/login",
+            json={"username": "admin@mitel.com", "password": "admin123"},
+            timeout=5
+        ).json()
+        headers = {"Authorization": f"Bearer {login['access_token']}"}
+        profiles = {f"{API_PATH}/agents": {"latencyMs": 300}}
+        response = requests.put(f"{BASE_URL}/admin/faults", json=profiles, headers=headers, timeout=5)
+        if response.status_code != 200:
+            print(f"❌ Fault profile update failed: {response.status_code}")
+            return False
+        try:
+            time.sleep(1.1)
+            started = time.time()
+            delayed = requests.get(f"{BASE_URL}{API_PATH}/agents", timeout=10)
+            elapsed = time.time() - started
+        finally:
+            requests.put(f"{BASE_URL}/admin/faults", json={}, headers=headers, timeout=5)
+        print(f"✅ Fault injection passed: {delayed.headers.get('X-Fault-Injected')} in {elapsed:.2f}s")
+        return delayed.status_code == 200 and elapsed >= 0.3 and 'latency=300ms' in delayed.headers.get('X-Fault-Injected', '')
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
+def cluster_pages(url, params, pages=3):
+    """RecordIds and next cursors of the first pages of a /calls query"""
+    walked = []
+    for _ in range(pages):
+        response = requests.get(f"{url}{API_PATH}/calls", params=params, timeout=30).json()
+        walked.append(([record['RecordId'] for record in response['data']],
+                       response['pagination']['nextCursor']))
+        if not response['pagination']['nextCursor']:
+            break
+        params = {"cursor": response['pagination']['nextCursor'], "limit": params["limit"]}
+    return walked
+
+
+def statistics_differences(clustered, standalone):
+    """Fields of two /statistics payloads that differ (percentiles within 2%)"""
+    differences = []
+    for section in ("callVolume", "journeyMetrics", "agentMetrics", "callMetrics"):
+        for name, value in standalone[section].items():
+            if name == "percentiles":
+                for field, points in value.items():
+                    for point, expected in points.items():
+                        actual = clustered[section][name][field][point]
+                        if abs(actual - expected) > max(abs(expected) * 0.02, 0.2):
+                            differences.append(f"{field} {point}: {actual} != {expected}")
+            elif name != "activeAgents" and clustered[section][name] != value:
+                differences.append(f"{name}: {clustered[section][name]} != {value}")
+    return differences
+
+
+def test_cluster_matches_standalone():
+    """Test that a three-node cluster answers pages and statistics like a single node"""
+    print("\n🔍 Testing cluster results against a standalone node...")
+    queries = [
+        {"startDate": "2025-11-20", "endDate": "2025-11-20", "limit": 40},
+        {"startDate": "2025-11-18", "endDate": "2025-11-21", "extension": "694311",
+         "direction": "I", "limit": 25}
+    ]
+    windows = [
+        {"startDate": "2025-11-17", "endDate": "2025-11-18"},
+        {"startDate": "2025-11-17", "endDate": "2025-11-18", "extension": "694311"}
+    ]
+    try:
+        with local_server(5118) as standalone:
+            expected_pages = [cluster_pages(standalone, query) for query in queries]
+            expected_statistics = [
+                requests.get(f"{standalone}{API_PATH}/statistics", params=window, timeout=30).json()['data']
+                for window in windows
+            ]
+        for shard_by, first_port in (("hour", 5112), ("extension", 5115)):
+            ports = range(first_port, first_port + 3)
+            peers = ",".join(f"http://127.0.0.1:{port}" for port in ports)
+            with tempfile.TemporaryFile('w+') as log_file, ExitStack() as nodes:
+                urls = [
+                    nodes.enter_context(local_server(port, log_file=log_file if node == 0 else None,
+                                                     CLUSTER_PEERS=peers, CLUSTER_NODE=str(node),
+                                                     CLUSTER_SHARD_BY=shard_by))
+                    for node, port in enumerate(ports)
+                ]
+                pages = [cluster_pages(urls[0], query) for query in queries]
+                statistics = [
+                    requests.get(f"{urls[0]}{API_PATH}/statistics", params=window, timeout=30).json()['data']
+                    for window in windows
+                ]
+                log_file.seek(0)
+                fallbacks = log_file.read().count("Cluster peer")
+            if pages != expected_pages:
+                print(f"❌ {shard_by} cluster pages differ from the standalone node's")
+                return False
+            differences = [difference for clustered, single in zip(statistics, expected_statistics)
+                           for difference in statistics_differences(clustered, single)]
+            if differences or fallbacks:
+                print(f"❌ {shard_by} cluster statistics differ: {differences}, "
+                      f"{fallbacks} shard(s) computed locally")
+                return False
+        page_sizes = [[len(ids) for ids, _ in walked] for walked in expected_pages]
+        print(f"✅ Cluster results passed: pages {page_sizes} and statistics match "
+              f"by hour and by extension")
+        return True
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
+def test_cluster_shard_requires_signature():
+    """Test that unsigned cluster shard requests are rejected"""
+    print("\n🔍 Testing unsigned cluster shard request...")
+    try:
+        response = requests.get(f"{BASE_URL}{API_PATH}/calls", params={"limit": 5},
+                                headers={"X-Cluster-Shard": "0"}, timeout=10)
+        if response.status_code != 403:
+            print(f"❌ Expected 403, got: {response.status_code}")
+            return False
+        print(f"✅ Unsigned shard request rejected: {response.json()['error']['code']}")
+        return response.json()['error']['code'] == 'CLUSTER_AUTH_FAILED'
+    except Exception as e:
+        print(f"❌ Error: {e}")
+        return False
+
+
 def main():
     """Run all tests"""
     print("=" * 70)
@@ -246,14 +1358,49 @@ def main():
     tests = [
         test_root,
         test_health,
+        test_health_startup,
         test_calls,
         test_calls_filter_extension,
         test_calls_date_filter,
         test_calls_date_filter_datetime,
+        test_calls_fields_projection,
+        test_calls_cursor_pagination,
+        test_calls_changes,
+        test_changes_waiter_cap,
+        test_calls_aggregate,
+        test_calls_distinct_and_top,
+        test_calls_search,
+        test_journeys,
+        test_calls_coalescing,
+        test_coalescing_other_keys,
         test_calls_stream,
+        test_calls_stream_replay,
         test_calls_export,
+        test_parallel_generation,
+        test_calls_export_parquet,
+        test_export_jobs,
+        test_webhook_subscription,
+        test_webhook_subscription_limits,
         test_agents,
-        test_statistics
+        test_agents_changes,
+        test_agent_stream_cap,
+        test_statistics,
+        test_statistics_percentiles,
+        test_statistics_counts,
+        test_batch,
+        test_batch_placeholder_injection,
+        test_admin_profiles_requires_admin,
+        test_rate_limits,
+        test_replay_limits,
+        test_admission_control,
+        test_profiled_stream,
+        test_json_access_log,
+        test_admin_tenants,
+        test_tenant_metrics_shared,
+        test_token_revocation_shared,
+        test_admin_faults,
+        test_cluster_shard_requires_signature,
+        test_cluster_matches_standalone
     ]
     
     results = []